@@ -1,9 +1,14 @@
 import sys
+from typing import List
 
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.management.base import BaseCommand
 
+from authentication.models import Profile
+
 ## LOGGING
 import logging
 logger = logging.getLogger(__name__)
@@ -17,6 +22,36 @@ class MockManager:
         logger.info("creating mock user %s", username)
         return user
 
+    @staticmethod
+    def bulk_create_users(usernames: List[str], password: str, batch_size: int = 5000) -> List[int]:
+        """Creates many users (and their profiles) in bulk, the password is
+           hashed once and the per-user post_save signals are skipped
+
+        Returns:
+            List[int]: ids of the created users, in the usernames order
+        """
+        password_hash = make_password(password)
+        User.objects.bulk_create(
+            [User(username=username, password=password_hash) for username in usernames],
+            batch_size=batch_size
+        )
+        # bulk_create doesn't return pks on every backend
+        ids_by_username = {}
+        for i in range(0, len(usernames), 500):
+            ids_by_username.update(User.objects.filter(
+                username__in=usernames[i:i+500]
+            ).values_list('username', 'id'))
+        user_ids = [ids_by_username[username] for username in usernames]
+
+        # what the User post_save signals would have done
+        Profile.objects.bulk_create(
+            [Profile(user_id=user_id) for user_id in user_ids],
+            batch_size=batch_size
+        )
+        cache.delete_pattern('*{}*'.format(getattr(settings, 'AUTHENTICATION_CACHE_KEY', '')))
+        logger.info("creating %s mock users", len(user_ids))
+        return user_ids
+
 
 class Command(BaseCommand):
     def handle(self, *args, **options):
@@ -11,6 +11,11 @@ class Profile(models.Model):
     status = models.CharField(max_length=15, choices=Status.choices, blank=True, null=True, default=Status.offline)
     status_msg = models.CharField(max_length=255, blank=True, null=True, verbose_name="Status message")
 
+    class Meta:
+        # users directory filtered by ?profile__status=, in the pagination order
+        indexes = [
+            models.Index(fields=['status', 'user'], name='auth_profile_status_user_idx'),
+        ]
 
 
     def __str__(self):
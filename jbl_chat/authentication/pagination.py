@@ -0,0 +1,12 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class UserCursorPagination(CursorPagination):
+    """Keyset pagination of the users directory on the primary key: pages
+       cost the same at any depth and no count query is run
+    """
+    ordering = 'id'
+    page_size = getattr(settings, 'USERS_PAGE_SIZE', 100)
+    page_size_query_param = 'page_size'
+    max_page_size = getattr(settings, 'USERS_MAX_PAGE_SIZE', 1000)
@@ -0,0 +1,124 @@
+from time import time
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from jbl_chat.profiling import timed
+from .models import Profile
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+PRESENCE_CACHE_KEY = getattr(settings, 'PRESENCE_CACHE_KEY', 'presence')
+
+# users with a live presence key, scored by its expiry timestamp, so that
+# the expired ones can be written back as offline
+ONLINE_SET = '{}:online'.format(PRESENCE_CACHE_KEY)
+
+# sets the user status and its expiry, returns the previous status
+# (KEYS[1] presence key, KEYS[2] online set,
+#  ARGV[1] user id, ARGV[2] status, ARGV[3] ttl, ARGV[4] now)
+HEARTBEAT_LUA = """
+local previous = redis.call('GET', KEYS[1])
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+redis.call('ZADD', KEYS[2], tonumber(ARGV[4]) + tonumber(ARGV[3]), ARGV[1])
+return previous
+"""
+
+_heartbeat_script = None
+
+
+def get_presence_ttl() -> int:
+    """Seconds a heartbeat keeps the user status, without a new heartbeat
+       the user is offline
+    """
+    return getattr(settings, 'PRESENCE_TTL', 60)
+
+
+def _presence_key(user_id: int) -> str:
+    return '{}:{}'.format(PRESENCE_CACHE_KEY, user_id)
+
+
+def _get_heartbeat_script():
+    global _heartbeat_script
+    if _heartbeat_script is None:
+        _heartbeat_script = get_redis_connection('default').register_script(HEARTBEAT_LUA)
+    return _heartbeat_script
+
+
+def _decode(value: Optional[bytes]) -> str:
+    return value.decode() if value else Profile.Status.offline
+
+
+def _write_back(status: str, user_ids: Iterable[int]):
+    # 'update' sends no post_save, the users pages are not invalidated
+    Profile.objects.filter(user_id__in=list(user_ids)).update(status=status)
+
+
+def heartbeat(user_id: int, status: str = Profile.Status.online) -> bool:
+    """Keeps the user in 'status' for PRESENCE_TTL seconds, an 'Offline'
+       status removes the presence. Profile.status is written only on the
+       transitions
+
+    Returns:
+        bool: whether the status changed
+    """
+    with timed('cache'):
+        if status == Profile.Status.offline:
+            pipe = get_redis_connection('default').pipeline()
+            pipe.get(_presence_key(user_id))
+            pipe.delete(_presence_key(user_id))
+            pipe.zrem(ONLINE_SET, user_id)
+            previous = pipe.execute()[0]
+        else:
+            previous = _get_heartbeat_script()(
+                keys=[_presence_key(user_id), ONLINE_SET],
+                args=[user_id, status, get_presence_ttl(), int(time())]
+            )
+
+    changed = _decode(previous) != status
+    if changed:
+        _write_back(status, [user_id])
+    return changed
+
+
+def has_presence(user_id: int) -> bool:
+    """Whether the user has a live heartbeat (so it was found by a previous one)"""
+    with timed('cache'):
+        return bool(get_redis_connection('default').exists(_presence_key(user_id)))
+
+
+def get_presence(user_ids: Iterable[int]) -> Dict[int, str]:
+    """Status of many users (e.g. the members of a room) with one MGET,
+       users without a live heartbeat are offline
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    with timed('cache'):
+        values = get_redis_connection('default').mget([_presence_key(user_id) for user_id in user_ids])
+    return {user_id: _decode(value) for user_id, value in zip(user_ids, values)}
+
+
+def sweep_presence(now: Optional[float] = None) -> int:
+    """Writes back as offline the users whose presence expired
+
+    Returns:
+        int: users set offline
+    """
+    now = time() if now is None else now
+    conn = get_redis_connection('default')
+    expired = [int(user_id) for user_id in conn.zrangebyscore(ONLINE_SET, '-inf', now)]
+    if not expired:
+        return 0
+
+    # a heartbeat may have come meanwhile
+    live = get_presence(expired)
+    expired = [user_id for user_id, status in live.items() if status == Profile.Status.offline]
+    if expired:
+        conn.zrem(ONLINE_SET, *expired)
+        _write_back(Profile.Status.offline, expired)
+    logger.info('%s users went offline', len(expired))
+    return len(expired)
@@ -1,11 +1,14 @@
 from random import random
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
+from django.db.models import Manager
 from .models import Profile
+from .presence import get_presence
 from rest_framework import serializers
+from jbl_chat.profiling import ProfiledModelSerializer
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(ProfiledModelSerializer):
     class Meta:
         model = Profile
         fields = '__all__'
@@ -13,13 +16,40 @@ class UserProfileSerializer(serializers.ModelSerializer):
             'user': {"required": False, "allow_null": True}
         }
 
-class UserBaseSerializer(serializers.ModelSerializer):
+class UserBaseSerializer(ProfiledModelSerializer):
     class Meta:
         model = User
         fields = ('username',)
 
 
-class UserSerializer(serializers.ModelSerializer):
+class PresenceListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, Manager) else data)
+        # the status of all the users with one redis call (unless read
+        # by the view already)
+        if 'presence' not in self.context:
+            self.context['presence'] = get_presence(user.id for user in users)
+        return super().to_representation(users)
+
+
+class UserListSerializer(ProfiledModelSerializer):
+    """Slim representation of the users directory (the presence
+       status only), the details are served by UserSerializer
+    """
+    status = serializers.SerializerMethodField()
+
+    class Meta:
+        model = User
+        fields = ('id', 'username', 'first_name', 'last_name', 'status')
+        list_serializer_class = PresenceListSerializer
+
+    def get_status(self, user: User) -> str:
+        presence = self.context.get('presence') or get_presence([user.id])
+        return presence[user.id]
+
+
+class UserSerializer(ProfiledModelSerializer):
     profile = UserProfileSerializer()
     last_login = serializers.DateTimeField(format='%Y-%m-%d %H:%M:%S', read_only=True)
 
@@ -27,7 +57,14 @@ class UserSerializer(serializers.ModelSerializer):
         model = User
         exclude = ("groups", "user_permissions")
         extra_kwargs = {'password': {'write_only':True}}
-        
+
+    def to_representation(self, instance):
+        ret = super().to_representation(instance)
+        if ret.get('profile'):
+            # the live status, Profile.status is written only on transitions
+            ret['profile']['status'] = get_presence([instance.id])[instance.id]
+        return ret
+
     def create(self, validated_data):
         # create user 
         profile_data = validated_data.pop('profile')
@@ -0,0 +1,20 @@
+from __future__ import absolute_import, unicode_literals
+
+from jbl_chat.celery import app as celery_app
+
+from authentication.presence import sweep_presence
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+@celery_app.task
+def sweep_expired_presence() -> int:
+    """Periodic task (celery beat) that writes back as offline the users
+       that stopped sending heartbeats
+
+    Returns:
+        int: users set offline
+    """
+    return sweep_presence()
@@ -1,3 +1,185 @@
-from django.test import TestCase
+from time import time
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import count_queries
+from chat.models import ChatRoom
+from .models import Profile
+from .presence import ONLINE_SET, _presence_key, heartbeat, sweep_presence
+from .tasks import sweep_expired_presence
+#
+
+
+@override_settings(TESTING=True)
+class UsersDirectoryTestCase(TransactionTestCase):
+    """
+        * test_0001_cursor_pages   : authentication__list    : GET : Test the users are paged by cursor with the slim representation
+
+        * test_0002_status_filter  : authentication__list    : GET : Test the status filter is paged, index backed and checked against the live status
+
+        * test_0003_details        : authentication__details : GET : Test the details keep the full representation
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        for i in range(25):
+            user = User.objects.create(username='directory{:02}'.format(i), password='test')
+            if i % 3 == 0:
+                heartbeat(user.id, Profile.Status.online)
+        super(UsersDirectoryTestCase, self).setUp()
+
+    def test_0001_cursor_pages(self):
+        url = '{}?page_size=10'.format(reverse('authentication__list'))
+        usernames = []
+        while url:
+            cache.clear()
+            with count_queries() as counter:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            # a single query per page, no count
+            self.assertEqual(counter[0], 1)
+
+            page = response.json()
+            usernames += [user['username'] for user in page['results']]
+            url = page['next']
+
+        self.assertEqual(usernames, ['directory{:02}'.format(i) for i in range(25)])
+        self.assertEqual(set(page['results'][0]), {'id', 'username', 'first_name', 'last_name', 'status'})
+
+        # a deleted user is no longer listed, while its deletion job runs
+        User.objects.filter(username='directory01').update(is_active=False)
+        response = self.client.get('{}?page_size=3'.format(reverse('authentication__list')))
+        self.assertEqual([user['username'] for user in response.json()['results']], [
+            'directory00', 'directory02', 'directory03'
+        ])
+
+    def test_0002_status_filter(self):
+        url = '{}?page_size=5&profile__status=Online'.format(reverse('authentication__list'))
+        response = self.client.get(url)
+        page = response.json()
+        self.assertEqual([user['username'] for user in page['results']], [
+            'directory00', 'directory03', 'directory06', 'directory09', 'directory12'
+        ])
+        self.assertEqual({user['status'] for user in page['results']}, {'Online'})
+        self.assertEqual(len(self.client.get(page['next']).json()['results']), 4)
+
+        # an expired heartbeat, not swept yet: the profile is still online
+        get_redis_connection('default').delete(_presence_key(User.objects.get(username='directory03').id))
+        self.assertEqual(Profile.objects.get(user__username='directory03').status, 'Online')
+        page = self.client.get(url).json()
+        # kept by the live status, the page is shorter
+        self.assertEqual([user['username'] for user in page['results']], [
+            'directory00', 'directory06', 'directory09', 'directory12'
+        ])
+        self.assertEqual(len(self.client.get(page['next']).json()['results']), 4)
+
+        # the plan depends on the backend and the table size, the index exists
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, Profile._meta.db_table)
+        self.assertTrue(constraints['auth_profile_status_user_idx']['index'])
+        self.assertEqual(constraints['auth_profile_status_user_idx']['columns'], ['status', 'user_id'])
+
+    def test_0003_details(self):
+        user = User.objects.get(username='directory03')
+        response = self.client.get(reverse('authentication__details', args=(user.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['profile']['status'], 'Online')
+
+
+@override_settings(TESTING=True, PRESENCE_TTL=60)
+class PresenceTestCase(TransactionTestCase):
+    """
+        * test_0001_heartbeat      : authentication__presence : PUT : Test the heartbeats write the profile only on transitions
+
+        * test_0002_users_status   : authentication__list     : GET : Test the users endpoints read the status from the presence
+
+        * test_0003_room_members   : chat__bulk_members       : GET : Test the presence of the room members
+
+        * test_0004_sweep          : sweep_expired_presence   :     : Test the expired presences are written back as offline
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='presence1', password='test')
+        self.user2 = User.objects.create(username='presence2', password='test')
+        super(PresenceTestCase, self).setUp()
+
+    def heartbeat(self, user, status=None):
+        data = {'status': status} if status else {}
+        return self.client.put(
+            reverse('authentication__presence', args=(user.id,)),
+            data=data, content_type='application/json'
+        )
+
+    def test_0001_heartbeat(self):
+        with count_queries() as counter:
+            response = self.heartbeat(self.user1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'status': 'Online', 'ttl': 60})
+        # offline -> online, the user is looked up
+        self.assertEqual(counter[0], 2)
+        self.assertEqual(Profile.objects.get(user=self.user1).status, 'Online')
+
+        # same status, redis only
+        with count_queries() as counter:
+            for _ in range(5):
+                self.heartbeat(self.user1)
+        self.assertEqual(counter[0], 0)
+
+        self.heartbeat(self.user1, 'Busy')
+        self.assertEqual(Profile.objects.get(user=self.user1).status, 'Busy')
+        self.heartbeat(self.user1, 'Offline')
+        self.assertEqual(Profile.objects.get(user=self.user1).status, 'Offline')
+
+        self.assertEqual(self.heartbeat(self.user1, 'Away').status_code, 400)
+
+        # unknown users get no presence
+        unknown = User(id=self.user2.id + 1000)
+        self.assertEqual(self.heartbeat(unknown).status_code, 404)
+        self.assertFalse(get_redis_connection('default').exists(_presence_key(unknown.id)))
+        self.assertIsNone(get_redis_connection('default').zscore(ONLINE_SET, unknown.id))
+
+    def test_0002_users_status(self):
+        self.heartbeat(self.user2, 'Busy')
+        response = self.client.get(reverse('authentication__list'))
+        self.assertEqual(
+            {user['username']: user['status'] for user in response.json()['results']},
+            {'presence1': 'Offline', 'presence2': 'Busy'}
+        )
+
+        # the durable status is ignored without a live heartbeat
+        Profile.objects.filter(user=self.user1).update(status='Online')
+        response = self.client.get(reverse('authentication__details', args=(self.user1.id,)))
+        self.assertEqual(response.json()['profile']['status'], 'Offline')
+        response = self.client.get(reverse('authentication__details', args=(self.user2.id,)))
+        self.assertEqual(response.json()['profile']['status'], 'Busy')
+
+    def test_0003_room_members(self):
+        room = ChatRoom.objects.create(room_name='presence', is_direct=False)
+        room.room_member.add(self.user1, self.user2)
+        self.heartbeat(self.user1)
+
+        response = self.client.get(reverse('chat__bulk_members', args=(room.id,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(user['username'], user['status']) for user in response.json()['data']],
+            [('presence1', 'Online'), ('presence2', 'Offline')]
+        )
+
+    def test_0004_sweep(self):
+        self.heartbeat(self.user1)
+        self.heartbeat(self.user2)
+        # user 1 heartbeat expired, user 2 is still alive
+        get_redis_connection('default').delete('{}:{}'.format(settings.PRESENCE_CACHE_KEY, self.user1.id))
+
+        self.assertEqual(sweep_presence(now=time() + 61), 1)
+        self.assertEqual(Profile.objects.get(user=self.user1).status, 'Offline')
+        self.assertEqual(Profile.objects.get(user=self.user2).status, 'Online')
+        self.assertEqual(sweep_expired_presence.apply().result, 0)
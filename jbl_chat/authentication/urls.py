@@ -1,15 +1,10 @@
 from django.urls import path
-from django.conf import settings
-from authentication.views.users import UserListCreateAPIView, UserRetrieveUpdateDestroyAPIView 
+from authentication.views.users import UserListCreateAPIView, UserPresenceAPIView, UserRetrieveUpdateDestroyAPIView
 
-from django.views.decorators.cache import cache_page
-from django.core.cache.backends.base import DEFAULT_TIMEOUT
-
-
-CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
-AUTHENTICATION_CACHE_KEY = getattr(settings, 'AUTHENTICATION_CACHE_KEY', '')
 
+# not cached, the users status is live (see authentication.presence)
 urlpatterns = [
-    path('', cache_page(CACHE_TTL, key_prefix=AUTHENTICATION_CACHE_KEY)(UserListCreateAPIView.as_view()), name="authentication__list"),
-    path('<int:pk>/', cache_page(CACHE_TTL, key_prefix=AUTHENTICATION_CACHE_KEY)(UserRetrieveUpdateDestroyAPIView.as_view()), name="authentication__details"),
-]
\ No newline at end of file
+    path('', UserListCreateAPIView.as_view(), name="authentication__list"),
+    path('<int:pk>/', UserRetrieveUpdateDestroyAPIView.as_view(), name="authentication__details"),
+    path('<int:pk>/presence/', UserPresenceAPIView.as_view(), name="authentication__presence"),
+]
@@ -1,20 +1,26 @@
 from rest_framework import generics
+from rest_framework.views import APIView
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import BasicAuthentication
 from django.contrib.auth.models import User
 from django_filters.rest_framework import DjangoFilterBackend
 from django.db import transaction
-from authentication.serializers import  UserSerializer
+from authentication.models import Profile
+from authentication.pagination import UserCursorPagination
+from authentication.presence import get_presence, get_presence_ttl, has_presence, heartbeat
+from authentication.serializers import UserListSerializer, UserSerializer
 from rest_framework.response import Response
 from rest_framework import status
+from chat.cleanup import schedule_user_deletion
 
 
 
 class UserListCreateAPIView(generics.ListCreateAPIView):
     # permission_classes = (IsAuthenticated, BasicAuthentication, SessionAuthentication)
-    queryset = User.objects.all()
+    queryset = User.objects.select_related('profile')
     serializer_class = UserSerializer
+    pagination_class = UserCursorPagination
     filter_backends = [DjangoFilterBackend]
     filterset_fields = [
         "id",
@@ -24,6 +30,36 @@ class UserListCreateAPIView(generics.ListCreateAPIView):
         "profile__status"
     ]
 
+    def get_queryset(self):
+        if self.request.method == 'GET':
+            # only the columns of the slim list representation,
+            # the status comes from the presence. The deleted users
+            # are deactivated until their deletion job is done
+            return User.objects.filter(is_active=True).only('id', 'username', 'first_name', 'last_name')
+        return super().get_queryset()
+
+    def get_serializer_class(self):
+        if self.request.method == 'GET':
+            return UserListSerializer
+        return UserSerializer
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        status_filter = self.request.query_params.get('profile__status')
+        if page is None or self.request.method != 'GET' or not status_filter:
+            return page
+        # Profile.status of the expired heartbeats is written back only by
+        # the beat sweep, the page users are kept by their live status: a
+        # page may have less users than page_size, the cursor follows the ids
+        self.presence = get_presence(user.id for user in page)
+        return [user for user in page if self.presence[user.id] == status_filter]
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if hasattr(self, 'presence'):
+            context['presence'] = self.presence
+        return context
+
     @transaction.atomic
     def post(self, request, format=None):
         try:
@@ -37,5 +73,38 @@ class UserListCreateAPIView(generics.ListCreateAPIView):
 
 class UserRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView):
     # permission_classes = (IsAuthenticated, BasicAuthentication, SessionAuthentication)
-    queryset = User.objects.all()
-    serializer_class = UserSerializer
\ No newline at end of file
+    queryset = User.objects.select_related('profile')
+    serializer_class = UserSerializer
+
+    def destroy(self, request, *args, **kwargs):
+        """The user is deactivated at once, its chat data and the user
+           itself are deleted in chunks by a celery job
+        """
+        user = self.get_object()
+        user.is_active = False
+        user.save(update_fields=['is_active'])
+        job = schedule_user_deletion(user.pk)
+        return Response({'task_id': job.id}, status=status.HTTP_202_ACCEPTED)
+
+
+class UserPresenceAPIView(APIView):
+    # permission_classes = (IsAuthenticated, BasicAuthentication, SessionAuthentication)
+
+    def put(self, request, pk, format=None):
+        """Presence heartbeat of the user, to repeat within PRESENCE_TTL seconds
+        {
+            "status": "Online" | "Busy" | "Offline"    (default "Online")
+        }
+        """
+        user_status = request.data.get('status', Profile.Status.online)
+        if user_status not in Profile.Status.values:
+            return Response(
+                {'status': ['"{}" is not a valid choice.'.format(user_status)]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        # the users with a live presence were found by a previous heartbeat,
+        # the steady heartbeats don't hit the db
+        if not has_presence(pk) and not User.objects.filter(pk=pk, is_active=True).exists():
+            return Response({'detail': 'Not found.'}, status=status.HTTP_404_NOT_FOUND)
+        heartbeat(pk, user_status)
+        return Response({'status': user_status, 'ttl': get_presence_ttl()}, status=status.HTTP_200_OK)
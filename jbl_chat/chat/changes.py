@@ -0,0 +1,133 @@
+from datetime import timedelta
+from itertools import chain
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from django.db.models import DateTimeField, ExpressionWrapper, Func, Q
+
+from chat.models import ChangeLog, Membership, Message
+from chat.sharding import room_db, scatter
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_sync_page_size() -> int:
+    """Max changes returned by a sync request"""
+    return getattr(settings, 'CHAT_SYNC_PAGE_SIZE', 500)
+
+
+def get_sync_settle_time() -> float:
+    """Seconds a change waits before being synced, so that the changes
+       of the transactions still running (their seq is allocated before
+       the commit) are never skipped by a client that synced a higher one
+    """
+    return getattr(settings, 'CHAT_SYNC_SETTLE_SECONDS', 5)
+
+
+class StatementNow(Func):
+    """The db clock when the statement runs (Now() is the start of the
+       transaction on postgres), the same clock for all the web nodes
+       and workers
+    """
+    template = 'CURRENT_TIMESTAMP'
+    output_field = DateTimeField()
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template='STATEMENT_TIMESTAMP()', **extra_context)
+
+
+def record_changes(kind: str, room_id: int, user_ids: Iterable[int], message_id: Optional[int] = None, db: Optional[str] = None):
+    """Appends to the change sequence a change of the room for every user,
+       with a single insert. To call in the transaction of the change, on
+       the db of the room: on the global db the change commits with it, on
+       a shard it's appended once the shard transaction commits
+    """
+    changes = [
+        ChangeLog(kind=kind, room_id=room_id, user_id=user_id, message_id=message_id, created_at=StatementNow())
+        for user_id in user_ids
+    ]
+    if not changes:
+        return
+    if (db or DEFAULT_DB_ALIAS) == router.db_for_write(ChangeLog):
+        ChangeLog.objects.bulk_create(changes)
+    else:
+        transaction.on_commit(lambda: ChangeLog.objects.bulk_create(changes), using=db)
+
+
+def record_change(kind: str, room_id: int, user_id: int, message_id: Optional[int] = None, db: Optional[str] = None):
+    record_changes(kind, room_id, [user_id], message_id, db)
+
+
+def _settled(queryset):
+    # the changes older than the settle time, by the db clock
+    settle_time = get_sync_settle_time()
+    if not settle_time:
+        return queryset
+    return queryset.filter(created_at__lte=ExpressionWrapper(
+        StatementNow() - timedelta(seconds=settle_time),
+        output_field=DateTimeField()
+    ))
+
+
+def current_seq() -> int:
+    """Seq to start syncing from, the last settled change"""
+    return _settled(ChangeLog.objects.order_by('-id')).values_list('id', flat=True).first() or 0
+
+
+def get_changes(user_id: int, since: int, limit: int) -> Tuple[List[ChangeLog], bool]:
+    """Changes after 'since' of the rooms the user is in, plus its own
+       joins and leaves (of the rooms it left meanwhile too), only the
+       settled ones (see get_sync_settle_time)
+
+    Returns:
+        Tuple[List[ChangeLog], bool]: the changes by seq and whether there are more
+    """
+    def query(db):
+        return list(Membership.objects.using(db).filter(
+            user_id=user_id,
+            date_lefted__isnull=True
+        ).values_list('chatroom_id', flat=True))
+
+    room_ids = sorted(set(chain(*scatter(query))))
+    changes = list(_settled(ChangeLog.objects.filter(
+        Q(room_id__in=room_ids) | Q(user_id=user_id),
+        id__gt=since
+    )).order_by('id')[:limit + 1])
+    return changes[:limit], len(changes) > limit
+
+
+def _load_messages(changes: List[ChangeLog]) -> Dict[int, Message]:
+    """Messages of the 'message' changes, one query per shard"""
+    by_db = {}
+    for change in changes:
+        if change.kind == ChangeLog.Kind.message:
+            by_db.setdefault(room_db(change.room_id), set()).add(change.message_id)
+
+    return {
+        msg.id: msg
+        for msg in chain(*scatter(
+            lambda db: list(Message.objects.using(db).filter(pk__in=by_db[db])),
+            dbs=by_db
+        ))
+    }
+
+
+def serialize_changes(changes: List[ChangeLog]) -> List[dict]:
+    """Compact form of the changes, the messages are inlined"""
+    messages = _load_messages(changes)
+    data = []
+    for change in changes:
+        row = {'seq': change.id, 'kind': change.kind, 'room': change.room_id, 'user': change.user_id}
+        if change.kind == ChangeLog.Kind.message:
+            msg = messages.get(change.message_id)
+            if msg is None:
+                # deleted with its room
+                continue
+            row['message'] = {'id': msg.id, 'text': msg.text, 'sent_at': msg.sent_at}
+        elif change.kind == ChangeLog.Kind.seen:
+            row['message'] = change.message_id
+        data.append(row)
+    return data
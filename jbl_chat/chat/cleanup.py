@@ -0,0 +1,159 @@
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import models, router, transaction
+from django.utils import timezone
+
+from chat.changes import record_change
+from chat.models import ChangeLog, ChatRoom, InboxEntry, Membership, Message, OutboxEvent, SeenMessage
+from chat.outbox import add_membership_events
+from chat.recent import forget_recent_messages
+from chat.sharding import get_shards
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_delete_chunk_size() -> int:
+    """Rows deleted (or updated) by each statement of the cleanup jobs"""
+    return getattr(settings, 'CHAT_DELETE_CHUNK_SIZE', 1000)
+
+
+def _apply(task, **kwargs):
+    # like prefetch_celery_behaviour, tests run the jobs synchronously
+    if getattr(settings, 'TESTING', False):
+        return task.apply(kwargs=kwargs)
+    return task.apply_async(kwargs=kwargs)
+
+
+def schedule_room_deletion(room_id: int, db: Optional[str] = None):
+    """Deletes an (empty) chat room and its data in a celery job, to
+       call once the last leave is committed (the job keeps rooms with
+       members)
+    """
+    from chat.tasks import delete_chatroom_data
+
+    return _apply(delete_chatroom_data, room_id=room_id, db=db)
+
+
+def schedule_user_deletion(user_id: int):
+    """Deletes a user and its chat data in a celery job"""
+    from chat.tasks import delete_user_data
+
+    return _apply(delete_user_data, user_id=user_id)
+
+
+def delete_in_chunks(queryset: models.QuerySet, db: Optional[str], progress: Optional[Callable] = None) -> int:
+    """Set based delete of the rows of 'queryset', one chunk of ids at a
+       time: rows are never loaded as model instances and no delete signal
+       is sent, so memory and statement size don't grow with the rows
+
+    Returns:
+        int: deleted rows
+    """
+    model = queryset.model
+    alias = db or router.db_for_write(model)
+    chunk_size = get_delete_chunk_size()
+    deleted = 0
+    while True:
+        ids = list(queryset.using(alias).values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += model.objects.using(alias).filter(pk__in=ids)._raw_delete(alias)
+        if progress:
+            progress(model._meta.model_name, deleted)
+
+
+def update_in_chunks(queryset: models.QuerySet, db: Optional[str], progress: Optional[Callable] = None, **values) -> int:
+    """queryset.update(**values) one chunk of ids at a time, 'queryset' must
+       not match the updated rows anymore
+
+    Returns:
+        int: updated rows
+    """
+    model = queryset.model
+    alias = db or router.db_for_write(model)
+    chunk_size = get_delete_chunk_size()
+    updated = 0
+    while True:
+        ids = list(queryset.using(alias).values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return updated
+        updated += model.objects.using(alias).filter(pk__in=ids).update(**values)
+        if progress:
+            progress(model._meta.model_name, updated)
+
+
+def delete_room(room_id: int, db: Optional[str] = None, progress: Optional[Callable] = None) -> Dict[str, int]:
+    """Deletes a chat room and all its data, children first, in chunks.
+       The room is kept if someone joined it in the meanwhile
+
+    Returns:
+        Dict[str, int]: deleted rows by model name
+    """
+    if Membership.objects.using(db).filter(chatroom_id=room_id, date_lefted__isnull=True).exists():
+        logger.info('chat room %s not deleted, it has members again', room_id)
+        return {}
+
+    deleted = {
+        'inboxentry': delete_in_chunks(InboxEntry.objects.filter(room_id=room_id), db, progress),
+        'seenmessage': delete_in_chunks(SeenMessage.objects.filter(message__room_id=room_id), db, progress),
+        'message': delete_in_chunks(Message.objects.filter(room_id=room_id), db, progress),
+        'membership': delete_in_chunks(Membership.objects.filter(chatroom_id=room_id), db, progress),
+    }
+    # nothing left to cascade, the post_delete signal updates the shard map
+    deleted['chatroom'], _ = ChatRoom.objects.using(db).filter(pk=room_id).delete()
+    forget_recent_messages([room_id])
+    logger.info('chat room %s deleted: %s', room_id, deleted)
+    return deleted
+
+
+def delete_user(user_id: int, progress: Optional[Callable] = None) -> Dict[str, int]:
+    """Deletes a user and its chat data from all the shards, in chunks:
+       its receipts, inbox and memberships are deleted, its messages are
+       kept without sender. The group rooms it leaves empty are deleted
+       by their own jobs
+
+    Returns:
+        Dict[str, int]: deleted (or updated) rows by model name
+    """
+    counts = {'seenmessage': 0, 'inboxentry': 0, 'message': 0, 'membership': 0}
+    for db in get_shards() or [None]:
+        counts['seenmessage'] += delete_in_chunks(SeenMessage.objects.filter(seen_by_id=user_id), db, progress)
+        counts['inboxentry'] += delete_in_chunks(InboxEntry.objects.filter(user_id=user_id), db, progress)
+        sent_room_ids = set(Message.objects.using(db).filter(
+            msg_from_id=user_id
+        ).values_list('room_id', flat=True).distinct())
+        counts['message'] += update_in_chunks(
+            Message.objects.filter(msg_from_id=user_id), db, progress, msg_from=None
+        )
+
+        room_ids = list(Membership.objects.using(db).filter(
+            user_id=user_id,
+            date_lefted__isnull=True
+        ).values_list('chatroom_id', flat=True))
+        with transaction.atomic(using=db):
+            Membership.objects.using(db).filter(
+                user_id=user_id,
+                date_lefted__isnull=True
+            ).update(date_lefted=timezone.now())
+            for room_id in room_ids:
+                add_membership_events(OutboxEvent.Kind.leave, room_id, [user_id], db)
+                record_change(ChangeLog.Kind.leave, room_id, user_id, db=db)
+        counts['membership'] += delete_in_chunks(Membership.objects.filter(user_id=user_id), db, progress)
+
+        empty_room_ids = set(room_ids) - set(Membership.objects.using(db).filter(
+            chatroom_id__in=room_ids,
+            date_lefted__isnull=True
+        ).values_list('chatroom_id', flat=True))
+        for room_id in sorted(empty_room_ids):
+            schedule_room_deletion(room_id, db)
+        # the cached messages of the user have no sender now
+        forget_recent_messages(sent_room_ids)
+
+    # the chat data is gone, the cascade only meets the profile
+    User.objects.filter(pk=user_id).delete()
+    logger.info('user %s deleted: %s', user_id, counts)
+    return counts
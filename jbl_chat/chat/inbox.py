@@ -0,0 +1,156 @@
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections, router
+from django.db.models import Subquery, OuterRef
+
+from chat.models import ChatRoom, InboxEntry, Membership, Message, SeenMessage
+from chat.sharding import group_by_db, room_db, scatter
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+def get_fanout_threshold() -> int:
+    """Rooms with less members than this value get their messages
+       copied in every recipient inbox at send time (fan-out-on-write),
+       bigger rooms are resolved at read time (fan-out-on-read)
+    """
+    return getattr(settings, 'CHAT_INBOX_FANOUT_THRESHOLD', 50)
+
+
+def fan_out_message(msg: Message, member_ids: Iterable[int]) -> int:
+    """Writes an inbox entry for every room member except the sender,
+       if the room is small enough
+
+    Args:
+        msg (Message): the message just created
+        member_ids (Iterable[int]): ids of the current room members
+
+    Returns:
+        int: number of inbox rows written
+    """
+    recipients = [m_id for m_id in set(member_ids) if m_id != msg.msg_from_id]
+    if len(recipients) + 1 >= get_fanout_threshold():
+        logger.debug('room %s too big for fan-out-on-write', msg.room_id)
+        return 0
+
+    db = room_db(msg)
+    InboxEntry.objects.using(db).bulk_create([
+        InboxEntry(user_id=user_id, room_id=msg.room_id, message_id=msg.id)
+        for user_id in recipients
+    ])
+    Message.objects.using(db).filter(pk=msg.pk).update(fanned_out=True)
+    msg.fanned_out = True
+    return len(recipients)
+
+
+def backfill_inbox(room_id: int, user_ids: Iterable[int], db=None) -> int:
+    """Writes the inbox entries of the fanned-out messages of a room for
+       the users joining it (to call once their memberships are created),
+       they were written at send time only for the members of that time.
+       Messages sent or already seen by the user are skipped.
+       A single INSERT .. SELECT, whatever the room history
+
+    Returns:
+        int: number of inbox rows written
+    """
+    user_ids = sorted(set(user_ids))
+    if not user_ids:
+        return 0
+    db = db or router.db_for_write(InboxEntry)
+    conn = connections[db]
+    table = lambda model: conn.ops.quote_name(model._meta.db_table)
+
+    with conn.cursor() as cursor:
+        # entries kept from a previous membership are left as they are
+        cursor.execute(
+            '{insert} {inbox} (user_id, room_id, message_id) '
+            'SELECT ms.user_id, m.room_id, m.id FROM {message} m '
+            'INNER JOIN {membership} ms ON ms.chatroom_id = m.room_id '
+            'WHERE m.room_id = %s AND m.fanned_out = %s AND ms.date_lefted IS NULL '
+            'AND ms.user_id IN ({users}) '
+            'AND (m.msg_from_id IS NULL OR m.msg_from_id <> ms.user_id) '
+            'AND NOT EXISTS (SELECT 1 FROM {seen} s WHERE s.message_id = m.id AND s.seen_by_id = ms.user_id)'
+            '{suffix}'.format(
+                insert=conn.ops.insert_statement(ignore_conflicts=True),
+                inbox=table(InboxEntry),
+                message=table(Message),
+                membership=table(Membership),
+                seen=table(SeenMessage),
+                users=', '.join(['%s'] * len(user_ids)),
+                suffix=conn.ops.ignore_conflicts_suffix_sql(ignore_conflicts=True),
+            ),
+            [room_id, True] + user_ids
+        )
+        return cursor.rowcount
+
+
+def get_unseen_messages(reader: User, chat_rooms: Iterable[ChatRoom]) -> Dict[int, List[Message]]:
+    """Merges the two sources of unseen messages of the reader:
+       - the inbox entries written at send time (small rooms)
+       - the messages not fanned out, filtered at read time (big rooms)
+
+    Returns:
+        Dict[int, List[Message]]: unseen messages by chat room id
+    """
+    by_db = group_by_db(chat_rooms)
+
+    unseen = {}
+    for unseen_in_db in scatter(
+        lambda db: _get_unseen_messages(db, reader, [cr.id for cr in by_db[db]]),
+        dbs=by_db
+    ):
+        unseen.update(unseen_in_db)
+    return unseen
+
+
+def _get_unseen_messages(db, reader: User, room_ids: List[int]) -> Dict[int, List[Message]]:
+    unseen = {room_id: {} for room_id in room_ids}
+
+    inbox_msgs = Message.objects.using(db).filter(
+        id__in=InboxEntry.objects.using(db).filter(
+            user_id=reader.id,
+            room_id__in=room_ids
+        ).values('message_id')
+    )
+
+    not_fanned_out_msgs = Message.objects.using(db).filter(
+        room_id__in=room_ids,
+        fanned_out=False
+    ).exclude(
+        msg_from_id=reader.id      # exclude msgs sent by me
+    ).annotate(
+        already_seen=Subquery(
+            SeenMessage.objects.using(db).filter(
+                seen_by_id=reader.id,        # annotate the already seen msgs
+                message_id=OuterRef('id'),
+            ).values('message_id')[:1]
+        )
+    ).filter(
+        already_seen__isnull=True
+    )                                # filter where annotation is None
+
+    for qset in (inbox_msgs, not_fanned_out_msgs):
+        for msg in qset.order_by('id'):
+            unseen[msg.room_id][msg.id] = msg
+
+    return {
+        room_id: sorted(msgs.values(), key=lambda m: m.id)
+        for room_id, msgs in unseen.items()
+    }
+
+
+def clear_inbox(chat_room_id: int, reader_id: int, up_to_message_id: int) -> int:
+    """Removes the inbox entries of a room once its messages were set as seen,
+       messages newer than 'up_to_message_id' are kept since they arrived
+       after the reader fetched the room
+    """
+    deleted, _ = InboxEntry.objects.using(room_db(chat_room_id)).filter(
+        room_id=chat_room_id,
+        user_id=reader_id,
+        message_id__lte=up_to_message_id
+    ).delete()
+    return deleted
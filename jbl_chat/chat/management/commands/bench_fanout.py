@@ -0,0 +1,200 @@
+import random
+import sys
+from time import perf_counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+
+from chat.inbox import fan_out_message, get_unseen_messages
+from chat.models import ChatRoom, InboxEntry, Membership, Message
+from chat.sequences import next_seq
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+# room size samplers by distribution name
+ROOM_SIZE_DISTRIBUTIONS = {
+    # only small rooms (direct chats and families)
+    'small': lambda rnd, n_users: rnd.randint(2, 8),
+    # mostly small rooms, some medium and a few very big ones
+    'mixed': lambda rnd, n_users: rnd.choices(
+        [rnd.randint(2, 10), rnd.randint(10, 100), rnd.randint(min(200, n_users), n_users)],
+        weights=[80, 18, 2]
+    )[0],
+    # half direct chats, half broadcast rooms
+    'broadcast': lambda rnd, n_users: rnd.choice(
+        [rnd.randint(2, 5), rnd.randint(n_users // 2, n_users)]
+    ),
+}
+
+
+class Rollback(Exception):
+    pass
+
+
+class FanoutBenchmark:
+    """Builds a synthetic data set inside a transaction, sends and reads
+       messages through chat.inbox and rolls everything back
+    """
+
+    def __init__(self, distribution: str, n_users: int, n_rooms: int, n_messages: int, n_reads: int, seed: int):
+        self.distribution = distribution
+        self.n_users = n_users
+        self.n_rooms = n_rooms
+        self.n_messages = n_messages
+        self.n_reads = n_reads
+        self.rnd = random.Random(seed)
+
+    def build(self):
+        User.objects.bulk_create([
+            User(username=f'bench_{self.distribution}_{i}', password='!')
+            for i in range(self.n_users)
+        ])
+        # bulk_create doesn't return pks on every backend
+        self.user_ids = list(User.objects.filter(
+            username__startswith=f'bench_{self.distribution}_'
+        ).values_list('id', flat=True))
+
+        ChatRoom.objects.bulk_create([
+            ChatRoom(
+                room_name=f'bench_{self.distribution}_{i}',
+                internal_identifier=f'bench_{self.distribution}_{i}',
+            ) for i in range(self.n_rooms)
+        ])
+        rooms = list(ChatRoom.objects.filter(
+            room_name__startswith=f'bench_{self.distribution}_'
+        ))
+
+        size_of = ROOM_SIZE_DISTRIBUTIONS[self.distribution]
+        self.members = {}
+        memberships = []
+        for cr in rooms:
+            size = min(size_of(self.rnd, self.n_users), self.n_users)
+            self.members[cr.id] = self.rnd.sample(self.user_ids, size)
+            memberships += [
+                Membership(user_id=user_id, chatroom_id=cr.id)
+                for user_id in self.members[cr.id]
+            ]
+        Membership.objects.bulk_create(memberships, batch_size=1000)
+        self.rooms_by_user = {}
+        for room_id, member_ids in self.members.items():
+            for user_id in member_ids:
+                self.rooms_by_user.setdefault(user_id, []).append(room_id)
+
+    def run_writes(self) -> dict:
+        room_ids = list(self.members)
+        inbox_rows = 0
+        with CaptureQueriesContext(connection) as ctx:
+            start = perf_counter()
+            for _ in range(self.n_messages):
+                room_id = self.rnd.choice(room_ids)
+                member_ids = self.members[room_id]
+                with transaction.atomic():
+                    msg = Message.objects.create(
+                        room_id=room_id,
+                        msg_from_id=self.rnd.choice(member_ids),
+                        text='bench',
+                        seq=next_seq(room_id)
+                    )
+                inbox_rows += fan_out_message(msg, member_ids)
+            elapsed = perf_counter() - start
+
+        return {
+            'write_ms': elapsed * 1000 / self.n_messages,
+            'write_queries': len(ctx.captured_queries) / self.n_messages,
+            'write_rows': (self.n_messages + inbox_rows) / self.n_messages,
+        }
+
+    def run_reads(self) -> dict:
+        readers = self.rnd.sample(list(self.rooms_by_user), min(self.n_reads, len(self.rooms_by_user)))
+        scanned = 0
+        returned = 0
+        elapsed = 0
+        queries = 0
+        for reader_id in readers:
+            reader = User(pk=reader_id)
+            rooms = [ChatRoom(pk=room_id) for room_id in self.rooms_by_user[reader_id]]
+
+            with CaptureQueriesContext(connection) as ctx:
+                start = perf_counter()
+                unseen = get_unseen_messages(reader, rooms)
+                elapsed += perf_counter() - start
+            queries += len(ctx.captured_queries)
+            returned += sum(len(msgs) for msgs in unseen.values())
+
+            # rows the DB has to look at to answer the read
+            room_ids = [cr.pk for cr in rooms]
+            scanned += InboxEntry.objects.filter(user_id=reader_id, room_id__in=room_ids).count()
+            scanned += Message.objects.filter(room_id__in=room_ids, fanned_out=False).count()
+
+        n_reads = len(readers) or 1
+        return {
+            'read_ms': elapsed * 1000 / n_reads,
+            'read_queries': queries / n_reads,
+            'read_rows': scanned / n_reads,
+            'read_returned': returned / n_reads,
+        }
+
+    def run(self, threshold: int) -> dict:
+        result = {'distribution': self.distribution, 'threshold': threshold}
+        with override_settings(CHAT_INBOX_FANOUT_THRESHOLD=threshold):
+            try:
+                with transaction.atomic():
+                    self.build()
+                    result.update(self.run_writes())
+                    result.update(self.run_reads())
+                    raise Rollback()
+            except Rollback:
+                pass
+        return result
+
+
+class Command(BaseCommand):
+    help = "Compares read and write amplification of fan-out-on-write vs fan-out-on-read by room size distribution"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--reads', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--distribution', nargs='+', choices=list(ROOM_SIZE_DISTRIBUTIONS),
+            default=list(ROOM_SIZE_DISTRIBUTIONS)
+        )
+        parser.add_argument(
+            '--threshold', nargs='+', type=int,
+            # pure fan-out-on-read, configured hybrid, pure fan-out-on-write
+            default=[0, getattr(settings, 'CHAT_INBOX_FANOUT_THRESHOLD', 50), sys.maxsize]
+        )
+
+    def handle(self, *args, **options):
+        columns = (
+            'distribution', 'threshold', 'write_ms', 'write_queries', 'write_rows',
+            'read_ms', 'read_queries', 'read_rows', 'read_returned'
+        )
+        self.stdout.write(' | '.join(columns))
+        try:
+            for distribution in options['distribution']:
+                for threshold in options['threshold']:
+                    bench = FanoutBenchmark(
+                        distribution,
+                        n_users=options['users'],
+                        n_rooms=options['rooms'],
+                        n_messages=options['messages'],
+                        n_reads=options['reads'],
+                        seed=options['seed'],
+                    )
+                    result = bench.run(threshold)
+                    self.stdout.write(' | '.join(
+                        '{:.2f}'.format(result[c]) if isinstance(result[c], float) else str(result[c])
+                        for c in columns
+                    ))
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
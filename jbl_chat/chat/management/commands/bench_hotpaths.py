@@ -0,0 +1,197 @@
+import json
+import statistics
+import sys
+from time import perf_counter
+from typing import Callable, Dict, List
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from chat.management.commands.bench_fanout import Rollback
+from chat.management.commands.seed_chat import SeedManager
+from chat.models import ChatRoom, Membership, Message
+from chat.serializers import BaseMessageSerializer, ChatRoomSerializer, MemberSerializer, MessageSerializer
+from jbl_chat.middleware import count_queries
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+class HotPathBenchmark:
+    """Times the serializer and model hot paths on a data set seeded inside
+       a transaction, rolled back at the end.
+       Every benchmark is a 'bench_<name>' method returning a setup
+       function (not timed) and the function to time, called 'repeat' times
+    """
+
+    def __init__(self, n_users: int, n_rooms: int, n_messages: int, repeat: int, seed: int):
+        self.n_users = n_users
+        self.n_rooms = n_rooms
+        self.n_messages = n_messages
+        self.repeat = repeat
+        self.seed = seed
+
+    @classmethod
+    def get_names(cls) -> List[str]:
+        return [name[len('bench_'):] for name in dir(cls) if name.startswith('bench_')]
+
+    def build(self):
+        SeedManager(
+            self.n_users, self.n_rooms, self.n_messages,
+            seed=self.seed, prefix='bench_hotpaths'
+        ).run()
+        self.users = list(User.objects.filter(username__startswith='bench_hotpaths_').order_by('id'))
+        # the room with most members and the one with most messages
+        self.biggest_room = ChatRoom.objects.annotate(
+            members=Count('membership')
+        ).order_by('-members', 'id').first()
+        self.busiest_room = ChatRoom.objects.annotate(
+            msgs=Count('message')
+        ).order_by('-msgs', 'id').first()
+
+    def measure(self, setup: Callable, func: Callable) -> dict:
+        timings = []
+        queries = []
+        for i in range(self.repeat):
+            args = setup(i)
+            with count_queries() as counter:
+                start = perf_counter()
+                func(*args)
+                timings.append((perf_counter() - start) * 1000)
+            queries.append(counter[0])
+        return {
+            'median_ms': statistics.median(timings),
+            'min_ms': min(timings),
+            'queries': max(queries),
+        }
+
+    def _messages(self, i):
+        return (list(Message.objects.filter(room=self.busiest_room).order_by('-id')[:1000]),)
+
+    def bench_room_members(self):
+        return lambda i: (self.biggest_room,), \
+            lambda room: ChatRoomSerializer().get_room_members(room)
+
+    def bench_message_list(self):
+        return self._messages, \
+            lambda msgs: MessageSerializer(msgs, many=True).data
+
+    def bench_base_message_list(self):
+        return self._messages, \
+            lambda msgs: BaseMessageSerializer(msgs, many=True).data
+
+    def bench_member_chat_rooms(self):
+        return lambda i: (list(User.objects.filter(pk__in=[u.pk for u in self.users[:100]])),), \
+            lambda users: MemberSerializer(users, many=True).data
+
+    def bench_direct_chat(self):
+        # existing direct chats, the path of every direct message
+        users = {u.id: u for u in self.users}
+        members = {}
+        for room_id, user_id in Membership.objects.filter(
+            chatroom__is_direct=True,
+            user_id__in=users
+        ).order_by('chatroom_id', 'user_id').values_list('chatroom_id', 'user_id'):
+            members.setdefault(room_id, []).append(user_id)
+        pairs = [(users[a], users[b]) for a, b in members.values()]
+
+        return lambda i: pairs[i % len(pairs)], \
+            lambda sender, receiver: ChatRoom().get_or_create_direct_chat(sender, receiver)
+
+    def bench_membership_save(self):
+        # a join of a user not in the room
+        rooms = list(ChatRoom.objects.filter(is_direct=False).annotate(
+            members=Count('membership')
+        ).filter(members__lt=len(self.users)).order_by('id'))
+
+        def setup(i):
+            room = rooms[i % len(rooms)]
+            member_ids = set(Membership.objects.filter(chatroom=room).values_list('user_id', flat=True))
+            user = next(u for u in self.users if u.id not in member_ids)
+            return Membership(user=user, chatroom=room),
+        return setup, lambda membership: membership.save()
+
+    def run(self, names: List[str]) -> Dict[str, dict]:
+        results = {}
+        try:
+            with transaction.atomic():
+                self.build()
+                for name in names:
+                    # every benchmark starts from the seeded data
+                    sid = transaction.savepoint()
+                    results[name] = self.measure(*getattr(self, 'bench_{}'.format(name))())
+                    transaction.savepoint_rollback(sid)
+                raise Rollback()
+        except Rollback:
+            pass
+        return results
+
+
+def find_regressions(baseline: Dict[str, dict], results: Dict[str, dict], threshold: float) -> List[str]:
+    """Benchmarks slower than the baseline by more than 'threshold'
+       (a fraction) or running more queries
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['median_ms'] > base['median_ms'] * (1 + threshold):
+            regressions.append('{}: {:.2f}ms -> {:.2f}ms'.format(name, base['median_ms'], result['median_ms']))
+        if result['queries'] > base['queries']:
+            regressions.append('{}: {} -> {} queries'.format(name, base['queries'], result['queries']))
+    return regressions
+
+
+class Command(BaseCommand):
+    help = "Times the serializers and models hot paths on seeded data and fails on regressions against a baseline"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument(
+            '--bench', nargs='+', choices=HotPathBenchmark.get_names(),
+            default=HotPathBenchmark.get_names()
+        )
+        parser.add_argument('--output', help="json file with the results, to be used as baseline")
+        parser.add_argument('--baseline', help="json file of a previous run")
+        parser.add_argument('--threshold', type=float, default=0.25,
+                            help="max slowdown against the baseline (0.25 = 25%%)")
+
+    def handle(self, *args, **options):
+        try:
+            bench = HotPathBenchmark(
+                n_users=options['users'],
+                n_rooms=options['rooms'],
+                n_messages=options['messages'],
+                repeat=options['repeat'],
+                seed=options['seed'],
+            )
+            results = bench.run(options['bench'])
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
+
+        self.stdout.write('benchmark | median_ms | min_ms | queries')
+        for name, result in results.items():
+            self.stdout.write('{} | {:.2f} | {:.2f} | {}'.format(
+                name, result['median_ms'], result['min_ms'], result['queries']
+            ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                regressions = find_regressions(json.load(f), results, options['threshold'])
+            if regressions:
+                raise CommandError('regressions against {}:\n{}'.format(
+                    options['baseline'], '\n'.join(regressions)
+                ))
@@ -0,0 +1,132 @@
+import io
+import json
+import statistics
+import sys
+from time import perf_counter
+from typing import Callable, Dict
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from authentication.serializers import UserListSerializer
+from chat.management.commands.bench_fanout import Rollback
+from chat.management.commands.seed_chat import SeedManager
+from chat.models import ChatRoom, Message
+from chat.serializers import ChatRoomSerializer, MessageSerializer
+from jbl_chat.renderers import FastJSONParser, FastJSONRenderer, MessagePackParser, MessagePackRenderer
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+# name: (renderer, parser)
+FORMATS = {
+    'json': (JSONRenderer(), JSONParser()),
+    'fast_json': (FastJSONRenderer(), FastJSONParser()),
+    'msgpack': (MessagePackRenderer(), MessagePackParser()),
+}
+
+
+class RendererBenchmark:
+    """Encodes and decodes the api payloads (already serialized, on data
+       seeded inside a transaction, rolled back at the end) in every format
+    """
+
+    def __init__(self, n_users: int, n_rooms: int, n_messages: int, repeat: int, seed: int):
+        self.n_users = n_users
+        self.n_rooms = n_rooms
+        self.n_messages = n_messages
+        self.repeat = repeat
+        self.seed = seed
+
+    def build_payloads(self) -> Dict[str, object]:
+        SeedManager(
+            self.n_users, self.n_rooms, self.n_messages,
+            seed=self.seed, prefix='bench_renderers'
+        ).run()
+        busiest_room = ChatRoom.objects.annotate(msgs=Count('message')).order_by('-msgs', 'id').first()
+        member = User.objects.filter(membership__chatroom=busiest_room).order_by('id').first()
+        return {
+            # chat__get_room_messages
+            'message_list': MessageSerializer(
+                Message.objects.filter(room=busiest_room).order_by('-id')[:1000], many=True
+            ).data,
+            # chat__get_create_chat
+            'chat_rooms': ChatRoomSerializer(
+                ChatRoom.objects.filter(membership__user=member).distinct(), many=True
+            ).data,
+            # authentication__list
+            'users': UserListSerializer(
+                User.objects.select_related('profile').order_by('id')[:100], many=True
+            ).data,
+        }
+
+    def time(self, func: Callable) -> float:
+        timings = []
+        for _ in range(self.repeat):
+            start = perf_counter()
+            func()
+            timings.append((perf_counter() - start) * 1000)
+        return statistics.median(timings)
+
+    def run(self) -> Dict[str, Dict[str, dict]]:
+        try:
+            with transaction.atomic():
+                payloads = self.build_payloads()
+                raise Rollback()
+        except Rollback:
+            pass
+
+        results = {}
+        for payload_name, data in payloads.items():
+            results[payload_name] = {}
+            for format_name, (renderer, parser) in FORMATS.items():
+                encoded = renderer.render(data)
+                results[payload_name][format_name] = {
+                    'bytes': len(encoded),
+                    'encode_ms': self.time(lambda: renderer.render(data)),
+                    'decode_ms': self.time(lambda: parser.parse(io.BytesIO(encoded))),
+                }
+        return results
+
+
+class Command(BaseCommand):
+    help = "Compares size, encode and decode time of the api payloads in json, fast json and msgpack"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rooms', type=int, default=100)
+        parser.add_argument('--messages', type=int, default=5000)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help="json file with the results")
+
+    def handle(self, *args, **options):
+        try:
+            bench = RendererBenchmark(
+                n_users=options['users'],
+                n_rooms=options['rooms'],
+                n_messages=options['messages'],
+                repeat=options['repeat'],
+                seed=options['seed'],
+            )
+            results = bench.run()
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
+
+        self.stdout.write('payload | format | bytes | encode_ms | decode_ms')
+        for payload_name, formats in results.items():
+            for format_name, result in formats.items():
+                self.stdout.write('{} | {} | {} | {:.3f} | {:.3f}'.format(
+                    payload_name, format_name, result['bytes'], result['encode_ms'], result['decode_ms']
+                ))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
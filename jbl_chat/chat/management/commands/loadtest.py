@@ -0,0 +1,326 @@
+import http.client
+import json
+import random
+import subprocess
+import sys
+import threading
+from collections import defaultdict
+from datetime import datetime
+from time import perf_counter
+from typing import Dict, List, Optional
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from chat.models import Membership
+from chat.sharding import scatter
+from jbl_chat.middleware import QUERY_COUNT_HEADER
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+# default share of every operation in the workload
+WORKLOAD_MIX = {
+    'send_direct': 10,
+    'send_group': 15,
+    'read_room': 25,
+    'poll_unseen': 30,
+    'list_rooms': 10,
+    'user_list': 10,
+}
+
+
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))]
+
+
+def get_git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Workload:
+    """Builds the requests of a mixed workload from the users (and their
+       chat rooms) already in the db, e.g. created by 'seed_chat'
+    """
+
+    def __init__(self, user_ids: List[int], rooms_by_user: Dict[int, List[int]], mix: Dict[str, int]):
+        self.user_ids = user_ids
+        self.rooms_by_user = rooms_by_user
+        self.operations = list(mix)
+        self.weights = [mix[op] for op in self.operations]
+
+    @classmethod
+    def from_db(cls, prefix: str, sample: int, mix: Dict[str, int], seed: int):
+        user_ids = list(User.objects.filter(
+            username__startswith=prefix
+        ).order_by('id').values_list('id', flat=True))
+        user_ids = random.Random(seed).sample(user_ids, min(sample, len(user_ids)))
+
+        rooms_by_user = defaultdict(list)
+        for rows in scatter(lambda db: list(Membership.objects.using(db).filter(
+            user_id__in=user_ids,
+            date_lefted__isnull=True
+        ).values_list('user_id', 'chatroom_id'))):
+            for user_id, room_id in rows:
+                rooms_by_user[user_id].append(room_id)
+        return cls(user_ids, dict(rooms_by_user), mix)
+
+    def next_request(self, rnd: random.Random):
+        """Returns (operation, method, path, body) of a random request"""
+        op = rnd.choices(self.operations, weights=self.weights)[0]
+        user_id = rnd.choice(self.user_ids)
+        rooms = self.rooms_by_user.get(user_id)
+        if op in ('send_group', 'read_room') and not rooms:
+            op = 'poll_unseen'
+
+        if op == 'send_direct':
+            receiver_id = rnd.choice(self.user_ids)
+            if receiver_id == user_id:
+                return self.next_request(rnd)
+            return op, 'POST', reverse('chat__message_user_create', args=(receiver_id,)), \
+                {'from': user_id, 'text': 'load test'}
+        if op == 'send_group':
+            return op, 'POST', reverse('chat__message_group_create', args=(rnd.choice(rooms),)), \
+                {'from': user_id, 'text': 'load test'}
+        if op == 'read_room':
+            path = reverse('chat__get_room_messages', args=(rnd.choice(rooms),))
+        elif op == 'poll_unseen':
+            path = reverse('chat__get_unseen_messages')
+        elif op == 'list_rooms':
+            path = reverse('chat__get_create_chat')
+        else:
+            return op, 'GET', reverse('authentication__list'), None
+        return op, 'GET', '{}?{}'.format(path, urlencode({'user_id': user_id})), None
+
+
+class LoadTest:
+    """Closed loop load generator: every worker thread sends the next
+       request as soon as the previous response is received
+    """
+
+    def __init__(self, base_url: str, workload: Workload, concurrency: int,
+                 duration: float, max_requests: Optional[int], seed: int):
+        url = urlsplit(base_url)
+        self.host, self.port = url.hostname, url.port or 80
+        self.workload = workload
+        self.concurrency = concurrency
+        self.duration = duration
+        self.max_requests = max_requests
+        self.seed = seed
+        self.samples = []       # (operation, status, latency in seconds, db queries)
+        self._lock = threading.Lock()
+        self._sent = 0
+
+    def _next_slot(self) -> bool:
+        with self._lock:
+            if self.max_requests is not None and self._sent >= self.max_requests:
+                return False
+            self._sent += 1
+            return True
+
+    def _worker(self, index: int, deadline: float):
+        rnd = random.Random(self.seed + index)
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        samples = []
+        while perf_counter() < deadline and self._next_slot():
+            op, method, path, body = self.workload.next_request(rnd)
+            headers = {}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+            start = perf_counter()
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+                queries = response.getheader(QUERY_COUNT_HEADER)
+            except (OSError, http.client.HTTPException) as ex:
+                logger.warning('%s %s failed: %s', method, path, ex)
+                conn.close()
+                status, queries = None, None
+            samples.append((op, status, perf_counter() - start, int(queries) if queries else None))
+        conn.close()
+        with self._lock:
+            self.samples += samples
+
+    def run(self) -> dict:
+        start = perf_counter()
+        deadline = start + self.duration
+        workers = [
+            threading.Thread(target=self._worker, args=(i, deadline), daemon=True)
+            for i in range(self.concurrency)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return self.report(perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        by_op = defaultdict(list)
+        for sample in self.samples:
+            by_op[sample[0]].append(sample)
+
+        endpoints = {}
+        for op, samples in sorted(by_op.items()):
+            latencies = sorted(latency * 1000 for _, _, latency, _ in samples)
+            queries = [q for _, _, _, q in samples if q is not None]
+            endpoints[op] = {
+                'requests': len(samples),
+                'errors': sum(1 for _, status, _, _ in samples if status is None or status >= 400),
+                'rps': len(samples) / elapsed,
+                'p50_ms': percentile(latencies, 0.50),
+                'p95_ms': percentile(latencies, 0.95),
+                'p99_ms': percentile(latencies, 0.99),
+                'mean_ms': sum(latencies) / len(latencies),
+                'queries_mean': sum(queries) / len(queries) if queries else None,
+                'queries_max': max(queries) if queries else None,
+            }
+
+        latencies = sorted(latency * 1000 for _, _, latency, _ in self.samples)
+        return {
+            'commit': get_git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'duration_s': elapsed,
+            'concurrency': self.concurrency,
+            'total': {
+                'requests': len(self.samples),
+                'errors': sum(ep['errors'] for ep in endpoints.values()),
+                'rps': len(self.samples) / elapsed if elapsed else 0,
+                'p50_ms': percentile(latencies, 0.50),
+                'p95_ms': percentile(latencies, 0.95),
+                'p99_ms': percentile(latencies, 0.99),
+            },
+            'endpoints': endpoints,
+        }
+
+
+class Command(BaseCommand):
+    help = "Drives a mixed workload against the chat api and reports latency percentiles, throughput and db queries by endpoint"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help="base url of a running server, by default an in-process server is started")
+        parser.add_argument('--celery', choices=('eager', 'worker'), default='eager',
+                            help="in-process server: run the tasks in the request (eager) or send them to the workers")
+        parser.add_argument('--throttle', action='store_true', help="in-process server: keep the rate limits")
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=30, help="seconds")
+        parser.add_argument('--requests', type=int, help="stop after this number of requests")
+        parser.add_argument('--prefix', default='seed', help="username prefix of the users driving the workload")
+        parser.add_argument('--sample', type=int, default=500, help="max number of users driving the workload")
+        parser.add_argument('--mix', nargs='+', metavar='OPERATION=WEIGHT', default=[],
+                            help="weights of the operations {}".format(list(WORKLOAD_MIX)))
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--output', help="json file with the results")
+        parser.add_argument('--compare', help="json file of a previous run to compare with")
+
+    def parse_mix(self, values: List[str]) -> Dict[str, int]:
+        mix = dict(WORKLOAD_MIX)
+        for value in values:
+            op, _, weight = value.partition('=')
+            if op not in mix or not weight.isdigit():
+                raise CommandError("invalid --mix '{}', operations: {}".format(value, list(WORKLOAD_MIX)))
+            mix[op] = int(weight)
+        return mix
+
+    def handle(self, *args, **options):
+        workload = Workload.from_db(
+            options['prefix'], options['sample'], self.parse_mix(options['mix']), options['seed']
+        )
+        if len(workload.user_ids) < 2:
+            raise CommandError("no users with prefix '{}', run 'seed_chat' first".format(options['prefix']))
+
+        try:
+            if options['url']:
+                results = self.run(options['url'], workload, options)
+            else:
+                results = self.run_in_process(workload, options)
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
+
+        self.print_results(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.print_comparison(json.load(f), results)
+
+    def run(self, base_url: str, workload: Workload, options) -> dict:
+        return LoadTest(
+            base_url, workload,
+            concurrency=options['concurrency'],
+            duration=options['duration'],
+            max_requests=options['requests'],
+            seed=options['seed'],
+        ).run()
+
+    def run_in_process(self, workload: Workload, options) -> dict:
+        overrides = {'CHAT_QUERY_COUNT_HEADER': True, 'ALLOWED_HOSTS': ['*']}
+        if options['celery'] == 'eager':
+            # the views apply the tasks synchronously (see prefetch_celery_behaviour)
+            overrides['TESTING'] = True
+        if not options['throttle']:
+            overrides['REST_FRAMEWORK'] = dict(settings.REST_FRAMEWORK, DEFAULT_THROTTLE_RATES={})
+
+        with override_settings(**overrides):
+            server = ThreadedWSGIServer(('127.0.0.1', 0), QuietRequestHandler)
+            # django is already set up, get_wsgi_application() would configure the logging again
+            server.set_app(WSGIHandler())
+            thread = threading.Thread(target=server.serve_forever, daemon=True)
+            thread.start()
+            try:
+                return self.run('http://127.0.0.1:{}'.format(server.server_port), workload, options)
+            finally:
+                server.shutdown()
+                server.server_close()
+
+    def print_results(self, results: dict):
+        columns = ('requests', 'errors', 'rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_mean', 'queries_max')
+        self.stdout.write(' | '.join(('endpoint',) + columns))
+        rows = list(results['endpoints'].items()) + [('TOTAL', results['total'])]
+        for name, row in rows:
+            self.stdout.write(' | '.join([name] + [
+                '{:.2f}'.format(row.get(c)) if isinstance(row.get(c), float) else str(row.get(c, ''))
+                for c in columns
+            ]))
+
+    def print_comparison(self, baseline: dict, results: dict):
+        self.stdout.write('\ncompared with {} ({})'.format(baseline.get('commit'), baseline.get('date')))
+        self.stdout.write('endpoint | p95_ms | rps | queries_mean')
+        for name, row in results['endpoints'].items():
+            base = baseline['endpoints'].get(name)
+            if not base:
+                continue
+            self.stdout.write(' | '.join([name] + [
+                '{} -> {}{}'.format(
+                    '{:.2f}'.format(base[c]) if base.get(c) is not None else None,
+                    '{:.2f}'.format(row[c]) if row.get(c) is not None else None,
+                    ' ({:+.0%})'.format(row[c] / base[c] - 1) if base.get(c) and row.get(c) is not None else ''
+                )
+                for c in ('p95_ms', 'rps', 'queries_mean')
+            ]))
@@ -0,0 +1,105 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Count
+
+from chat.models import ChatRoom, RoomShard
+from chat.sharding import forget_room_shard, get_shards, move_room, shard_for_room
+from chat.utils import reset_sequences
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RebalanceManager:
+
+    @staticmethod
+    def register_rooms() -> int:
+        """Adds to the shard map the rooms created before sharding was enabled"""
+        registered = 0
+        mapped_ids = set(RoomShard.objects.using(DEFAULT_DB_ALIAS).values_list('id', flat=True))
+        for alias in get_shards():
+            new_entries = [
+                RoomShard(pk=cr.id, internal_identifier=cr.internal_identifier, shard=alias)
+                for cr in ChatRoom.objects.using(alias).exclude(id__in=mapped_ids)
+            ]
+            RoomShard.objects.using(DEFAULT_DB_ALIAS).bulk_create(new_entries, batch_size=1000)
+            for entry in new_entries:
+                forget_room_shard(entry.pk)
+            registered += len(new_entries)
+
+        # explicit ids were inserted, the ids sequence has to be moved forward
+        reset_sequences(DEFAULT_DB_ALIAS, RoomShard)
+        return registered
+
+    @staticmethod
+    def plan(limit: int):
+        """Moves rooms from the most to the least loaded shard until the
+           rooms count differs at most by one
+
+        Yields:
+            Tuple[int, str, str]: room id, source shard, target shard
+        """
+        counts = {alias: 0 for alias in get_shards()}
+        counts.update({
+            row['shard']: row['rooms']
+            for row in RoomShard.objects.using(DEFAULT_DB_ALIAS).values('shard').annotate(rooms=Count('id'))
+            if row['shard'] in counts
+        })
+
+        moved = set()
+        for _ in range(limit):
+            source = max(counts, key=counts.get)
+            target = min(counts, key=counts.get)
+            if counts[source] - counts[target] <= 1:
+                return
+            room_id = RoomShard.objects.using(DEFAULT_DB_ALIAS).filter(
+                shard=source
+            ).exclude(id__in=moved).order_by('-id').values_list('id', flat=True).first()
+            if room_id is None:
+                return
+            moved.add(room_id)
+            counts[source] -= 1
+            counts[target] += 1
+            yield room_id, source, target
+
+
+class Command(BaseCommand):
+    help = "Registers existing chat rooms in the shard map and moves rooms across the CHAT_SHARDS"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--register', action='store_true', help="map the rooms created before sharding was enabled")
+        parser.add_argument('--room', type=int, help="id of a room to move")
+        parser.add_argument('--to', help="target shard of --room")
+        parser.add_argument('--limit', type=int, default=100, help="max number of rooms to move")
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if not get_shards():
+            raise CommandError("CHAT_SHARDS is not set")
+
+        try:
+            if options['register']:
+                registered = RebalanceManager.register_rooms()
+                self.stdout.write("registered {} rooms".format(registered))
+                return
+
+            if options['room']:
+                if options['to'] not in get_shards():
+                    raise CommandError("--to must be one of {}".format(get_shards()))
+                moves = [(options['room'], shard_for_room(options['room']), options['to'])]
+            else:
+                moves = RebalanceManager.plan(options['limit'])
+
+            for room_id, source, target in moves:
+                self.stdout.write("room {}: {} -> {}".format(room_id, source, target))
+                if not options['dry_run']:
+                    move_room(room_id, target)
+
+        except CommandError:
+            raise
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
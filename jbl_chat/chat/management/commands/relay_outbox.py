@@ -0,0 +1,37 @@
+import sys
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.outbox import EVENTS_STREAM, relay_all_outboxes
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Publishes the outbox events of all the shards to the chat events redis stream"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="drain the outboxes and exit")
+        parser.add_argument('--interval', type=float, default=0.5, help="seconds between the polls of empty outboxes")
+
+    def handle(self, *args, **options):
+        self.stdout.write("relaying the outbox events to '{}'".format(EVENTS_STREAM))
+        try:
+            while True:
+                published = relay_all_outboxes()
+                if options['once']:
+                    self.stdout.write("published {} events".format(published))
+                    return
+                # a long running process, connections are recycled like in a request
+                close_old_connections()
+                if not published:
+                    sleep(options['interval'])
+        except KeyboardInterrupt:
+            return
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
@@ -0,0 +1,298 @@
+import random
+import sys
+from collections import Counter
+from datetime import timedelta
+from itertools import accumulate
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from authentication.management.commands.mock_users import MockManager
+from chat.inbox import get_fanout_threshold
+from chat.management.commands.bench_fanout import ROOM_SIZE_DISTRIBUTIONS
+from chat.models import ChatRoom, InboxEntry, Membership, Message, RoomShard, SeenMessage
+from chat.sharding import pick_shard, sharding_enabled
+from chat.utils import keep_timestamps, reset_sequences
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+WORDS = (
+    'hi', 'hello', 'ok', 'yes', 'no', 'maybe', 'today', 'tomorrow', 'lunch', 'meeting',
+    'call', 'me', 'you', 'later', 'thanks', 'see', 'soon', 'where', 'are', 'we', 'lol', 'great',
+)
+
+
+class SeedManager:
+    """Generates a synthetic chat data set with bulk inserts, deterministic by seed:
+       - room sizes drawn from a bench_fanout distribution, plus direct chats
+       - messages spread with a Zipf-like activity, few rooms and few
+         members of each room write most of the messages
+       - a read cursor per member and room, messages before it are seen,
+         the ones after it are unseen (and in the inbox of small rooms).
+         A member has read the room up to its last message, its cursor
+         is the read_seq of its membership
+    """
+
+    def __init__(
+        self, n_users: int, n_rooms: int, n_messages: int, seed: int = 42,
+        distribution: str = 'mixed', direct_ratio: float = 0.3, seen_ratio: float = 0.8,
+        skew: float = 1.0, days: int = 30, prefix: str = 'seed',
+        password: str = 'Passw0rd!', batch_size: int = 5000
+    ):
+        self.n_users = n_users
+        self.n_rooms = n_rooms
+        self.n_messages = n_messages
+        self.distribution = distribution
+        self.direct_ratio = direct_ratio
+        self.seen_ratio = seen_ratio
+        self.skew = skew
+        self.days = days
+        self.prefix = prefix
+        self.password = password
+        self.batch_size = batch_size
+        self.rnd = random.Random(seed)
+        self.stats = Counter()
+
+    @staticmethod
+    def _next_id(model, db: str) -> int:
+        return (model.objects.using(db).aggregate(Max('id'))['id__max'] or 0) + 1
+
+    def create_users(self):
+        self.usernames = ['{}_{}'.format(self.prefix, i + 1) for i in range(self.n_users)]
+        self.user_ids = MockManager.bulk_create_users(
+            self.usernames, self.password, batch_size=self.batch_size
+        )
+        self.stats['users'] = len(self.user_ids)
+
+    def _direct_room(self, pairs: set):
+        """Direct chat between two random users, None if they already have one"""
+        a, b = sorted(self.rnd.sample(range(self.n_users), 2))
+        if (a, b) in pairs:
+            return None
+        pairs.add((a, b))
+        sender = User(id=self.user_ids[a], username=self.usernames[a])
+        receiver = User(id=self.user_ids[b], username=self.usernames[b])
+        cr = ChatRoom(
+            room_name=ChatRoom().get_direct_chat_name(sender, receiver),
+            is_direct=True
+        )
+        cr.internal_identifier = cr.encode_msg(cr.get_direct_base_internal_id(sender, receiver))
+        return cr, [sender.id, receiver.id]
+
+    def _group_room(self, i: int):
+        cr = ChatRoom(room_name='{}_room_{}'.format(self.prefix, i + 1), is_direct=False)
+        cr.internal_identifier = cr.encode_msg(cr.room_name)
+        size = min(ROOM_SIZE_DISTRIBUTIONS[self.distribution](self.rnd, self.n_users), self.n_users)
+        # the members order is their talkativeness rank
+        return cr, self.rnd.sample(self.user_ids, size)
+
+    def create_rooms(self, started_at):
+        """Rooms and memberships, on the room shard if sharding is enabled"""
+        first_id = self._next_id(RoomShard if sharding_enabled() else ChatRoom, DEFAULT_DB_ALIAS)
+
+        self.rooms = []        # ChatRoom instances
+        self.members = []      # member ids by room index
+        self.dbs = []          # db alias by room index
+        pairs = set()
+        for i in range(self.n_rooms):
+            room = None
+            if self.rnd.random() < self.direct_ratio:
+                room = self._direct_room(pairs)
+            cr, member_ids = room or self._group_room(i)
+            cr.id = first_id + i
+            self.rooms.append(cr)
+            self.members.append(member_ids)
+            self.dbs.append(pick_shard(cr.internal_identifier) if sharding_enabled() else DEFAULT_DB_ALIAS)
+
+        if sharding_enabled():
+            RoomShard.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+                RoomShard(id=cr.id, internal_identifier=cr.internal_identifier, shard=db)
+                for cr, db in zip(self.rooms, self.dbs)
+            ], batch_size=self.batch_size)
+            reset_sequences(DEFAULT_DB_ALIAS, RoomShard)
+
+        for db in set(self.dbs):
+            ChatRoom.objects.using(db).bulk_create([
+                cr for cr, cr_db in zip(self.rooms, self.dbs) if cr_db == db
+            ], batch_size=self.batch_size)
+            reset_sequences(db, ChatRoom)
+
+        self.stats['rooms'] = len(self.rooms)
+        self.stats['memberships'] = sum(len(member_ids) for member_ids in self.members)
+
+    def create_memberships(self, started_at):
+        """Memberships, read up to the member cursor (see create_messages)"""
+        for db in set(self.dbs):
+            Membership.objects.using(db).bulk_create([
+                Membership(user_id=user_id, chatroom_id=cr.id, date_joined=started_at, read_seq=room_cursors[user_id])
+                for cr, member_ids, room_cursors, cr_db in zip(self.rooms, self.members, self.cursors, self.dbs)
+                if cr_db == db
+                for user_id in member_ids
+            ], batch_size=self.batch_size)
+
+    # columns of the rows generated for each model, the messages data set is
+    # inserted with plain 'executemany', building millions of model
+    # instances and compiling their INSERTs would dominate the seeding time
+    ROW_FIELDS = {
+        Message: ('id', 'room', 'seq', 'msg_from', 'text', 'sent_at', 'fanned_out'),
+        SeenMessage: ('message', 'seen_by', 'seen_at'),
+        InboxEntry: ('user', 'room', 'message'),
+    }
+
+    def _flush(self, db: str, buffer: dict):
+        conn = connections[db]
+        with transaction.atomic(using=db), conn.cursor() as cursor:
+            for model, fields in self.ROW_FIELDS.items():
+                rows = buffer[model]
+                if not rows:
+                    continue
+                columns = [conn.ops.quote_name(model._meta.get_field(name).column) for name in fields]
+                cursor.executemany('INSERT INTO {} ({}) VALUES ({})'.format(
+                    conn.ops.quote_name(model._meta.db_table),
+                    ', '.join(columns),
+                    ', '.join(['%s'] * len(columns))
+                ), rows)
+                self.stats[model._meta.model_name] += len(rows)
+                rows.clear()
+
+    def create_messages(self, started_at):
+        """Messages with their seen and inbox rows, flushed by db every 'batch_size' rows"""
+        weights = [1 / (rank + 1) ** self.skew for rank in range(len(self.rooms))]
+        self.rnd.shuffle(weights)
+        msg_rooms = self.rnd.choices(
+            range(len(self.rooms)), cum_weights=list(accumulate(weights)), k=self.n_messages
+        )
+        senders = [
+            self.members[r][int(len(self.members[r]) * self.rnd.random() ** 3)]
+            for r in msg_rooms
+        ]
+
+        # read cursor of every member: fully read or stopped at a random
+        # message, at least after its own last message
+        msgs_per_room = Counter(msg_rooms)
+        self.cursors = cursors = [
+            {
+                user_id: count if self.rnd.random() < self.seen_ratio else self.rnd.randint(0, count)
+                for user_id in member_ids
+            }
+            for member_ids, count in zip(self.members, (msgs_per_room[r] for r in range(len(self.rooms))))
+        ]
+        positions = [0] * len(self.rooms)
+        for r, sender_id in zip(msg_rooms, senders):
+            positions[r] += 1
+            cursors[r][sender_id] = max(cursors[r][sender_id], positions[r])
+
+        threshold = get_fanout_threshold()
+        next_ids = {db: self._next_id(Message, db) for db in set(self.dbs)}
+        buffers = {db: {Message: [], SeenMessage: [], InboxEntry: []} for db in next_ids}
+        positions = [0] * len(self.rooms)
+        conn_ops = {db: connections[db].ops for db in next_ids}
+        step = timedelta(days=self.days) / max(self.n_messages, 1)
+
+        for i, r in enumerate(msg_rooms):
+            cr, member_ids, db = self.rooms[r], self.members[r], self.dbs[r]
+            position = positions[r]
+            positions[r] += 1
+
+            msg_id = next_ids[db]
+            next_ids[db] += 1
+            sent_at = conn_ops[db].adapt_datetimefield_value(started_at + step * i)
+            sender_id = senders[i]
+            fanned_out = len(member_ids) < threshold
+
+            buffer = buffers[db]
+            buffer[Message].append((
+                msg_id, cr.id, position + 1, sender_id,
+                ' '.join(self.rnd.choices(WORDS, k=self.rnd.randint(1, 12))),
+                sent_at, fanned_out
+            ))
+            room_cursors = cursors[r]
+            for user_id in member_ids:
+                if user_id == sender_id:
+                    continue
+                if position < room_cursors[user_id]:
+                    buffer[SeenMessage].append((msg_id, user_id, sent_at))
+                elif fanned_out:
+                    buffer[InboxEntry].append((user_id, cr.id, msg_id))
+
+            if len(buffer[SeenMessage]) + len(buffer[InboxEntry]) + len(buffer[Message]) >= self.batch_size:
+                self._flush(db, buffer)
+
+        for db, buffer in buffers.items():
+            self._flush(db, buffer)
+            reset_sequences(db, Message)
+
+        # the rooms seq continues after their seeded messages
+        for cr, count in zip(self.rooms, positions):
+            cr.last_seq = count
+        for db in next_ids:
+            ChatRoom.objects.using(db).bulk_update(
+                [cr for cr, cr_db in zip(self.rooms, self.dbs) if cr_db == db],
+                ['last_seq'], batch_size=self.batch_size
+            )
+
+    def run(self) -> Counter:
+        started_at = timezone.now() - timedelta(days=self.days)
+        with keep_timestamps(Membership):
+            self.create_users()
+            self.create_rooms(started_at)
+            self.create_messages(started_at)
+            self.create_memberships(started_at)
+        return self.stats
+
+
+class Command(BaseCommand):
+    help = "Seeds a synthetic data set of users, chat rooms, messages and seen state with bulk inserts"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--rooms', type=int, default=200)
+        parser.add_argument('--messages', type=int, default=10000)
+        parser.add_argument('--distribution', choices=list(ROOM_SIZE_DISTRIBUTIONS), default='mixed')
+        parser.add_argument('--direct-ratio', type=float, default=0.3, help="share of direct chats")
+        parser.add_argument('--seen-ratio', type=float, default=0.8, help="share of members that read all their messages")
+        parser.add_argument('--skew', type=float, default=1.0, help="Zipf exponent of the rooms activity")
+        parser.add_argument('--days', type=int, default=30, help="messages are spread over the last days")
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--prefix', default='seed', help="prefix of the usernames and room names")
+        parser.add_argument('--password', default='Passw0rd!')
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError("at least 2 users are needed")
+        if User.objects.filter(username__startswith='{}_'.format(options['prefix'])).exists():
+            raise CommandError("users with prefix '{}' already exist, use another --prefix".format(options['prefix']))
+
+        try:
+            seeder = SeedManager(
+                n_users=options['users'],
+                n_rooms=options['rooms'],
+                n_messages=options['messages'],
+                seed=options['seed'],
+                distribution=options['distribution'],
+                direct_ratio=options['direct_ratio'],
+                seen_ratio=options['seen_ratio'],
+                skew=options['skew'],
+                days=options['days'],
+                prefix=options['prefix'],
+                password=options['password'],
+                batch_size=options['batch_size'],
+            )
+            start = perf_counter()
+            stats = seeder.run()
+            elapsed = perf_counter() - start
+        except Exception as ex:
+            logger.exception(ex)
+            sys.exit(1)
+
+        for name, count in stats.items():
+            self.stdout.write('{}: {}'.format(name, count))
+        self.stdout.write('seeded in {:.2f}s'.format(elapsed))
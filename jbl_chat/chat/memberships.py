@@ -0,0 +1,135 @@
+from typing import Dict, Iterable, List, Tuple, Union
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from chat.cleanup import schedule_room_deletion
+from chat.changes import record_changes
+from chat.inbox import backfill_inbox
+from chat.models import ChangeLog, ChatRoom, Membership, OutboxEvent
+from chat.outbox import add_membership_events
+from chat.sharding import room_db
+from jbl_chat.routers import pin_users_to_primary
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+# per user outcomes of the bulk join / leave
+JOINED = 'joined'
+LEFT = 'left'
+ALREADY_MEMBER = 'already_member'
+NOT_MEMBER = 'not_member'
+NOT_FOUND = 'not_found'
+
+
+def get_bulk_members_max() -> int:
+    """Max users (ids + usernames) of a bulk join / leave request"""
+    return getattr(settings, 'CHAT_BULK_MEMBERS_MAX', 5000)
+
+
+def resolve_users(user_ids: Iterable = (), usernames: Iterable = ()) -> Tuple[List[User], List[Union[int, str]]]:
+    """Looks up the users by id and username in one query
+
+    Returns:
+        Tuple[List[User], List[Union[int, str]]]: the users found (ordered
+        by id, without duplicates) and the ids / usernames not found
+    """
+    user_ids, usernames = list(user_ids), list(usernames)
+    if any(not str(user_id).isdigit() for user_id in user_ids):
+        raise ValidationError("user ids must be numbers")
+    user_ids = [int(user_id) for user_id in user_ids]
+    if len(user_ids) + len(usernames) > get_bulk_members_max():
+        raise ValidationError("At most {} users per request".format(get_bulk_members_max()))
+
+    users = list(User.objects.filter(
+        Q(pk__in=user_ids) | Q(username__in=usernames)
+    ).order_by('id')) if user_ids or usernames else []
+
+    found_ids = {user.id for user in users}
+    found_usernames = {user.username for user in users}
+    missing = [user_id for user_id in user_ids if user_id not in found_ids]
+    missing += [username for username in usernames if username not in found_usernames]
+    return users, missing
+
+
+def bulk_join(cr: ChatRoom, users: Iterable[User]) -> Dict[int, str]:
+    """Adds many users to a chat room with a single insert (without the
+       per row lookup of Membership.save), users already in the room are
+       left as they are
+
+    Returns:
+        Dict[int, str]: user id -> JOINED / ALREADY_MEMBER
+    """
+    users = {user.id: user for user in users}
+    db = room_db(cr)
+
+    with transaction.atomic(using=db):
+        members = set(Membership.objects.using(db).filter(
+            chatroom_id=cr.id,
+            user_id__in=list(users),
+            date_lefted__isnull=True
+        ).values_list('user_id', flat=True))
+
+        joined = [user_id for user_id in users if user_id not in members]
+        Membership.objects.using(db).bulk_create([
+            Membership(user_id=user_id, chatroom_id=cr.id) for user_id in joined
+        ], batch_size=1000)
+        backfill_inbox(cr.id, joined, db)
+        record_changes(ChangeLog.Kind.join, cr.id, joined, db=db)
+        add_membership_events(OutboxEvent.Kind.join, cr.id, joined, db)
+
+    # read-your-writes, next reads of the users go to the primary
+    pin_users_to_primary(joined)
+    logger.debug('%s users joined the chat room %s', len(joined), cr.id)
+    return {user_id: ALREADY_MEMBER if user_id in members else JOINED for user_id in users}
+
+
+def bulk_leave(cr: ChatRoom, users: Iterable[User]) -> Dict[int, str]:
+    """Removes many users from a chat room with a single update of the
+       'date_lefted' of their memberships (what the post_delete signals do
+       one membership at a time). As when the last member leaves, the chat
+       room is deleted by a celery job once empty
+
+    Returns:
+        Dict[int, str]: user id -> LEFT / NOT_MEMBER
+    """
+    users = {user.id: user for user in users}
+    db = room_db(cr)
+
+    with transaction.atomic(using=db):
+        memberships = Membership.objects.using(db).filter(
+            chatroom_id=cr.id,
+            user_id__in=list(users),
+            date_lefted__isnull=True
+        )
+        leavers = set(memberships.values_list('user_id', flat=True))
+        memberships.update(date_lefted=timezone.now())
+
+        empty = leavers and not Membership.objects.using(db).filter(
+            chatroom_id=cr.id,
+            date_lefted__isnull=True
+        ).exists()
+        record_changes(ChangeLog.Kind.leave, cr.id, sorted(leavers), db=db)
+        add_membership_events(OutboxEvent.Kind.leave, cr.id, sorted(leavers), db)
+
+    if empty:
+        schedule_room_deletion(cr.id, db)
+    # read-your-writes, next reads of the users go to the primary
+    pin_users_to_primary(leavers)
+    return {user_id: LEFT if user_id in leavers else NOT_MEMBER for user_id in users}
+
+
+def get_outcomes(users: List[User], missing: List[Union[int, str]], outcomes: Dict[int, str]) -> List[dict]:
+    """Per user outcomes of a bulk request, in the response format"""
+    return [
+        {'user_id': user.id, 'username': user.username, 'outcome': outcomes[user.id]}
+        for user in users
+    ] + [
+        {'user': user, 'outcome': NOT_FOUND}
+        for user in missing
+    ]
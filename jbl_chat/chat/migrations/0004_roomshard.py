@@ -0,0 +1,44 @@
+# Generated by Django 3.2.8 on 2026-10-19 11:53
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0003_inbox'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RoomShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('internal_identifier', models.CharField(max_length=255, unique=True)),
+                ('shard', models.CharField(db_index=True, max_length=64)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='inboxentry',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='membership',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='msg_from',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='msg_as_sender', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='seenmessage',
+            name='seen_by',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
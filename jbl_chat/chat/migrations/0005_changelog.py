@@ -0,0 +1,32 @@
+# Generated by Django 3.2.8 on 2026-10-19 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_roomshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeLog',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('message', 'Message'), ('join', 'Join'), ('leave', 'Leave'), ('seen', 'Seen')], max_length=8)),
+                ('room_id', models.BigIntegerField()),
+                ('user_id', models.BigIntegerField()),
+                ('message_id', models.BigIntegerField(default=None, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['room_id', 'id'], name='chat_change_room_id_0122ef_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='changelog',
+            index=models.Index(fields=['user_id', 'id'], name='chat_change_user_id_511a76_idx'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.2.8 on 2026-10-19 12:55
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """Numbers the existing messages of every room by id, the read cursor
+       of a member is its last message seen (or sent)
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Membership = apps.get_model('chat', 'Membership')
+    Message = apps.get_model('chat', 'Message')
+    SeenMessage = apps.get_model('chat', 'SeenMessage')
+    db = schema_editor.connection.alias
+
+    for room_id in ChatRoom.objects.using(db).values_list('id', flat=True).iterator():
+        msgs = list(Message.objects.using(db).filter(room_id=room_id).only('id', 'msg_from_id').order_by('id'))
+        read_seqs = {}
+        for seq, msg in enumerate(msgs, start=1):
+            msg.seq = seq
+            read_seqs[msg.msg_from_id] = seq
+        Message.objects.using(db).bulk_update(msgs, ['seq'], batch_size=1000)
+        ChatRoom.objects.using(db).filter(pk=room_id).update(last_seq=len(msgs))
+
+        seqs = {msg.id: msg.seq for msg in msgs}
+        for user_id, message_id in SeenMessage.objects.using(db).filter(
+            message__room_id=room_id
+        ).values_list('seen_by_id', 'message_id').iterator():
+            read_seqs[user_id] = max(read_seqs.get(user_id, 0), seqs[message_id])
+        for user_id, read_seq in read_seqs.items():
+            Membership.objects.using(db).filter(
+                chatroom_id=room_id, user_id=user_id, date_lefted__isnull=True
+            ).update(read_seq=read_seq)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_changelog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('room', 'seq'), name='chat_message_room_seq_uniq'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.2.8 on 2026-10-19 13:24
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_outboxevent'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelog',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,8 +1,10 @@
 from asyncio.log import logger
 from os import environ
 from typing import List
-from django.db import models
+from django.db import models, router, transaction
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
 import base64
 
 # Create your models here.
@@ -11,6 +13,8 @@ class ChatRoom(models.Model):
     room_name = models.CharField(max_length=255, unique=True, blank=False)
     room_member = models.ManyToManyField(User, through='Membership')
     is_direct = models.BooleanField(default=False)
+    # seq of the last message of the room, see chat.sequences
+    last_seq = models.PositiveBigIntegerField(default=0)
     
     def get_or_create_direct_chat(self, sender:User, receiver:User):
         """Direct chat room (user to user) is created automatically at
@@ -20,15 +24,23 @@ class ChatRoom(models.Model):
             ChatRoom
         """
 
+        from chat.sharding import get_or_create_chatroom
+
         msg = self.get_direct_base_internal_id(sender, receiver)
         unique_direct_room_name = self.get_direct_chat_name(sender, receiver)
-        cr, created = ChatRoom.objects.get_or_create(
+        cr, created = get_or_create_chatroom(
             internal_identifier=self.encode_msg(msg), 
             room_name=unique_direct_room_name,
             is_direct=True
         )
         if created:
-            cr.room_member.set([sender, receiver])
+            from chat.changes import record_changes
+            from chat.outbox import add_membership_events
+
+            with transaction.atomic(using=cr._state.db):
+                cr.room_member.set([sender, receiver])
+                add_membership_events(OutboxEvent.Kind.join, cr.id, [sender.id, receiver.id], cr._state.db)
+                record_changes(ChangeLog.Kind.join, cr.id, [sender.id, receiver.id], db=cr._state.db)
         
         log = 'Private chat already existed' if created else 'Creating new private chat'
         logger.debug('%s for users %s - %s', log, sender.username, receiver.username)
@@ -80,18 +92,33 @@ class ChatRoom(models.Model):
     def __str__(self):
         return self.room_name
 
+class RoomShard(models.Model):
+    """Global map chat room -> shard db alias, used only when CHAT_SHARDS is set.
+       Its pk allocates the chat room ids, unique across all the shards
+    """
+    internal_identifier = models.CharField(max_length=255, unique=True, blank=False)
+    shard = models.CharField(max_length=64, db_index=True)
+
+    def __str__(self):
+        return '{} - {}'.format(self.pk, self.shard)
+
+# users live on the global db, chat rooms data may live on a shard
+# (see chat.sharding), so foreign keys to users have no db constraint
 class Membership(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_constraint=False)
     chatroom = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
     date_joined = models.DateTimeField(auto_now_add=True)
     date_lefted = models.DateTimeField(null=True, default=None)
+    # seq of the last message of the room read by the user, see chat.sequences
+    read_seq = models.PositiveBigIntegerField(default=0)
 
     def save(self, *args, **kwargs) -> None:
         # chek if last element of user-chatroom has the
         # 'date_lefed empt it means that the user still
         # belongs to chatroom, so do nothing
-        last_join = Membership.objects.filter(
-            user=self.user, chatroom=self.chatroom
+        using = kwargs.get('using') or router.db_for_write(Membership, instance=self)
+        last_join = Membership.objects.using(using).filter(
+            user_id=self.user_id, chatroom_id=self.chatroom_id
         ).last()
 
         if last_join and last_join.date_lefted is None:
@@ -106,14 +133,89 @@ class Membership(models.Model):
 
 class Message(models.Model):
     room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
-    msg_from = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name="msg_as_sender")
+    msg_from = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name="msg_as_sender", db_constraint=False)
     text = models.TextField(max_length=1024, default="")
     sent_at = models.DateTimeField(auto_now_add=True)
+    # True when the message was copied into the recipients' inboxes
+    # at send time (fan-out-on-write), see chat.inbox
+    fanned_out = models.BooleanField(default=False)
+    # gap-free position of the message in its room, see chat.sequences
+    seq = models.PositiveBigIntegerField(null=True, default=None)
 
     def __str__(self):
         return "{} - Message message from {}".format(self.pk, self.msg_from.username)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'fanned_out']),
+        ]
+        constraints = [
+            # also the index of the seq range reads
+            models.UniqueConstraint(fields=['room', 'seq'], name='chat_message_room_seq_uniq'),
+        ]
+
 class SeenMessage(models.Model):
     message = models.ForeignKey(Message, on_delete=models.CASCADE)
-    seen_by = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
+    seen_by = models.ForeignKey(User, on_delete=models.CASCADE, null=True, db_constraint=False)
     seen_at = models.DateTimeField(auto_now_add=True)
+
+class InboxEntry(models.Model):
+    """Per-recipient copy of an unseen message, written at send time
+       only for rooms below CHAT_INBOX_FANOUT_THRESHOLD members.
+       The entry is removed once the message is set as seen
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="inbox", db_constraint=False)
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE)
+    message = models.ForeignKey(Message, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (('user', 'message'),)
+        indexes = [
+            models.Index(fields=['user', 'room']),
+        ]
+
+
+class ChangeLog(models.Model):
+    """Global sequence (the pk) of the chat changes, read by the delta sync
+       of the clients (see chat.changes). It lives on the global db, rooms
+       and users are referenced by id
+    """
+    class Kind(models.TextChoices):
+        message = 'message'
+        join = 'join'
+        leave = 'leave'
+        seen = 'seen'
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=8, choices=Kind.choices)
+    room_id = models.BigIntegerField()
+    # author of the message, member joining/leaving, reader
+    user_id = models.BigIntegerField()
+    # message sent, or last message seen
+    message_id = models.BigIntegerField(null=True, default=None)
+    # by the db clock (see chat.changes.record_changes)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room_id', 'id']),
+            models.Index(fields=['user_id', 'id']),
+        ]
+
+
+class OutboxEvent(models.Model):
+    """Chat events written in the transaction of the message / membership
+       change they announce, on the shard of the room. The outbox relay
+       publishes them in order to a redis stream and deletes them
+       (see chat.outbox)
+    """
+    class Kind(models.TextChoices):
+        message = 'message'
+        join = 'join'
+        leave = 'leave'
+
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=8, choices=Kind.choices)
+    room_id = models.BigIntegerField()
+    payload = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(auto_now_add=True)
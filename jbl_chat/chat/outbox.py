@@ -0,0 +1,189 @@
+import json
+from typing import Callable, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import router
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+
+from chat.models import ChatRoom, Message, OutboxEvent
+from chat.sharding import get_shards
+from jbl_chat.profiling import timed
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+# stream of the chat events, read by the consumer groups
+EVENTS_STREAM = '{}:events'.format(CHAT_CACHE_KEY)
+
+
+def get_relay_batch_size() -> int:
+    """Outbox events published (and deleted) by each step of the relay"""
+    return getattr(settings, 'CHAT_OUTBOX_BATCH_SIZE', 500)
+
+
+def get_stream_maxlen() -> int:
+    """Approximate length the events stream is trimmed to"""
+    return getattr(settings, 'CHAT_EVENTS_STREAM_MAXLEN', 100000)
+
+
+def get_relay_lock_ttl() -> int:
+    """Seconds a relay holds a shard without finishing a batch, in case
+       it dies before releasing it
+    """
+    return getattr(settings, 'CHAT_OUTBOX_RELAY_LOCK_TTL', 60)
+
+
+def _relay_lock_key(db: Optional[str]) -> str:
+    return '{}:outbox_relay:{}'.format(CHAT_CACHE_KEY, db or 'default')
+
+
+def lock_room(room_id: int, db: Optional[str] = None):
+    """Locks the row of the room until the commit, as next_seq does for
+       the messages. The events of a room are inserted under the lock, so
+       their ids (the relay order) follow the commit order: an event can't
+       commit after a later one of its room was relayed
+    """
+    list(ChatRoom.objects.using(db).select_for_update().filter(pk=room_id).values_list('id', flat=True))
+
+
+def add_events(kind: str, room_id: int, payloads: Iterable[dict], db: Optional[str] = None):
+    """Appends events of the room to the outbox of its shard with a single
+       insert, to call in the transaction of the change they announce,
+       holding the lock of the room (see lock_room)
+    """
+    OutboxEvent.objects.using(db).bulk_create([
+        OutboxEvent(kind=kind, room_id=room_id, payload=payload)
+        for payload in payloads
+    ])
+
+
+def add_event(kind: str, room_id: int, payload: dict, db: Optional[str] = None):
+    add_events(kind, room_id, [payload], db)
+
+
+def add_message_event(msg: Message, db: Optional[str] = None):
+    # the room is locked by the next_seq of the message
+    add_event(OutboxEvent.Kind.message, msg.room_id, {
+        'id': msg.id,
+        'seq': msg.seq,
+        'from': msg.msg_from_id,
+        'text': msg.text,
+        'sent_at': msg.sent_at,
+    }, db)
+
+
+def add_membership_events(kind: str, room_id: int, user_ids: Iterable[int], db: Optional[str] = None):
+    lock_room(room_id, db)
+    add_events(kind, room_id, [{'user': user_id} for user_id in user_ids], db)
+
+
+def publish_events(events: List[OutboxEvent], db: Optional[str] = None):
+    """Appends the events to the events stream, with one pipeline"""
+    with timed('cache'):
+        pipe = get_redis_connection('default').pipeline(transaction=False)
+        for event in events:
+            pipe.xadd(EVENTS_STREAM, {
+                'id': event.id,
+                'shard': db or '',
+                'kind': event.kind,
+                'room': event.room_id,
+                'payload': json.dumps(event.payload, cls=DjangoJSONEncoder),
+            }, maxlen=get_stream_maxlen(), approximate=True)
+        pipe.execute()
+
+
+def relay_outbox(db: Optional[str] = None, publish: Callable[[List[OutboxEvent], Optional[str]], None] = publish_events) -> int:
+    """Drains the outbox of a shard into the events stream, in batches and
+       in order (by id, the commit order of the events of a room, see
+       lock_room): a batch is published, then deleted. A relay dying in
+       between publishes the batch again (at least once delivery, the
+       consumers dedupe on the event 'id' and 'shard').
+       Only one relay at a time drains a shard
+
+    Returns:
+        int: events published
+    """
+    # the primary, not a replica
+    alias = db or router.db_for_write(OutboxEvent)
+    conn = get_redis_connection('default')
+    lock = conn.lock(_relay_lock_key(db), timeout=get_relay_lock_ttl())
+    if not lock.acquire(blocking=False):
+        return 0
+
+    published = 0
+    try:
+        while True:
+            events = list(OutboxEvent.objects.using(alias).order_by('id')[:get_relay_batch_size()])
+            if not events:
+                return published
+
+            publish(events, db)
+
+            OutboxEvent.objects.using(alias).filter(pk__in=[event.id for event in events])._raw_delete(alias)
+            published += len(events)
+            # the relay keeps the shard for the next batch
+            lock.extend(get_relay_lock_ttl(), replace_ttl=True)
+    finally:
+        lock.release()
+        if published:
+            logger.info('%s outbox events of %s published', published, db or 'default')
+
+
+def relay_all_outboxes() -> int:
+    """Drains the outboxes of all the shards"""
+    return sum(relay_outbox(db) for db in get_shards() or [None])
+
+
+def _decode_event(stream_id: bytes, fields: dict) -> dict:
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return {
+        'stream_id': stream_id.decode(),
+        'id': int(fields['id']),
+        'shard': fields['shard'] or None,
+        'kind': fields['kind'],
+        'room': int(fields['room']),
+        'payload': json.loads(fields['payload']),
+    }
+
+
+def ensure_group(group: str):
+    """Creates the consumer group (and the stream), reading from the start"""
+    try:
+        get_redis_connection('default').xgroup_create(EVENTS_STREAM, group, id='0', mkstream=True)
+    except ResponseError as ex:
+        if 'BUSYGROUP' not in str(ex):
+            raise
+
+
+def consume_events(group: str, consumer: str, handler: Callable[[List[dict]], None],
+                   count: int = 100, block_ms: Optional[int] = None) -> int:
+    """Hands a batch of events of the consumer group to 'handler' and
+       acknowledges them once it returns, the group checkpoint. The events
+       of a failed handler stay pending and are retried first by the next
+       call of the same consumer
+
+    Returns:
+        int: events handled
+    """
+    conn = get_redis_connection('default')
+    ensure_group(group)
+
+    # the pending events of the consumer, then the new ones
+    for start in ('0', '>'):
+        streams = conn.xreadgroup(group, consumer, {EVENTS_STREAM: start}, count=count,
+                                  block=block_ms if start == '>' else None)
+        entries = [entry for _, stream_entries in streams for entry in stream_entries]
+        if entries:
+            break
+    if not entries:
+        return 0
+
+    # pending events trimmed from the stream meanwhile come without fields
+    handler([_decode_event(stream_id, fields) for stream_id, fields in entries if fields])
+    conn.xack(EVENTS_STREAM, group, *[stream_id for stream_id, _ in entries])
+    return len(entries)
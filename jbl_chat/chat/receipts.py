@@ -0,0 +1,110 @@
+from typing import Callable, Optional
+from uuid import uuid4
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+# deletes the pending job key only if it's still the one of the job
+# (KEYS[1] pending key, ARGV[1] task id)
+RELEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_script = None
+
+# debounce counters, exported by the metrics endpoint
+ENQUEUED = 'enqueued'
+COALESCED = 'coalesced'
+
+
+def get_debounce_ttl() -> int:
+    """Seconds a pending set_msg_as_seen job holds its (room, reader) key,
+       in case the job is lost before releasing it
+    """
+    return getattr(settings, 'CHAT_SEEN_DEBOUNCE_TTL', 10)
+
+
+def _pending_key(chat_room_id: int, reader_id: int) -> str:
+    return '{}:seen_pending:{}:{}'.format(CHAT_CACHE_KEY, chat_room_id, reader_id)
+
+
+def _counter_key(name: str) -> str:
+    return '{}:seen_jobs:{}'.format(CHAT_CACHE_KEY, name)
+
+
+def enqueue_msg_as_seen(apply_task: Callable, chat_room_id: int, reader_id: int) -> Optional[str]:
+    """Enqueues a set_msg_as_seen job, unless one for the same room and
+       reader is already pending: the pending job marks as seen all the
+       messages in the room when it runs, the new ones too.
+
+    Args:
+        apply_task (Callable): set_msg_as_seen apply or apply_async
+        chat_room_id (int)
+        reader_id (int)
+
+    Returns:
+        Optional[str]: id of the enqueued or of the pending job
+    """
+    task_id = str(uuid4())
+    key = _pending_key(chat_room_id, reader_id)
+    try:
+        conn = get_redis_connection('default')
+        if not conn.set(key, task_id, nx=True, ex=get_debounce_ttl()):
+            conn.incr(_counter_key(COALESCED))
+            pending_id = conn.get(key)
+            logger.debug('set_msg_as_seen of room %s reader %s already pending', chat_room_id, reader_id)
+            return pending_id.decode() if pending_id else None
+        conn.incr(_counter_key(ENQUEUED))
+    except Exception as ex:
+        # never lose a job because of the debounce storage
+        logger.warning('set_msg_as_seen debounce failed for %s: %s', key, ex)
+
+    apply_task(
+        kwargs={
+            'chat_room_id': chat_room_id,
+            'reader_id': reader_id
+        },
+        task_id=task_id
+    )
+    return task_id
+
+
+def release_msg_as_seen(chat_room_id: int, reader_id: int, task_id: str):
+    """Called by the job when it starts: the following requests enqueue a
+       new job, for the messages sent after this one reads them
+    """
+    global _release_script
+    try:
+        if _release_script is None:
+            _release_script = get_redis_connection('default').register_script(RELEASE_LUA)
+        _release_script(keys=[_pending_key(chat_room_id, reader_id)], args=[task_id])
+    except Exception as ex:
+        logger.warning('set_msg_as_seen debounce release failed: %s', ex)
+
+
+def get_debounce_counters() -> dict:
+    conn = get_redis_connection('default')
+    return {
+        name: int(conn.get(_counter_key(name)) or 0)
+        for name in (ENQUEUED, COALESCED)
+    }
+
+
+def render_debounce_metrics() -> str:
+    """The debounce counters in the Prometheus text format"""
+    lines = [
+        '# HELP chat_seen_jobs_total set_msg_as_seen jobs requested, enqueued or coalesced into a pending one',
+        '# TYPE chat_seen_jobs_total counter',
+    ]
+    for name, count in get_debounce_counters().items():
+        lines.append('chat_seen_jobs_total{{result="{}"}} {}'.format(name, count))
+    return '\n'.join(lines) + '\n'
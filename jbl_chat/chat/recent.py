@@ -0,0 +1,154 @@
+import json
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis import get_redis_connection
+
+from chat.models import ChatRoom, Message
+from chat.serializers import SlimMessageSerializer, get_senders
+from chat.sharding import room_db
+from jbl_chat.profiling import timed
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+# reads of the recent messages cache, by room, exported by the metrics endpoint
+HIT = 'hit'
+MISS = 'miss'
+STATS_KEY = '{}:recent_stats'.format(CHAT_CACHE_KEY)
+
+
+def get_recent_size() -> int:
+    """Last messages of a room kept in its recent messages cache"""
+    return getattr(settings, 'CHAT_RECENT_MESSAGES', 50)
+
+
+def get_recent_ttl() -> int:
+    """Seconds the recent messages of a room are kept without reads"""
+    return getattr(settings, 'CHAT_RECENT_MESSAGES_TTL', 24 * 60 * 60)
+
+
+def _recent_key(room_id: int) -> str:
+    # the slim messages, see _with_senders
+    return '{}:recent_slim:{}'.format(CHAT_CACHE_KEY, room_id)
+
+
+def _dumps(data) -> str:
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def push_recent_message(msg: Message):
+    """Write-through of a new message, to call once it's committed: it's
+       appended to the recent messages of its room only if they are cached
+       (the room was read lately), the oldest one is dropped
+    """
+    try:
+        with timed('cache'):
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            pipe.rpushx(_recent_key(msg.room_id), _dumps(SlimMessageSerializer(msg).data))
+            pipe.ltrim(_recent_key(msg.room_id), -get_recent_size(), -1)
+            pipe.execute()
+    except Exception as ex:
+        # the next read repairs the cache
+        logger.warning('recent messages cache of room %s not updated: %s', msg.room_id, ex)
+
+
+def forget_recent_messages(room_ids: Iterable[int]):
+    """Drops the recent messages of the rooms, rebuilt by the next read"""
+    keys = [_recent_key(room_id) for room_id in room_ids]
+    if keys:
+        get_redis_connection('default').delete(*keys)
+
+
+def _is_fresh(messages: List[dict], last_seq: int, count: int) -> bool:
+    # the messages of the seqs up to the room last_seq, no gap nor duplicate
+    expected = min(count, last_seq)
+    return [msg.get('seq') for msg in messages] == list(range(last_seq - expected + 1, last_seq + 1))
+
+
+def _count_read(room_id: int, result: str):
+    try:
+        get_redis_connection('default').hincrby(STATS_KEY, '{}:{}'.format(room_id, result))
+    except Exception as ex:
+        logger.warning('recent messages cache stats not updated: %s', ex)
+
+
+def _repair(cr: ChatRoom) -> List[dict]:
+    """Loads the recent messages of the room from its db and caches them"""
+    msgs = list(Message.objects.using(room_db(cr)).filter(room_id=cr.id).order_by('-seq')[:get_recent_size()])
+    messages = json.loads(_dumps(SlimMessageSerializer(msgs[::-1], many=True).data))
+
+    key = _recent_key(cr.id)
+    try:
+        with timed('cache'):
+            pipe = get_redis_connection('default').pipeline()
+            pipe.delete(key)
+            if messages:
+                pipe.rpush(key, *[_dumps(msg) for msg in messages])
+                pipe.expire(key, get_recent_ttl())
+            pipe.execute()
+    except Exception as ex:
+        logger.warning('recent messages cache of room %s not repaired: %s', cr.id, ex)
+    return messages
+
+
+def _with_senders(messages: List[dict]) -> List[dict]:
+    """The messages are cached with the sender id, its data (and
+       memberships) is read now, as BaseMessageSerializer
+    """
+    senders = get_senders(msg['msg_from'] for msg in messages)
+    for msg in messages:
+        msg['msg_from'] = senders.get(msg['msg_from'])
+    return messages
+
+
+def get_recent_messages(cr: ChatRoom, count: int) -> List[dict]:
+    """Last 'count' (at most CHAT_RECENT_MESSAGES) serialized messages of
+       the room, by seq: one LRANGE when cached, otherwise (or if the cache
+       misses some messages of the room last_seq) they are read from the
+       db and cached again
+    """
+    count = max(0, min(count, get_recent_size()))
+    key = _recent_key(cr.id)
+    messages: Optional[List[dict]] = None
+    try:
+        with timed('cache'):
+            pipe = get_redis_connection('default').pipeline(transaction=False)
+            pipe.lrange(key, -count, -1)
+            pipe.expire(key, get_recent_ttl())
+            cached, _ = pipe.execute()
+        messages = [json.loads(msg) for msg in cached] if count else []
+    except Exception as ex:
+        logger.warning('recent messages cache of room %s not read: %s', cr.id, ex)
+
+    if messages is not None and _is_fresh(messages, cr.last_seq, count):
+        _count_read(cr.id, HIT)
+        return _with_senders(messages)
+
+    _count_read(cr.id, MISS)
+    return _with_senders(_repair(cr)[-count:] if count else [])
+
+
+def get_recent_cache_stats() -> Dict[int, Dict[str, int]]:
+    """Hits and misses of the recent messages cache, by room"""
+    stats = {}
+    for field, value in get_redis_connection('default').hgetall(STATS_KEY).items():
+        room_id, result = field.decode().split(':')
+        stats.setdefault(int(room_id), {HIT: 0, MISS: 0})[result] = int(value)
+    return stats
+
+
+def render_recent_cache_metrics() -> str:
+    """The recent messages cache reads in the Prometheus text format"""
+    lines = [
+        '# HELP chat_recent_cache_reads_total reads of the recent messages cache of the rooms, by result',
+        '# TYPE chat_recent_cache_reads_total counter',
+    ]
+    for room_id, counts in sorted(get_recent_cache_stats().items()):
+        for result, count in counts.items():
+            lines.append('chat_recent_cache_reads_total{{room="{}",result="{}"}} {}'.format(room_id, result, count))
+    return '\n'.join(lines) + '\n'
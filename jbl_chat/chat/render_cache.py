@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from chat.models import Message
+from chat.serializers import SlimMessageSerializer
+from jbl_chat.profiling import timed
+from jbl_chat.renderers import dumps
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+
+def get_render_ttl() -> int:
+    """Seconds the rendered JSON of a message is cached"""
+    return getattr(settings, 'CHAT_MESSAGE_RENDER_TTL', 24 * 60 * 60)
+
+
+def _render_key(message_id: int, db: Optional[str]) -> str:
+    # message ids are allocated by each shard
+    return '{}:msg_slim:{}:{}'.format(CHAT_CACHE_KEY, db or 'default', message_id)
+
+
+def render_messages(msgs: List[Message]) -> List[bytes]:
+    """JSON of SlimMessageSerializer of many messages, without the sender:
+       its memberships change, it's added at every read (see with_field)
+    """
+    return [
+        dumps({name: value for name, value in data.items() if name != 'msg_from'})
+        for data in SlimMessageSerializer(msgs, many=True).data
+    ]
+
+
+def get_rendered_messages(message_ids: List[int], db: Optional[str] = None) -> Dict[int, bytes]:
+    """Rendered JSON of the messages of a shard: the cached ones with a
+       single MGET, only the others are loaded, rendered and cached. The
+       JSON holds only the fields that don't change once sent.
+
+    Returns:
+        Dict[int, bytes]: message id -> JSON, without the deleted messages
+    """
+    if not message_ids:
+        return {}
+    conn = get_redis_connection('default')
+    try:
+        with timed('cache'):
+            cached = conn.mget([_render_key(message_id, db) for message_id in message_ids])
+    except Exception as ex:
+        logger.warning('rendered messages not read: %s', ex)
+        cached = [None] * len(message_ids)
+
+    rendered = {message_id: raw for message_id, raw in zip(message_ids, cached) if raw is not None}
+    missing = [message_id for message_id in message_ids if message_id not in rendered]
+    if not missing:
+        return rendered
+
+    msgs = list(Message.objects.using(db).filter(pk__in=missing).order_by('id'))
+    new = dict(zip([msg.id for msg in msgs], render_messages(msgs)))
+    try:
+        with timed('cache'):
+            pipe = conn.pipeline(transaction=False)
+            for message_id, raw in new.items():
+                pipe.set(_render_key(message_id, db), raw, ex=get_render_ttl())
+            pipe.execute()
+    except Exception as ex:
+        logger.warning('rendered messages not cached: %s', ex)
+    rendered.update(new)
+    return rendered
+
+
+def with_field(raw: bytes, name: str, value) -> bytes:
+    """Adds a field to the rendered JSON object of a message, without
+       decoding it
+    """
+    return b'%s,"%s":%s}' % (raw[:-1], name.encode(), dumps(value))
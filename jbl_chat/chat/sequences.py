@@ -0,0 +1,63 @@
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import F
+
+from chat.models import ChatRoom, Membership
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+def next_seq(room_id: int, db: str = None) -> int:
+    """Allocates the seq of a new message of the room, to call inside the
+       transaction inserting the message.
+
+       The increment locks the room row until the transaction ends, so the
+       concurrent senders of the same room (in any worker) get consecutive
+       numbers, and a rolled back insert gives its number back: seqs have
+       no gaps
+    """
+    rooms = ChatRoom.objects.using(db).filter(pk=room_id)
+    rooms.update(last_seq=F('last_seq') + 1)
+    return rooms.values_list('last_seq', flat=True).get()
+
+
+def get_seq_range_max() -> int:
+    """Max messages of a seq range read"""
+    return getattr(settings, 'CHAT_SEQ_RANGE_MAX', 1000)
+
+
+def get_seq_range(params) -> Optional[Tuple[int, int]]:
+    """Reads the ?seq_from=<n>&seq_to=<m> range of the messages of a room,
+       a missing bound is open
+
+    Returns:
+        Optional[Tuple[int, int]]: the range, None if no bound is given
+    """
+    seq_from, seq_to = params.get('seq_from', ''), params.get('seq_to', '')
+    if not seq_from and not seq_to:
+        return None
+    if not all(bound.isdigit() for bound in (seq_from, seq_to) if bound):
+        raise ValidationError("seq_from and seq_to must be numbers")
+    seq_from = int(seq_from) if seq_from else 1
+    seq_to = int(seq_to) if seq_to else seq_from + get_seq_range_max() - 1
+    if seq_to < seq_from:
+        raise ValidationError("seq_to must not be lower than seq_from")
+    if seq_to - seq_from + 1 > get_seq_range_max():
+        raise ValidationError("At most {} messages per range".format(get_seq_range_max()))
+    return seq_from, seq_to
+
+
+def mark_read(room_id: int, user_id: int, seq: int, db: str = None) -> int:
+    """Moves forward the read cursor of the user in the room, its unread
+       count is the room last_seq minus the cursor
+    """
+    return Membership.objects.using(db).filter(
+        chatroom_id=room_id,
+        user_id=user_id,
+        date_lefted__isnull=True,
+        read_seq__lt=seq
+    ).update(read_seq=seq)
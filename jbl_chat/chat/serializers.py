@@ -1,32 +1,101 @@
+from itertools import chain
+from typing import Dict, Iterable, List
+
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.db.models import F, Count
+from django.db import connections
+from django.db.models import F, Count, Manager, Window, prefetch_related_objects
+from django.db.models.functions import RowNumber
 
 from .models import ChatRoom, Message, Membership, SeenMessage
+from .sharding import (
+    get_user_memberships,
+    group_by_db,
+    prefetch_user_memberships,
+    room_db,
+    scatter,
+    sharding_enabled,
+)
 from rest_framework import serializers
+from jbl_chat.profiling import ProfiledModelSerializer
 from authentication.serializers import UserBaseSerializer
 
 
-class MembershipSerializer(serializers.ModelSerializer):
+class MembershipSerializer(ProfiledModelSerializer):
     user = UserBaseSerializer()
     class Meta:
         model = Membership
         fields = ('id', 'date_joined', 'user')
 
 
-class BaseChatRoomSerializer(serializers.ModelSerializer):
+class BaseChatRoomSerializer(ProfiledModelSerializer):
 
     class Meta:
         model = ChatRoom
         fields = ('id', 'room_name')
 
 
-class ChatRoomSerializer(serializers.ModelSerializer):
+def current_members(db, room_ids: List[int]):
+    """(chatroom, user) of the current members of the rooms: the users
+       with an odd number of memberships, the last one is a join
+    """
+    return Membership.objects.using(
+        db                                     # the chatrooms shard
+    ).filter(
+        chatroom_id__in = room_ids,            # belongs to the chatrooms
+    ).values('chatroom', 'user').annotate(
+        Count('user')
+    ).annotate(
+        odd=F('user__count') %2                # has an odd n° of instancese
+    ).filter(
+        odd=True
+    )
+
+
+def prefetch_room_members(chat_rooms: Iterable[ChatRoom]):
+    """Loads the current members of many chat rooms, in one query per
+       shard plus one for the users, for ChatRoomSerializer.get_room_members
+    """
+    by_db = group_by_db(chat_rooms)
+    rows = list(chain(*scatter(
+        lambda db: list(current_members(db, [cr.id for cr in by_db[db]]).values_list('chatroom', 'user')),
+        dbs=by_db
+    )))
+    users = User.objects.in_bulk({user_id for _, user_id in rows})
+
+    members = {}
+    for room_id, user_id in sorted(rows, key=lambda row: row[1]):
+        members.setdefault(room_id, []).append(users[user_id])
+    for cr in chain(*by_db.values()):
+        cr._room_members = members.get(cr.id, [])
+
+
+class ChatRoomListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        chat_rooms = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_room_members(cr for cr in chat_rooms if not hasattr(cr, '_room_members'))
+        return super().to_representation(chat_rooms)
+
+
+class ChatRoomSerializer(ProfiledModelSerializer):
     room_member = serializers.SerializerMethodField(method_name='get_room_members')
     messages = serializers.ListField(required=False)
+    unread = serializers.SerializerMethodField()
 
     class Meta:
         model = ChatRoom
-        fields = ('id', 'room_name', 'room_member', 'messages')
+        fields = ('id', 'room_name', 'room_member', 'messages', 'last_seq', 'unread')
+        list_serializer_class = ChatRoomListSerializer
+
+    def get_unread(self, chatroom):
+        """messages after the read cursor of the user, when loaded with
+           the user chat rooms (see get_user_chatrooms)
+        """
+        read_seq = getattr(chatroom, 'read_seq', None)
+        if read_seq is None:
+            return None
+        return max(chatroom.last_seq - read_seq, 0)
 
     def get_room_members(self, chatroom, get_queryset=False):
         """excludes user that left the chat room 
@@ -37,19 +106,19 @@ class ChatRoomSerializer(serializers.ModelSerializer):
 
            get_queryset:bool defualt to False
         """
-        qset = chatroom.room_member.filter(            # get all chatroom memebers who:
-            id__in=  Membership.objects.filter(
-                        chatroom_id = chatroom.id,     # belongs to the chatroom
-                    ).values('user').annotate(
-                        Count('user')
-                        ).annotate(
-                            odd=F('user__count') %2    # has an odd n° of instancese 
-                            ).filter(                  
-                                odd=True
-                            ).
-                            values_list(
-                                'user'
-                                )
+        if not get_queryset and hasattr(chatroom, '_room_members'):
+            # loaded by prefetch_room_members
+            return [UserBaseSerializer(m).data for m in chatroom._room_members]
+
+        member_ids = current_members(
+            room_db(chatroom), [chatroom.id]
+        ).values_list('user')
+        if sharding_enabled():
+            # users live on the global db, no cross db subquery
+            member_ids = [user_id for (user_id,) in member_ids]
+
+        qset = User.objects.filter(                    # get all chatroom memebers who:
+            id__in=member_ids
         ).distinct()                                   # removes duplicates
 
         return qset if get_queryset else [
@@ -57,35 +126,155 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         ]
 
 
-class MemberSerializer(serializers.ModelSerializer):
+class MemberListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        users = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_user_memberships(users)
+        return super().to_representation(users)
+
+
+class MemberSerializer(ProfiledModelSerializer):
     chat_room = serializers.SerializerMethodField(method_name='get_chat_rooms')
 
     class Meta:
         model = User
         fields = ('id', 'username', 'chat_room')
+        list_serializer_class = MemberListSerializer
     
     def get_chat_rooms(self, obj: User):
         """get chat_rooms by user"""
-        qset = Membership.objects.filter(user=obj)
+        qset = getattr(obj, '_chat_memberships', None)    # loaded by prefetch_user_memberships
+        if qset is None:
+            qset = get_user_memberships(obj.id)
+            prefetch_related_objects(qset, 'user')
         return [MembershipSerializer(m).data for m in qset]
 
 
-class MessageSerializer(serializers.ModelSerializer):
+def prefetch_messages_relations(messages: List[Message], with_room: bool = False):
+    """Loads senders (with their memberships) and, if requested, rooms
+       (with their members) of many messages at once
+    """
+    prefetch_related_objects(messages, 'msg_from')
+    if with_room:
+        # rooms live on the shard of their messages
+        for msgs in group_by_db(messages).values():
+            prefetch_related_objects(msgs, 'room')
+    prefetch_user_memberships(msg.msg_from for msg in messages if msg.msg_from is not None)
+    if with_room:
+        prefetch_room_members({
+            id(msg.room): msg.room for msg in messages if not hasattr(msg.room, '_room_members')
+        }.values())
+
+
+class MessageListSerializer(serializers.ListSerializer):
+
+    def to_representation(self, data):
+        messages = list(data.all() if isinstance(data, Manager) else data)
+        prefetch_messages_relations(
+            messages,
+            with_room=isinstance(self.child.fields.get('room'), ChatRoomSerializer)
+        )
+        return super().to_representation(messages)
+
+
+class MessageSerializer(ProfiledModelSerializer):
     room = ChatRoomSerializer()
     msg_from = MemberSerializer()
 
     class Meta:
         model = Message
         fields = '__all__'
+        list_serializer_class = MessageListSerializer
 
-class BaseMessageSerializer(serializers.ModelSerializer):
+class BaseMessageSerializer(ProfiledModelSerializer):
     msg_from = MemberSerializer()
 
     class Meta:
         model = Message
         fields = '__all__'
+        list_serializer_class = MessageListSerializer
+
+
+class SlimMessageSerializer(ProfiledModelSerializer):
+    """The fields of a message that don't change once sent, the sender by
+       id: the cached form of the messages (see chat.recent and
+       chat.render_cache), the live sender data is added from get_senders
+    """
+    class Meta:
+        model = Message
+        fields = '__all__'
+
+
+def get_senders(user_ids: Iterable[int]) -> Dict[int, dict]:
+    """MemberSerializer data of the senders of cached messages, by id, read
+       at every use since their memberships change: one query for the users
+       plus one per shard for their memberships
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if not user_ids:
+        return {}
+    users = User.objects.filter(pk__in=user_ids).order_by('id')
+    return {data['id']: data for data in MemberSerializer(users, many=True).data}
+
+
+def get_seen_by_max_readers() -> int:
+    """Max readers listed in the 'seen_by' of each message"""
+    return getattr(settings, 'CHAT_SEEN_BY_MAX_READERS', 10)
+
+
+def _seen_by_readers(db, message_ids: List[int], readers: int) -> List[tuple]:
+    """(message, reader, total readers) of the first 'readers' readers of
+       every message, ranked in the db by a window function
+    """
+    ranked = SeenMessage.objects.using(db).filter(
+        message_id__in=message_ids
+    ).annotate(
+        rank=Window(RowNumber(), partition_by=[F('message_id')], order_by=[F('seen_at').asc(), F('id').asc()]),
+        total=Window(Count('id'), partition_by=[F('message_id')]),
+    ).values_list('message_id', 'seen_by_id', 'rank', 'total')
+
+    sql, params = ranked.query.sql_with_params()
+    with connections[ranked.db].cursor() as cursor:
+        cursor.execute(
+            'SELECT ranked.message_id, ranked.seen_by_id, ranked.total FROM ({}) ranked '
+            'WHERE ranked.rank <= %s ORDER BY ranked.message_id, ranked.rank'.format(sql),
+            list(params) + [readers]
+        )
+        return cursor.fetchall()
+
+
+def get_seen_by(db, message_ids: List[int], readers: int = 0) -> Dict[int, dict]:
+    """Read receipts aggregate of many messages of a shard: the readers
+       count and the first 'readers' readers. One query, plus one for the
+       users if 'readers'
+    """
+    readers = max(0, min(readers, get_seen_by_max_readers()))
+    seen_by = {
+        message_id: {'count': 0, 'readers': []} if readers else {'count': 0}
+        for message_id in message_ids
+    }
+    if not message_ids:
+        return seen_by
+
+    if not readers:
+        counts = SeenMessage.objects.using(db).filter(
+            message_id__in=list(message_ids)
+        ).values_list('message_id').annotate(Count('id'))
+        for message_id, count in counts:
+            seen_by[message_id]['count'] = count
+        return seen_by
+
+    rows = _seen_by_readers(db, list(message_ids), readers)
+    users = User.objects.in_bulk({reader_id for _, reader_id, _ in rows if reader_id is not None})
+    for message_id, reader_id, count in rows:
+        seen_by[message_id]['count'] = count
+        if reader_id in users:
+            seen_by[message_id]['readers'].append({'id': reader_id, 'username': users[reader_id].username})
+    return seen_by
+
 
-class SeenMessageSerializer(serializers.ModelSerializer):
+class SeenMessageSerializer(ProfiledModelSerializer):
     message = MessageSerializer()
     room = ChatRoomSerializer()
 
@@ -0,0 +1,381 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from itertools import chain
+import zlib
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, close_old_connections, connections, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+
+from chat.utils import keep_timestamps
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+CACHE_TTL = getattr(settings, 'CACHE_TTL', 60*15)
+
+# chat models whose rows live on the shard of their chat room
+SHARDED_MODELS = ('chatroom', 'membership', 'message', 'seenmessage', 'inboxentry', 'outboxevent')
+
+_executor = None
+
+
+def get_shards() -> List[str]:
+    """db aliases holding the chat rooms data, empty if sharding is disabled"""
+    return list(getattr(settings, 'CHAT_SHARDS', []))
+
+
+def sharding_enabled() -> bool:
+    return bool(get_shards())
+
+
+def is_sharded_model(model) -> bool:
+    return model._meta.app_label == 'chat' and model._meta.model_name in SHARDED_MODELS
+
+
+def _shard_cache_key(room_id: int) -> str:
+    return '{}:room_shard:{}'.format(CHAT_CACHE_KEY, room_id)
+
+
+def shard_for_room(room_id: int) -> str:
+    """Looks up (cache first) the shard of a chat room in the global map"""
+    from chat.models import RoomShard
+
+    key = _shard_cache_key(room_id)
+    alias = cache.get(key)
+    if alias:
+        return alias
+
+    alias = RoomShard.objects.using(DEFAULT_DB_ALIAS).filter(
+        pk=room_id
+    ).values_list('shard', flat=True).first()
+    if alias is None:
+        # unknown room, the lookup on the default db will raise DoesNotExist
+        return DEFAULT_DB_ALIAS
+
+    cache.set(key, alias, timeout=CACHE_TTL)
+    return alias
+
+
+def set_room_shard(room_id: int, alias: str):
+    from chat.models import RoomShard
+
+    RoomShard.objects.using(DEFAULT_DB_ALIAS).filter(pk=room_id).update(shard=alias)
+    cache.set(_shard_cache_key(room_id), alias, timeout=CACHE_TTL)
+
+
+def forget_room_shard(room_id: int):
+    cache.delete(_shard_cache_key(room_id))
+
+
+def room_db(room: Union[int, models.Model]) -> Optional[str]:
+    """db alias holding the data of a chat room (ChatRoom instance or id).
+       Returns None if sharding is disabled, so that '.using(room_db(..))'
+       falls back to the routers (primary/replicas)
+    """
+    if not sharding_enabled():
+        return None
+    if isinstance(room, models.Model):
+        if room._state.db:
+            return room._state.db
+        room = room.pk
+    return shard_for_room(int(room))
+
+
+def pick_shard(internal_identifier: str) -> str:
+    """Shard of a new chat room, rooms can be moved later with the
+       'rebalance_shards' command
+    """
+    shards = get_shards()
+    return shards[zlib.crc32(internal_identifier.encode()) % len(shards)]
+
+
+def create_chatroom(**fields):
+    """Creates a chat room on its shard, the id is allocated from the global map"""
+    from chat.models import ChatRoom, RoomShard
+
+    if not sharding_enabled():
+        return ChatRoom.objects.create(**fields)
+
+    cr = ChatRoom(**fields)
+    # same defaults of ChatRoom.save
+    if not cr.internal_identifier:
+        cr.internal_identifier = cr.encode_msg(cr.room_name)
+
+    alias = pick_shard(cr.internal_identifier)
+    room_shard = RoomShard.objects.using(DEFAULT_DB_ALIAS).create(
+        internal_identifier=cr.internal_identifier,
+        shard=alias
+    )
+
+    cr.pk = room_shard.pk
+    cr.save(using=alias, force_insert=True)
+    cache.set(_shard_cache_key(cr.pk), alias, timeout=CACHE_TTL)
+    return cr
+
+
+def get_or_create_chatroom(**fields):
+    """Sharding aware ChatRoom.objects.get_or_create, rooms are looked up
+       by 'internal_identifier' that is unique across all the shards
+
+    Returns:
+        Tuple[ChatRoom, bool]: the chat room and whether it was created
+    """
+    from chat.models import ChatRoom, RoomShard
+
+    if not sharding_enabled():
+        return ChatRoom.objects.get_or_create(**fields)
+
+    room_shard = RoomShard.objects.using(DEFAULT_DB_ALIAS).filter(
+        internal_identifier=fields['internal_identifier']
+    ).first()
+    if room_shard is None:
+        try:
+            return create_chatroom(**fields), True
+        except IntegrityError:
+            # concurrently created
+            room_shard = RoomShard.objects.using(DEFAULT_DB_ALIAS).get(
+                internal_identifier=fields['internal_identifier']
+            )
+    return ChatRoom.objects.using(room_shard.shard).get(pk=room_shard.pk), False
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'CHAT_SHARD_WORKERS', 8),
+            thread_name_prefix='shard'
+        )
+    return _executor
+
+
+def _run_on_shard(func: Callable, db: Optional[str]):
+    # worker threads have their own connections, recycled like in a request
+    close_old_connections()
+    try:
+        return func(db)
+    finally:
+        close_old_connections()
+
+
+def scatter(func: Callable, dbs: Optional[Iterable[Optional[str]]] = None) -> List:
+    """Runs 'func(db)' on every shard (in parallel if more than one)
+       and gathers the results in the shards order.
+       With sharding disabled 'func' runs once with db None
+    """
+    dbs = list(dbs) if dbs is not None else (get_shards() or [None])
+    if len(dbs) <= 1:
+        return [func(db) for db in dbs]
+
+    executor = _get_executor()
+    futures = [
+        executor.submit(copy_context().run, _run_on_shard, func, db)
+        for db in dbs
+    ]
+    return [future.result() for future in futures]
+
+
+def group_by_db(objs: Iterable[models.Model]) -> Dict[Optional[str], List[models.Model]]:
+    """Groups chat model instances by the db holding them"""
+    grouped = {}
+    for obj in objs:
+        grouped.setdefault(obj._state.db if sharding_enabled() else None, []).append(obj)
+    return grouped
+
+
+def get_user_chatrooms(user_id: int) -> List:
+    """Chat rooms the user currently belongs to, from all the shards"""
+    from chat.models import ChatRoom, Membership
+
+    def query(db):
+        memberships = Membership.objects.using(db).filter(
+            user_id=user_id,
+            date_lefted__isnull=True
+        )
+        # with the read cursor of the user, for the unread counts
+        return list(ChatRoom.objects.using(db).filter(
+            id__in = memberships.values('chatroom_id')
+        ).annotate(
+            read_seq=Subquery(memberships.filter(chatroom_id=OuterRef('pk')).values('read_seq')[:1])
+        ).order_by('id'))
+
+    return sorted(chain(*scatter(query)), key=lambda cr: cr.id)
+
+
+def get_group_chatrooms() -> List:
+    """All the group (not direct) chat rooms, from all the shards"""
+    from chat.models import ChatRoom
+
+    def query(db):
+        return list(ChatRoom.objects.using(db).filter(
+            is_direct=False
+        ).order_by('id'))
+
+    return sorted(chain(*scatter(query)), key=lambda cr: cr.id)
+
+
+def get_user_memberships(user_id: int) -> List:
+    """All the memberships of a user, from all the shards"""
+    from chat.models import Membership
+
+    def query(db):
+        return list(Membership.objects.using(db).filter(user_id=user_id).order_by('id'))
+
+    return list(chain(*scatter(query)))
+
+
+def prefetch_user_memberships(users: Iterable):
+    """Loads the memberships of many users (from all the shards) at once,
+       in the '_chat_memberships' attribute of each user
+    """
+    from chat.models import Membership
+
+    users = {user.id: user for user in users if not hasattr(user, '_chat_memberships')}
+    if not users:
+        return
+
+    def query(db):
+        return list(Membership.objects.using(db).filter(user_id__in=list(users)).order_by('id'))
+
+    for user in users.values():
+        user._chat_memberships = []
+    for membership in chain(*scatter(query)):
+        user = users[membership.user_id]
+        Membership.user.field.set_cached_value(membership, user)
+        user._chat_memberships.append(membership)
+
+
+def _copy_messages(room_id: int, source: str, target: str, after_id: int = 0) -> Dict[int, int]:
+    """Copies the messages of a room (and their seen/inbox rows) from source
+       to target, message ids are allocated by the target shard. The messages
+       of the catch-up pass ('after_id') get new seqs from the target room,
+       the tasks on the target may have taken their source seqs meanwhile
+
+    Returns:
+        Dict[int, int]: source message id -> target message id
+    """
+    from chat.models import InboxEntry, Message, SeenMessage
+    from chat.sequences import next_seq
+
+    msgs = list(Message.objects.using(source).filter(
+        room_id=room_id, id__gt=after_id
+    ).order_by('id'))
+    source_ids = [msg.id for msg in msgs]
+    for msg in msgs:
+        msg.pk = None
+        if after_id:
+            msg.seq = next_seq(room_id, target)
+
+    if connections[target].features.can_return_rows_from_bulk_insert:
+        Message.objects.using(target).bulk_create(msgs, batch_size=1000)
+    else:
+        for msg in msgs:
+            msg.save(using=target, force_insert=True)
+    id_map = dict(zip(source_ids, [msg.id for msg in msgs]))
+
+    for model in (SeenMessage, InboxEntry):
+        rows = list(model.objects.using(source).filter(message_id__in=source_ids))
+        for row in rows:
+            row.pk = None
+            row.message_id = id_map[row.message_id]
+        model.objects.using(target).bulk_create(rows, batch_size=1000)
+
+    return id_map
+
+
+def _raw_delete_room(room_id: int, db: str):
+    """Set based delete of a room data, without loading the rows nor
+       sending the delete signals (that would touch the shard map)
+    """
+    from chat.models import ChatRoom, InboxEntry, Membership, Message, SeenMessage
+
+    with transaction.atomic(using=db):
+        InboxEntry.objects.using(db).filter(room_id=room_id)._raw_delete(db)
+        SeenMessage.objects.using(db).filter(message__room_id=room_id)._raw_delete(db)
+        Message.objects.using(db).filter(room_id=room_id)._raw_delete(db)
+        Membership.objects.using(db).filter(chatroom_id=room_id)._raw_delete(db)
+        ChatRoom.objects.using(db).filter(pk=room_id)._raw_delete(db)
+
+
+def move_room(room_id: int, target: str):
+    """Moves a chat room and all its data to another shard.
+
+       The data is copied on the target, the shard map is switched and a
+       catch-up pass copies the messages written meanwhile on the source
+       by the tasks that resolved the shard before the switch, then the
+       source rows are deleted
+    """
+    from chat.models import ChatRoom, Membership, Message, SeenMessage
+    from chat.recent import forget_recent_messages
+
+    source = shard_for_room(room_id)
+    if source == target:
+        return
+
+    # leftovers of an interrupted move
+    _raw_delete_room(room_id, target)
+
+    with keep_timestamps(Membership, Message, SeenMessage):
+        with transaction.atomic(using=target):
+            room = ChatRoom.objects.using(source).get(pk=room_id)
+            ChatRoom.objects.using(target).bulk_create([room])
+
+            memberships = list(Membership.objects.using(source).filter(chatroom_id=room_id))
+            for membership in memberships:
+                membership.pk = None
+            Membership.objects.using(target).bulk_create(memberships, batch_size=1000)
+
+            id_map = _copy_messages(room_id, source, target)
+            # messages sent between the copy of the room and of its messages
+            last_seq = Message.objects.using(target).filter(room_id=room_id).aggregate(Max('seq'))['seq__max']
+            ChatRoom.objects.using(target).filter(pk=room_id, last_seq__lt=last_seq or 0).update(last_seq=last_seq)
+
+        set_room_shard(room_id, target)
+
+        last_copied_id = max(id_map, default=0)
+        with transaction.atomic(using=target):
+            _copy_messages(room_id, source, target, after_id=last_copied_id)
+
+    _raw_delete_room(room_id, source)
+    # the late messages got new seqs
+    forget_recent_messages([room_id])
+    logger.info('room %s moved from %s to %s', room_id, source, target)
+
+
+class RoomShardRouter:
+    """Routes the chat rooms data to the shard of the room when CHAT_SHARDS
+       is set, users and the shard map stay on the global ('default') db.
+
+       Queries without an instance hint have to pick the shard with
+       '.using(room_db(room))', otherwise they fall back to the next router
+    """
+
+    def db_for_read(self, model, **hints):
+        if not sharding_enabled() or not is_sharded_model(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and is_sharded_model(type(instance)) and instance._state.db:
+            return instance._state.db
+        return None
+
+    def db_for_write(self, model, **hints):
+        return self.db_for_read(model, **hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not sharding_enabled():
+            return None
+        sharded1, sharded2 = is_sharded_model(type(obj1)), is_sharded_model(type(obj2))
+        if sharded1 and sharded2:
+            return obj1._state.db == obj2._state.db
+        if sharded1 or sharded2:
+            # chat data referencing global users
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
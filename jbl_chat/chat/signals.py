@@ -1,15 +1,34 @@
-from django.db.models.signals import post_delete
+from contextvars import ContextVar
+
+from django.db.models.signals import post_delete, pre_delete
 from django.dispatch import receiver
 
-from chat.models import ChatRoom
+from chat.models import ChatRoom, RoomShard
 from .models import Membership
+from .cleanup import schedule_room_deletion
+from .sharding import forget_room_shard, sharding_enabled
+from django.db import DEFAULT_DB_ALIAS, transaction
 from django.utils import timezone
-from django.dispatch import Signal
+
+# ids of the chat rooms being deleted, their memberships go with them
+_deleting_rooms = ContextVar('deleting_rooms', default=frozenset())
 
 
 # Chat Room
+@receiver(pre_delete, sender=ChatRoom)
+def mark_deleting_chatroom(sender, instance: ChatRoom, **kwargs):
+    _deleting_rooms.set(_deleting_rooms.get() | {instance.pk})
+
+
+@receiver(post_delete, sender=ChatRoom)
+def unmark_deleting_chatroom(sender, instance: ChatRoom, **kwargs):
+    _deleting_rooms.set(_deleting_rooms.get() - {instance.pk})
+
+
 @receiver(post_delete, sender=Membership)
 def delete_membership(sender, instance: Membership, **kwargs):
+    if instance.chatroom_id in _deleting_rooms.get():
+        return
     # set the value of 'date_lefted' in the Membership relation
     leave_date = timezone.now()
     instance.date_lefted = leave_date
@@ -18,14 +37,28 @@ def delete_membership(sender, instance: Membership, **kwargs):
 
 @receiver(post_delete, sender=Membership)
 def delete_chatroom(sender, instance: Membership, **kwargs):
-    # if no member is left in the chat room, delete it
-    if not Membership.objects.filter(
+    # if no member is left in the chat room, delete it (and its messages)
+    # in a celery job, in chunks and out of the request
+    if instance.chatroom_id in _deleting_rooms.get():
+        return
+    if not Membership.objects.using(instance._state.db).filter(
         chatroom_id=instance.chatroom_id,
         date_lefted__isnull=True
-    ):
-        # disable signals to avoid recursion
-        Signal.disconnect(post_delete, receiver=delete_chatroom, sender=Membership)
-        Signal.disconnect(post_delete, receiver=delete_membership, sender=Membership)
-        ChatRoom.objects.get(pk=instance.chatroom_id).delete()
+    ).exists():
+        # the leave may run in a transaction: a job started before its
+        # commit would still see the member and keep the room
+        transaction.on_commit(
+            lambda: schedule_room_deletion(instance.chatroom_id, instance._state.db if sharding_enabled() else None),
+            using=instance._state.db
+        )
 
 
+@receiver(post_delete, sender=ChatRoom)
+def delete_room_shard(sender, instance: ChatRoom, **kwargs):
+    # remove the room from the shard map, unless it was moved to another shard
+    if sharding_enabled():
+        RoomShard.objects.using(DEFAULT_DB_ALIAS).filter(
+            pk=instance.pk,
+            shard=instance._state.db
+        ).delete()
+        forget_room_shard(instance.pk)
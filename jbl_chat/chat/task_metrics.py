@@ -0,0 +1,164 @@
+import json
+from time import perf_counter, time
+from typing import Dict, List
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from jbl_chat.profiling import start_profiling, stop_profiling
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# message header with the publish timestamp
+ENQUEUED_AT_HEADER = 'enqueued_at'
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# name: (help, buckets)
+HISTOGRAMS = {
+    'chat_task_queue_wait_seconds': ('Time between the task publish and its start', SECONDS_BUCKETS),
+    'chat_task_run_seconds': ('Task execution time', SECONDS_BUCKETS),
+    'chat_task_db_seconds': ('Time spent by the task in db queries', SECONDS_BUCKETS),
+    'chat_task_result_bytes': ('Size of the json task result', BYTES_BUCKETS),
+}
+TASKS_COUNTER = 'chat_tasks_total'
+
+# task id -> (start, start timestamp, profile, profile token) of the tasks
+# running in this process
+_running = {}
+
+
+def metrics_enabled() -> bool:
+    return getattr(settings, 'CHAT_TASK_METRICS', False)
+
+
+def _series_key() -> str:
+    return '{}:task_metrics:series'.format(CHAT_CACHE_KEY)
+
+
+def _metric_key(metric: str, task: str, queue: str) -> str:
+    return '{}:task_metrics:{}:{}:{}'.format(CHAT_CACHE_KEY, metric, task, queue)
+
+
+def get_task_queue(task) -> str:
+    delivery_info = task.request.delivery_info or {}
+    if delivery_info.get('routing_key'):
+        return delivery_info['routing_key']
+    # applied locally, the queue it would have been routed to
+    return task.app.amqp.router.route({}, task.name)['queue'].name
+
+
+def record_task(task: str, queue: str, state: str, observations: Dict[str, float]):
+    """Adds the observations (metric: value) of a task run to the metrics in
+       redis, shared by all the workers, in one round trip
+    """
+    pipe = get_redis_connection('default').pipeline(transaction=False)
+    for metric, value in observations.items():
+        buckets = HISTOGRAMS[metric][1]
+        # counts by bucket (not cumulative), '+Inf' for the values over the last one
+        bucket = next((str(le) for le in buckets if value <= le), '+Inf')
+        key = _metric_key(metric, task, queue)
+        pipe.hincrby(key, bucket, 1)
+        pipe.hincrbyfloat(key, 'sum', value)
+        pipe.hincrby(key, 'count', 1)
+        pipe.sadd(_series_key(), '{}|{}|{}'.format(metric, task, queue))
+    pipe.hincrby(_metric_key(TASKS_COUNTER, task, queue), state, 1)
+    pipe.sadd(_series_key(), '{}|{}|{}'.format(TASKS_COUNTER, task, queue))
+    pipe.execute()
+
+
+def _labels(**labels) -> str:
+    return ','.join('{}="{}"'.format(name, value) for name, value in labels.items())
+
+
+def render_metrics() -> str:
+    """The task metrics in the Prometheus text format"""
+    conn = get_redis_connection('default')
+    series = sorted(tuple(s.decode().split('|')) for s in conn.smembers(_series_key()))
+    pipe = conn.pipeline(transaction=False)
+    for metric, task, queue in series:
+        pipe.hgetall(_metric_key(metric, task, queue))
+    values = dict(zip(series, pipe.execute()))
+
+    lines: List[str] = []
+    for metric, (help_text, buckets) in HISTOGRAMS.items():
+        lines += ['# HELP {} {}'.format(metric, help_text), '# TYPE {} histogram'.format(metric)]
+        for (name, task, queue), counts in values.items():
+            if name != metric:
+                continue
+            counts = {k.decode(): v.decode() for k, v in counts.items()}
+            cumulative = 0
+            for le in [str(b) for b in buckets] + ['+Inf']:
+                cumulative += int(counts.get(le, 0))
+                lines.append('{}_bucket{{{}}} {}'.format(metric, _labels(task=task, queue=queue, le=le), cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(metric, _labels(task=task, queue=queue), counts.get('sum', 0)))
+            lines.append('{}_count{{{}}} {}'.format(metric, _labels(task=task, queue=queue), counts.get('count', 0)))
+
+    lines += ['# HELP {} Tasks run by final state'.format(TASKS_COUNTER), '# TYPE {} counter'.format(TASKS_COUNTER)]
+    for (name, task, queue), counts in values.items():
+        if name != TASKS_COUNTER:
+            continue
+        for state, count in sorted(counts.items()):
+            lines.append('{}{{{}}} {}'.format(TASKS_COUNTER, _labels(task=task, queue=queue, state=state.decode()), int(count)))
+    return '\n'.join(lines) + '\n'
+
+
+def clear_metrics():
+    conn = get_redis_connection('default')
+    keys = [
+        _metric_key(*s.decode().split('|')) for s in conn.smembers(_series_key())
+    ]
+    conn.delete(_series_key(), *keys)
+
+
+###
+# celery signals
+###
+
+@before_task_publish.connect
+def add_enqueued_at(headers: dict = None, **kwargs):
+    if metrics_enabled() and headers is not None:
+        headers[ENQUEUED_AT_HEADER] = time()
+
+
+@task_prerun.connect
+def task_started(task_id: str, task, **kwargs):
+    if not metrics_enabled():
+        return
+    profile, token = start_profiling()
+    _running[task_id] = (perf_counter(), time(), profile, token)
+
+
+@task_postrun.connect
+def task_finished(task_id: str, task, retval=None, state: str = None, **kwargs):
+    running = _running.pop(task_id, None)
+    if running is None:
+        return
+    start, started_at, profile, token = running
+    run_time = perf_counter() - start
+    stop_profiling(token)
+
+    try:
+        observations = {
+            'chat_task_run_seconds': run_time,
+            'chat_task_db_seconds': profile.durations['db'],
+            'chat_task_result_bytes': len(json.dumps(retval, default=str)),
+        }
+        # the message headers are request attributes in the workers,
+        # in 'request.headers' when the task is applied with 'headers'
+        enqueued_at = getattr(task.request, ENQUEUED_AT_HEADER, None) \
+            or (task.request.headers or {}).get(ENQUEUED_AT_HEADER)
+        if enqueued_at is not None:
+            observations['chat_task_queue_wait_seconds'] = max(0.0, started_at - float(enqueued_at))
+        record_task(task.name, get_task_queue(task), state or 'UNKNOWN', observations)
+    except Exception as ex:
+        # the metrics never fail a task
+        logger.warning('task metrics of %s not recorded: %s', task.name, ex)
@@ -2,31 +2,39 @@ from __future__ import absolute_import, unicode_literals
 from time import sleep
 import traceback
 
-from jbl_chat.celery import shared_task
+from jbl_chat.celery import app as celery_app, shared_task
+from jbl_chat.routers import reads_from_primary
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Q
 from django.core.exceptions import PermissionDenied
 from celery import Celery, current_task
 from celery.states import FAILURE, SUCCESS, PENDING
 from celery.exceptions import Ignore
 
-from chat.models import ChatRoom, Message, SeenMessage
+from chat.models import ChangeLog, ChatRoom, Message, SeenMessage
 from chat.serializers import ChatRoomSerializer, MessageSerializer
+from chat.changes import record_change
+from chat.cleanup import delete_room, delete_user
+from chat.inbox import fan_out_message, clear_inbox
+from chat.outbox import add_message_event
+from chat.receipts import release_msg_as_seen
+from chat.recent import push_recent_message
+from chat.sequences import mark_read, next_seq
+from chat.sharding import room_db
 
 ## LOGGING
 import logging
 logger = logging.getLogger(__name__)
 
-celery_app = Celery('jbl_chat')
-
 @celery_app.task(bind=True)
+@reads_from_primary
 def send_direct_message(self, data: dict, user_id: int) -> dict:
     """Async task that send a message to a user
 
     Args:
         data (dict): data containing the body of the request
         user_id (int): user id of the receiver
-        default_db (str, optional): It's a bit tricky but it force celery to use the test DB during tests. Defaults to 'default'.
 
     Raises:
         ex: Exception
@@ -56,11 +64,19 @@ def send_direct_message(self, data: dict, user_id: int) -> dict:
             receiver=receiver, sender=sender
         )
 
-        msg = Message.objects.create(
-            room=cr,
-            msg_from=sender,
-            text=data['text']
-        )
+        with transaction.atomic(using=room_db(cr)):
+            msg = Message.objects.using(room_db(cr)).create(
+                room=cr,
+                msg_from=sender,
+                text=data['text'],
+                seq=next_seq(cr.id, room_db(cr))
+            )
+            # the sender has read up to its own message
+            mark_read(cr.id, sender.id, msg.seq, room_db(cr))
+            add_message_event(msg, room_db(cr))
+            fan_out_message(msg, [sender.id, receiver.id])
+            record_change(ChangeLog.Kind.message, cr.id, sender.id, msg.id, db=room_db(cr))
+        push_recent_message(msg)
 
         # update task status
         meta['status'] = 'DONE SENDING DIRECT MESSAGE'
@@ -89,13 +105,13 @@ def send_direct_message(self, data: dict, user_id: int) -> dict:
         raise Ignore()
 
 @celery_app.task(bind=True)
+@reads_from_primary
 def send_group_message(self, data: dict, group_id: int) -> dict:
     """Async task that send a message to a chat room (group)
 
     Args:
         data (dict): data containing the body of the request
         group_id (int): id of the of the receiver chat room
-        default_db (str, optional): It's a bit tricky but it force celery to use the test DB during tests. Defaults to 'default'.
 
     Raises:
         ex: Exception
@@ -107,7 +123,7 @@ def send_group_message(self, data: dict, group_id: int) -> dict:
         logger.info("starting send group msg task")
 
         sender: User = User.objects.get(pk=data['from'])
-        receiver: ChatRoom = ChatRoom.objects.get(pk=group_id)
+        receiver: ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
 
         # update task status
         meta={
@@ -120,19 +136,29 @@ def send_group_message(self, data: dict, group_id: int) -> dict:
             meta=meta
         )
 
-        # if sender is not part of the group
-        if sender not in ChatRoomSerializer().get_room_members(
+        member_ids = list(ChatRoomSerializer().get_room_members(
             receiver, get_queryset=True
-            ):
+        ).values_list('id', flat=True))
+
+        # if sender is not part of the group
+        if sender.id not in member_ids:
 
             logger.warn("User %s doesn't belong to chatroom %s", sender.username, receiver.room_name)
             raise PermissionDenied("User doesn't belong to chatroom")
 
-        msg = Message.objects.create(
-            room=receiver,
-            msg_from=sender,
-            text=data['text']
-        )
+        with transaction.atomic(using=room_db(receiver)):
+            msg = Message.objects.using(room_db(receiver)).create(
+                room=receiver,
+                msg_from=sender,
+                text=data['text'],
+                seq=next_seq(receiver.id, room_db(receiver))
+            )
+            # the sender has read up to its own message
+            mark_read(receiver.id, sender.id, msg.seq, room_db(receiver))
+            add_message_event(msg, room_db(receiver))
+            fan_out_message(msg, member_ids)
+            record_change(ChangeLog.Kind.message, receiver.id, sender.id, msg.id, db=room_db(receiver))
+        push_recent_message(msg)
 
         # update task status
         meta['status'] = 'DONE SENDING GROUP MESSAGE'
@@ -164,6 +190,7 @@ def send_group_message(self, data: dict, group_id: int) -> dict:
 
 
 @celery_app.task(bind=True)
+@reads_from_primary
 def set_msg_as_seen(self, chat_room_id: int, reader_id: int) -> dict:
     """Async task that set all retrieved messages as seen
        it's applied only for those message the the reader_id hadn't already read and those that werent sent by himself
@@ -171,7 +198,6 @@ def set_msg_as_seen(self, chat_room_id: int, reader_id: int) -> dict:
     Args:
         chat_room_id (int)
         reader_id (int)
-        default_db (str, optional): It's a bit tricky but it force celery to use the test DB during tests. Defaults to 'default'.
 
     Raises:
         ex: Exception
@@ -181,11 +207,14 @@ def set_msg_as_seen(self, chat_room_id: int, reader_id: int) -> dict:
     """
     try:
         logger.info("starting task to set msgs as seen task")
-        
+        # the next requests of the reader enqueue a new job
+        release_msg_as_seen(chat_room_id, reader_id, self.request.id)
+
         reader: User = User.objects.get(pk=reader_id)
 
         # get the chatroom and therelated messages
-        user_chat_room = ChatRoom.objects.using('default').prefetch_related(
+        db = room_db(chat_room_id)
+        user_chat_room = ChatRoom.objects.using(db).prefetch_related(
             'message_set'
         ).get(pk=chat_room_id)
 
@@ -212,7 +241,15 @@ def set_msg_as_seen(self, chat_room_id: int, reader_id: int) -> dict:
             )
 
             logger.info('set msg %s as seen' % new_msg.id)
-            SeenMessage.objects.update_or_create(message=new_msg, seen_by=reader)
+            SeenMessage.objects.using(db).update_or_create(message=new_msg, seen_by=reader)
+
+        # seen messages are no more pending in the reader inbox
+        if total:
+            last_seen_id = max(m.id for m in msg_not_seen_by_me)
+            with transaction.atomic(using=db):
+                mark_read(chat_room_id, reader_id, max(m.seq or 0 for m in msg_not_seen_by_me), db)
+                clear_inbox(chat_room_id, reader_id, last_seen_id)
+                record_change(ChangeLog.Kind.seen, chat_room_id, reader_id, last_seen_id, db=db)
 
         logger.info("task finished")
         
@@ -231,4 +268,42 @@ def set_msg_as_seen(self, chat_room_id: int, reader_id: int) -> dict:
                 'exc_type': type(ex).__name__,
             }
         )
-        raise Ignore()
\ No newline at end of file
+        raise Ignore()
+
+@celery_app.task(bind=True)
+@reads_from_primary
+def delete_chatroom_data(self, room_id: int, db: str = None) -> dict:
+    """Async task that deletes an empty chat room and its messages, in
+       bounded chunks whatever the size of the room
+
+    Args:
+        room_id (int)
+        db (str): db alias of the room (its shard)
+
+    Returns:
+        dict: deleted rows by model name
+    """
+    def progress(model_name: str, deleted: int):
+        self.update_state(state=PENDING, meta={'deleting': model_name, 'deleted': deleted})
+
+    logger.info("starting task to delete chat room %s", room_id)
+    return delete_room(room_id, db, progress)
+
+
+@celery_app.task(bind=True)
+@reads_from_primary
+def delete_user_data(self, user_id: int) -> dict:
+    """Async task that deletes a user with its receipts, inbox and
+       memberships, its messages are kept without sender
+
+    Args:
+        user_id (int)
+
+    Returns:
+        dict: deleted (or updated) rows by model name
+    """
+    def progress(model_name: str, deleted: int):
+        self.update_state(state=PENDING, meta={'deleting': model_name, 'deleted': deleted})
+
+    logger.info("starting task to delete user %s", user_id)
+    return delete_user(user_id, progress)
@@ -0,0 +1,101 @@
+import asyncio
+import json
+from time import monotonic
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import AsyncClient, AsyncRequestFactory, RequestFactory, TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import QUERY_COUNT_HEADER
+from .. import urls as chat_urls
+from ..models import ChatRoom, Message
+from ..views.async_views import async_read_view
+#
+
+
+@override_settings(TESTING=True)
+class AsyncViewsTestCase(TransactionTestCase):
+    """
+        * test_0001_async_reads      : chat GET endpoints        : GET : Test the async views answer like the sync ones
+
+        * test_0002_long_poll        : chat__get_unseen_messages : GET : Test the poll waits for new messages with ?wait=<s>
+
+        * test_0003_async_middleware : chat__get_create_chat     : GET : Test the middlewares run in the async handler
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create(username='async_reader', password='test')
+        self.sender = User.objects.create(username='async_sender', password='test')
+        self.room = ChatRoom.objects.create(room_name='async_room', is_direct=False)
+        self.room.room_member.add(self.reader, self.sender)
+        Message.objects.create(room=self.room, msg_from=self.sender, text='hi')
+        super(AsyncViewsTestCase, self).setUp()
+
+    def read_requests(self):
+        # the django 3.2 AsyncRequestFactory ignores the 'data' of GET requests
+        qs = '?user_id={}'.format(self.reader.id)
+        return [
+            (chat_urls.chatroom_list_create, reverse('chat__get_create_chat'), {}),
+            (chat_urls.leave_join_read_chatroom, reverse('chat__join_leave_read_chat', args=(self.room.id,)), {'group_id': self.room.id}),
+            (chat_urls.message_read, reverse('chat__get_room_messages', args=(self.room.id,)), {'group_id': self.room.id}),
+            (chat_urls.messages_unseen_read, reverse('chat__get_unseen_messages'), {}),
+            (chat_urls.message_status, reverse('chat__get_message_status', args=('task-id',)), {'task_id': 'task-id'}),
+        ], qs
+
+    async def test_0001_async_reads(self):
+        views, qs = self.read_requests()
+        for view, url, kwargs in views:
+            with self.subTest(url=url):
+                async_view = async_read_view(view)
+                self.assertTrue(asyncio.iscoroutinefunction(async_view))
+
+                expected = await sync_to_async(view)(RequestFactory().get(url + qs), **kwargs)
+                expected.render()
+                response = await async_view(AsyncRequestFactory().get(url + qs), **kwargs)
+                self.assertEqual(response.status_code, expected.status_code)
+                if 'unseen' not in url and 'messages' not in url:
+                    self.assertEqual(json.loads(response.content), json.loads(expected.content))
+
+        # the other methods are served by the sync view
+        joiner = await sync_to_async(User.objects.create)(username='async_joiner', password='test')
+        url = reverse('chat__join_leave_read_chat', args=(self.room.id,))
+        async_view = async_read_view(chat_urls.leave_join_read_chatroom)
+        response = await async_view(
+            AsyncRequestFactory().put('{}?user_id={}'.format(url, joiner.id)), group_id=self.room.id
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await sync_to_async(self.room.room_member.filter(pk=joiner.pk).exists)())
+
+    @override_settings(CHAT_POLL_INTERVAL=0.05)
+    async def test_0002_long_poll(self):
+        poll = async_read_view(chat_urls.messages_unseen_read, long_poll=True)
+        url = reverse('chat__get_unseen_messages')
+
+        # sender has no unseen message, waits until the end
+        start = monotonic()
+        response = await poll(AsyncRequestFactory().get('{}?user_id={}&wait=0.3'.format(url, self.sender.id)))
+        self.assertGreaterEqual(monotonic() - start, 0.3)
+        self.assertEqual(json.loads(response.content)['data'][0]['messages'], [])
+
+        # answers as soon as a message arrives
+        async def send_later():
+            await asyncio.sleep(0.2)
+            await sync_to_async(Message.objects.create)(room=self.room, msg_from=self.reader, text='there')
+
+        start = monotonic()
+        response, _ = await asyncio.gather(
+            poll(AsyncRequestFactory().get('{}?user_id={}&wait=5'.format(url, self.sender.id))),
+            send_later()
+        )
+        self.assertLess(monotonic() - start, 5)
+        self.assertEqual(json.loads(response.content)['data'][0]['messages'][0]['text'], 'there')
+
+    @override_settings(CHAT_PROFILING=True, CHAT_PROFILING_SAMPLE_RATE=1.0, CHAT_QUERY_COUNT_HEADER=True)
+    async def test_0003_async_middleware(self):
+        response = await AsyncClient().get('{}?user_id={}'.format(reverse('chat__get_create_chat'), self.reader.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response[QUERY_COUNT_HEADER]), 0)
+        self.assertIn('db;dur=', response['Server-Timing'])
@@ -0,0 +1,98 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from ..models import ChatRoom, Membership, Message
+#
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_BATCH_MAX_REQUESTS=5)
+class BatchTestCase(TransactionTestCase):
+    """
+        * test_0001_batch          : batch : POST : Test the sub-requests responses are returned in order, the same as the single requests
+
+        * test_0002_parallel_reads : batch : POST : Test the reads run concurrently and the writes are seen by the next sub-requests
+
+        * test_0003_errors         : batch : POST : Test the invalid batches and the per sub-request errors
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='batch1', password='test')
+        self.user2 = User.objects.create(username='batch2', password='test')
+        self.room = ChatRoom.objects.create(room_name='batch', is_direct=False, last_seq=1)
+        Membership.objects.create(user=self.user1, chatroom=self.room)
+        Membership.objects.create(user=self.user2, chatroom=self.room)
+        Message.objects.create(room=self.room, msg_from=self.user2, text='hello', seq=1)
+        super(BatchTestCase, self).setUp()
+
+    def batch(self, data):
+        return self.client.post(reverse('batch'), data=json.dumps(data), content_type='application/json')
+
+    def screen_load(self):
+        return [
+            {'method': 'GET', 'url': reverse('authentication__list')},
+            {'method': 'GET', 'url': '{}?user_id={}'.format(reverse('chat__get_create_chat'), self.user1.id)},
+            {'method': 'GET', 'url': '{}?user_id={}'.format(
+                reverse('chat__get_room_messages', args=(self.room.id,)), self.user1.id
+            )},
+        ]
+
+    def test_0001_batch(self):
+        response = self.batch({'requests': self.screen_load()})
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()['data']
+
+        self.assertEqual([sub['status'] for sub in data], [200, 200, 200])
+        self.assertEqual(
+            [user['username'] for user in data[0]['body']['results']],
+            ['batch1', 'batch2']
+        )
+        self.assertEqual([cr['room_name'] for cr in data[1]['body']['data']], ['batch'])
+        self.assertEqual([msg['text'] for msg in data[2]['body']['data']['messages']], ['hello'])
+
+        # the same as the single request (the others changed, the messages are now read)
+        self.assertEqual(self.client.get(self.screen_load()[0]['url']).json(), data[0]['body'])
+        self.assertEqual(data[1]['body']['data'][0]['unread'], 1)
+
+        # a bare list of requests
+        response = self.batch(self.screen_load()[:1])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['data']), 1)
+
+    def test_0002_parallel_reads(self):
+        messages_url = '{}?user_id={}'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user2.id
+        )
+        response = self.batch({'parallel': True, 'requests': self.screen_load() + [
+            {'method': 'POST', 'url': reverse('chat__message_group_create', args=(self.room.id,)),
+             'body': {'from': self.user1.id, 'text': 'from the batch'}},
+            {'method': 'GET', 'url': messages_url},
+        ]})
+        self.assertEqual(response.status_code, 200, response.content)
+        data = response.json()['data']
+
+        self.assertEqual([sub['status'] for sub in data], [200] * 5)
+        self.assertEqual([msg['text'] for msg in data[2]['body']['data']['messages']], ['hello'])
+        self.assertEqual(
+            [msg['text'] for msg in data[4]['body']['data']['messages']],
+            ['hello', 'from the batch']
+        )
+
+    def test_0003_errors(self):
+        for data in ({'requests': []}, {'requests': [{'url': 'chat/'}]},
+                     {'requests': [{'method': 'TRACE', 'url': '/chat/'}]},
+                     {'requests': self.screen_load() * 2}):
+            response = self.batch(data)
+            self.assertEqual(response.status_code, 400, data)
+
+        response = self.batch({'requests': [
+            {'url': '/not/a/url/'},
+            {'method': 'POST', 'url': reverse('batch'), 'body': {'requests': self.screen_load()}},
+            {'url': '{}?user_id=0'.format(reverse('chat__get_create_chat'))},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([sub['status'] for sub in response.json()['data']], [404, 400, 404])
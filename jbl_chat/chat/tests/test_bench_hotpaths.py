@@ -0,0 +1,55 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TransactionTestCase, override_settings
+#
+
+
+@override_settings(TESTING=True)
+class BenchHotPathsTestCase(TransactionTestCase):
+    """
+        * test_0001_bench_hotpaths : bench_hotpaths : Test timings and query counts of the hot paths and the regressions check
+
+    """
+
+    def bench(self, **options):
+        call_command(
+            'bench_hotpaths', users=20, rooms=6, messages=60, repeat=2,
+            stdout=StringIO(), **options
+        )
+
+    def test_0001_bench_hotpaths(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'baseline.json')
+            self.bench(output=output)
+            with open(output) as f:
+                results = json.load(f)
+
+            self.assertEqual(set(results), {
+                'base_message_list', 'direct_chat', 'member_chat_rooms',
+                'membership_save', 'message_list', 'room_members'
+            })
+            for result in results.values():
+                self.assertGreater(result['queries'], 0)
+                self.assertLessEqual(result['min_ms'], result['median_ms'])
+            # the seeded data is rolled back
+            self.assertFalse(User.objects.exists())
+
+            ###
+            # same code, no regression with a large threshold
+            ###
+            self.bench(baseline=output, threshold=100)
+
+            ###
+            # a baseline with less queries fails
+            ###
+            results['membership_save']['queries'] -= 1
+            with open(output, 'w') as f:
+                json.dump(results, f)
+            with self.assertRaisesMessage(CommandError, 'membership_save'):
+                self.bench(baseline=output, threshold=100)
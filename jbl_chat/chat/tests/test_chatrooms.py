@@ -15,6 +15,8 @@ class ChatRoomTestCase(TransactionTestCase):
 
         * test_0002_join_leave_a_chatroom   : chat__join_leave_read_chat   : PUT-DELETE : Test chatroom joining and leaving
 
+        * test_0003_bulk_join_leave         : chat__bulk_members           : POST-DELETE : Test many users joining and leaving at once
+
     """
 
 
@@ -25,6 +27,7 @@ class ChatRoomTestCase(TransactionTestCase):
         cls.client = Client()
         cls.test1_API = 'chat__get_create_chat'
         cls.test2_API = 'chat__join_leave_read_chat'
+        cls.test3_API = 'chat__bulk_members'
 
         super(TransactionTestCase, cls).setUpClass()
 
@@ -197,4 +200,76 @@ class ChatRoomTestCase(TransactionTestCase):
         )
         url = '{}{}{}'.format(url, '?user_id=', self.user2.id)
         response = self.client.put(url)
-        self.assertEqual(response.status_code, 400)
\ No newline at end of file
+        self.assertEqual(response.status_code, 400)
+
+    def test_0003_bulk_join_leave(self):
+        url = reverse(
+            self.test3_API,
+            args=(self.roomFriend.id,)
+        )
+
+        ###
+        # Users 2 and 3 join by id and username, user 1 is already a member
+        # and 'ghost' doesn't exist
+        ###
+        payload = {
+            "user_ids": [self.user1.id, self.user2.id],
+            "usernames": [self.user3.username, 'ghost'],
+        }
+        response = self.client.post(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        outcomes = {el.get('username', el.get('user')): el['outcome'] for el in response.json()['data']}
+        self.assertEqual(outcomes, {
+            'user1': 'already_member',
+            'user2': 'joined',
+            'user3': 'joined',
+            'ghost': 'not_found',
+        })
+        self.assertEqual(
+            set(self.roomFriend.room_member.filter(membership__date_lefted__isnull=True).values_list('username', flat=True)),
+            {'user1', 'user2', 'user3', 'user4'}
+        )
+
+        ###
+        # Users 1 and 2 leave, the chatroom still exists
+        ###
+        payload = {"user_ids": [self.user1.id, self.user2.id]}
+        response = self.client.delete(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([el['outcome'] for el in response.json()['data']], ['left', 'left'])
+
+        # user 1 can't read the chatroom anymore, user 3 can
+        url_read = reverse(self.test2_API, args=(self.roomFriend.id,))
+        response = self.client.get('{}?user_id={}'.format(url_read, self.user1.id))
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get('{}?user_id={}'.format(url_read, self.user3.id))
+        self.assertEqual(response.status_code, 200)
+
+        ###
+        # The last members leave, the chatroom is deleted
+        ###
+        payload = {"user_ids": [self.user2.id, self.user3.id, self.user4.id]}
+        response = self.client.delete(url, data=payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([el['outcome'] for el in response.json()['data']], ['not_member', 'left', 'left'])
+        self.assertFalse(ChatRoom.objects.filter(pk=self.roomFriend.id).exists())
+
+        ###
+        # Wrong bodies and private chatrooms, expected errors
+        ###
+        url = reverse(
+            self.test3_API,
+            args=(self.roomFamily.id,)
+        )
+        response = self.client.post(url, data={"user_ids": ['x']}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url, data={}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        private_chat_room, _ = ChatRoom.objects.get_or_create(room_name='private', is_direct=True)
+        url = reverse(
+            self.test3_API,
+            args=(private_chat_room.id,)
+        )
+        response = self.client.post(url, data={"user_ids": [self.user2.id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,110 @@
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import count_queries
+from ..models import ChatRoom, InboxEntry, Membership, Message, SeenMessage
+from ..tasks import delete_chatroom_data
+#
+
+
+@override_settings(TESTING=True, CHAT_DELETE_CHUNK_SIZE=7)
+class CleanupTestCase(TransactionTestCase):
+    """
+        * test_0001_delete_room_in_chunks : delete_chatroom_data  :        : Test a room and its data are deleted in chunks
+
+        * test_0002_last_member_leaves    : chat__join_leave_read_chat : DELETE : Test the empty room is deleted by the job
+
+        * test_0003_delete_user           : authentication__details    : DELETE : Test a user and its chat data are deleted by the job
+
+        * test_0004_queued_after_commit   : chat__join_leave_read_chat : DELETE : Test the empty room job is queued once the leave is committed
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='cleanup1', password='test')
+        self.user2 = User.objects.create(username='cleanup2', password='test')
+        self.room = ChatRoom.objects.create(room_name='cleanup', is_direct=False)
+        self.room.room_member.add(self.user1, self.user2)
+        self.other_room = ChatRoom.objects.create(room_name='cleanup_other', is_direct=False)
+        self.other_room.room_member.add(self.user1)
+
+        for room in (self.room, self.other_room):
+            for i in range(30):
+                msg = Message.objects.create(room=room, msg_from=self.user1, text=str(i))
+                SeenMessage.objects.create(message=msg, seen_by=self.user2)
+                InboxEntry.objects.create(user=self.user2, room=room, message=msg)
+        super(CleanupTestCase, self).setUp()
+
+    def test_0001_delete_room_in_chunks(self):
+        # someone is still in, nothing is deleted
+        job = delete_chatroom_data.apply(kwargs={'room_id': self.room.id})
+        self.assertEqual(job.result, {})
+        self.assertTrue(ChatRoom.objects.filter(pk=self.room.id).exists())
+
+        Membership.objects.filter(chatroom=self.room).update(date_lefted='2022-01-01T00:00Z')
+        with count_queries() as counter:
+            job = delete_chatroom_data.apply(kwargs={'room_id': self.room.id})
+        self.assertEqual(job.result, {
+            'inboxentry': 30, 'seenmessage': 30, 'message': 30, 'membership': 2, 'chatroom': 1,
+        })
+        # 5 chunks (of 7) + the empty lookup for each model of the room
+        self.assertGreater(counter[0], 3 * (5 + 1))
+
+        self.assertFalse(ChatRoom.objects.filter(pk=self.room.id).exists())
+        self.assertFalse(Message.objects.filter(room_id=self.room.id).exists())
+        self.assertFalse(SeenMessage.objects.filter(message__room_id=self.room.id).exists())
+        self.assertFalse(Membership.objects.filter(chatroom_id=self.room.id).exists())
+        # the other room is untouched
+        self.assertEqual(Message.objects.filter(room=self.other_room).count(), 30)
+        self.assertEqual(SeenMessage.objects.filter(message__room=self.other_room).count(), 30)
+
+    def test_0002_last_member_leaves(self):
+        url = reverse('chat__join_leave_read_chat', args=(self.other_room.id,))
+        response = self.client.delete('{}?user_id={}'.format(url, self.user1.id))
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(ChatRoom.objects.filter(pk=self.other_room.id).exists())
+        self.assertFalse(Message.objects.filter(room_id=self.other_room.id).exists())
+
+        # the membership signals still work after a room deletion
+        url = reverse('chat__join_leave_read_chat', args=(self.room.id,))
+        response = self.client.delete('{}?user_id={}'.format(url, self.user2.id))
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(Membership.objects.filter(
+            chatroom=self.room, user=self.user2, date_lefted__isnull=False
+        ).exists())
+        self.assertTrue(ChatRoom.objects.filter(pk=self.room.id).exists())
+
+    def test_0003_delete_user(self):
+        response = self.client.delete(reverse('authentication__details', args=(self.user1.id,)))
+        self.assertEqual(response.status_code, 202)
+        self.assertIn('task_id', response.json())
+
+        self.assertFalse(User.objects.filter(pk=self.user1.id).exists())
+        self.assertFalse(Membership.objects.filter(user_id=self.user1.id).exists())
+        # user 1 was alone in the other room
+        self.assertFalse(ChatRoom.objects.filter(pk=self.other_room.id).exists())
+        # its messages stay in the room of user 2, without sender
+        self.assertEqual(Message.objects.filter(room=self.room, msg_from__isnull=True).count(), 30)
+        self.assertEqual(SeenMessage.objects.filter(seen_by=self.user2).count(), 30)
+
+    @override_settings(TESTING=False)
+    def test_0004_queued_after_commit(self):
+        queued = []
+
+        def apply_async(kwargs):
+            # what a worker picking the job at once would see
+            queued.append((connection.in_atomic_block, Membership.objects.filter(
+                chatroom_id=kwargs['room_id'], date_lefted__isnull=True
+            ).exists()))
+            return MagicMock(id='task-id')
+
+        url = reverse('chat__join_leave_read_chat', args=(self.other_room.id,))
+        with patch.object(delete_chatroom_data, 'apply_async', side_effect=apply_async):
+            response = self.client.delete('{}?user_id={}'.format(url, self.user1.id))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(queued, [(False, False)])
@@ -0,0 +1,49 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import QUERY_COUNT_HEADER
+#
+
+
+@override_settings(TESTING=True, CHAT_QUERY_COUNT_HEADER=True)
+class LoadTestTestCase(TransactionTestCase):
+    """
+        * test_0001_query_count_header : chat__get_create_chat : GET : Test the db queries count header
+
+        * test_0002_loadtest           : loadtest              :     : Test the mixed workload results by endpoint
+
+    """
+
+    def setUp(self):
+        call_command('seed_chat', users=20, rooms=10, messages=30, stdout=StringIO())
+        super(LoadTestTestCase, self).setUp()
+
+    def test_0001_query_count_header(self):
+        response = self.client.get(reverse('chat__get_create_chat'))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response[QUERY_COUNT_HEADER]), 0)
+
+    def test_0002_loadtest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            out = StringIO()
+            call_command(
+                'loadtest', requests=20, concurrency=2, output=output, stdout=out
+            )
+            call_command(
+                'loadtest', requests=10, concurrency=2, compare=output, stdout=out
+            )
+            with open(output) as f:
+                results = json.load(f)
+
+        self.assertEqual(results['total']['requests'], 20)
+        self.assertEqual(results['total']['errors'], 0)
+        for endpoint in results['endpoints'].values():
+            self.assertLessEqual(endpoint['p50_ms'], endpoint['p99_ms'])
+            self.assertGreater(endpoint['queries_mean'], 0)
+        self.assertIn('compared with', out.getvalue())
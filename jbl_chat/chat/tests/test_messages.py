@@ -5,7 +5,7 @@ from django.test import Client
 from django.contrib.auth.models import User
 from django.urls import reverse
 from celery.result import EagerResult
-from ..models import ChatRoom, Message
+from ..models import ChatRoom, InboxEntry, Message
 from celery import Celery
 celery_app = Celery('jbl_chat')
 #
@@ -19,7 +19,9 @@ class MessagesTestCase(TransactionTestCase):
 
         * test_0003_read_message_by_room     : chat__get_room_messages   : GET  : Test reading message and set as seen
 
-        * test_0004_read_all_unseen_messages : chat__get_unseen_messages : GET  : Test reading all and only unreaded messages and set as seen
+        * test_0004_read_all_unseen_messages : chat__get_unseen_messages : GET  : Test reading all and only unreaded messages (inbox and fan-out-on-read) and set as seen
+
+        * test_0005_late_joiner_inbox        : chat__join_leave_read_chat: PUT  : Test a user joining a fan-out-on-write room gets its earlier messages as unseen
 
     """
 
@@ -256,10 +258,82 @@ class MessagesTestCase(TransactionTestCase):
 
 
     def test_0004_read_all_unseen_messages(self):
-        pass
+        ###
+        # Chat from user1 to 'family' (fan-out-on-write, message lands
+        # in the inboxes) and to 'friends' (fan-out-on-read)
+        ###
+        Message.objects.all().delete()
+        payload = {
+            "from": self.user1.id,
+            "text": "hi family"
+        }
+        url = reverse(self.test2_API, args=(self.roomFamily.id,))
+        response = self.client.post(url, data=payload)
+        self.assertEqual(response.status_code, 200)
+
+        with override_settings(CHAT_INBOX_FANOUT_THRESHOLD=0):
+            payload['text'] = "hi friends"
+            url = reverse(self.test2_API, args=(self.roomFriend.id,))
+            response = self.client.post(url, data=payload)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertTrue(Message.objects.get(text="hi family").fanned_out)
+        self.assertFalse(Message.objects.get(text="hi friends").fanned_out)
+
+        ###
+        # user2 and user4 read their unseen messages from both sources
+        ###
+        url = reverse(self.test4_API)
+        for reader, text in ((self.user2, "hi family"), (self.user4, "hi friends")):
+            response = self.client.get('{}{}{}'.format(url, '?user_id=', reader.id))
+            self.assertEqual(response.status_code, 200)
+            res = response.json()
+            unseen = [msg['text'] for room in res['data'] for msg in room['messages']]
+            self.assertEqual(unseen, [text])
 
+        ###
+        # messages were set as seen, reading again returns nothing
+        ###
+        for reader in (self.user2, self.user4):
+            response = self.client.get('{}{}{}'.format(url, '?user_id=', reader.id))
+            res = response.json()
+            unseen = [msg['text'] for room in res['data'] for msg in room['messages']]
+            self.assertEqual(unseen, [])
+        self.assertFalse(InboxEntry.objects.filter(user=self.user2).exists())
 
+        ###
+        # the sender doesn't see its own messages as unseen
+        ###
+        response = self.client.get('{}{}{}'.format(url, '?user_id=', self.user1.id))
+        res = response.json()
+        unseen = [msg['text'] for room in res['data'] for msg in room['messages']]
+        self.assertEqual(unseen, [])
 
+    def test_0005_late_joiner_inbox(self):
+        Message.objects.all().delete()
+        url = reverse(self.test2_API, args=(self.roomFamily.id,))
+        for text in ("before 1", "before 2"):
+            response = self.client.post(url, data={"from": self.user1.id, "text": text})
+            self.assertEqual(response.status_code, 200)
+        self.assertTrue(all(Message.objects.values_list('fanned_out', flat=True)))
 
+        ###
+        # user4 joins 'family' after the messages were fanned out
+        ###
+        url = reverse('chat__join_leave_read_chat', args=(self.roomFamily.id,))
+        response = self.client.put('{}?user_id={}'.format(url, self.user4.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(InboxEntry.objects.filter(user=self.user4).count(), 2)
 
+        url = reverse(self.test4_API)
+        response = self.client.get('{}?user_id={}'.format(url, self.user4.id))
+        unseen = [msg['text'] for room in response.json()['data'] for msg in room['messages']]
+        self.assertEqual(unseen, ["before 1", "before 2"])
 
+        ###
+        # leaving and joining again doesn't bring back the seen messages
+        ###
+        url = reverse('chat__join_leave_read_chat', args=(self.roomFamily.id,))
+        self.client.delete('{}?user_id={}'.format(url, self.user4.id))
+        self.client.put('{}?user_id={}'.format(url, self.user4.id))
+        self.assertFalse(InboxEntry.objects.filter(user=self.user4).exists())
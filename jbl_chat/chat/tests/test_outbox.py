@@ -0,0 +1,145 @@
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+from redis.exceptions import ResponseError
+from ..memberships import bulk_join
+from ..models import ChatRoom, Membership, OutboxEvent
+from ..outbox import EVENTS_STREAM, add_membership_events, consume_events, relay_outbox
+#
+
+
+def streams_supported() -> bool:
+    # redis >= 5
+    try:
+        get_redis_connection('default').xlen(EVENTS_STREAM)
+        return True
+    except ResponseError:
+        return False
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_OUTBOX_BATCH_SIZE=2)
+class OutboxTestCase(TransactionTestCase):
+    """
+        * test_0001_outbox_events : chat__message_group_create : POST : Test the events are written with the message and membership changes, and rolled back with them
+
+        * test_0002_relay         : -                          : -    : Test the relay publishes the events in order to the stream and the consumer groups ack them
+
+        * test_0003_relay_batches : -                          : -    : Test the relay drains the outbox in id order by batches, deleting only the published events
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='outbox1', password='test')
+        self.user2 = User.objects.create(username='outbox2', password='test')
+        self.user3 = User.objects.create(username='outbox3', password='test')
+        self.room = ChatRoom.objects.create(room_name='outbox', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=self.room)
+        super(OutboxTestCase, self).setUp()
+
+    def send(self, user, text):
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(self.room.id,)),
+            data={'from': user.id, 'text': text}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def make_events(self):
+        url = reverse('chat__join_leave_read_chat', args=(self.room.id,))
+        self.client.put('{}?user_id={}'.format(url, self.user2.id))
+        self.send(self.user1, 'hello')
+        self.client.delete('{}?user_id={}'.format(url, self.user2.id))
+
+    def test_0001_outbox_events(self):
+        self.make_events()
+        events = list(OutboxEvent.objects.order_by('id'))
+        self.assertEqual(
+            [(event.kind, event.room_id) for event in events],
+            [('join', self.room.id), ('message', self.room.id), ('leave', self.room.id)]
+        )
+        self.assertEqual(events[0].payload, {'user': self.user2.id})
+        self.assertEqual(events[1].payload['text'], 'hello')
+        self.assertEqual(events[1].payload['seq'], 1)
+
+        # no change, no event
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                bulk_join(self.room, [self.user3])
+                raise RuntimeError('rolled back')
+        self.assertEqual(OutboxEvent.objects.count(), 3)
+        self.assertFalse(Membership.objects.filter(user=self.user3).exists())
+
+    @skipUnless(streams_supported(), "the redis server has no streams")
+    def test_0002_relay(self):
+        conn = get_redis_connection('default')
+        conn.delete(EVENTS_STREAM)
+        self.make_events()
+
+        # in batches of CHAT_OUTBOX_BATCH_SIZE, the outbox is drained
+        self.assertEqual(relay_outbox(), 3)
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(relay_outbox(), 0)
+
+        received = []
+        self.assertEqual(consume_events('test', 'worker', received.extend, count=2), 2)
+        self.assertEqual([event['kind'] for event in received], ['join', 'message'])
+        self.assertEqual(received[1]['payload']['text'], 'hello')
+
+        # a failed handler leaves the events pending, they come back first
+        def fail(events):
+            raise ValueError('handler failed')
+        with self.assertRaises(ValueError):
+            consume_events('test', 'worker', fail)
+        self.assertEqual(consume_events('test', 'worker', received.extend), 1)
+        self.assertEqual([event['kind'] for event in received], ['join', 'message', 'leave'])
+        self.assertEqual(consume_events('test', 'worker', received.extend), 0)
+
+        # another group reads the stream from the start
+        other = []
+        consume_events('other', 'worker', other.extend)
+        self.assertEqual([event['id'] for event in other], [event['id'] for event in received])
+
+    def test_0003_relay_batches(self):
+        other = ChatRoom.objects.create(room_name='outbox_other', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=other)
+
+        # the events of a room are inserted holding its row lock
+        with CaptureQueriesContext(connection) as ctx:
+            with transaction.atomic():
+                add_membership_events(OutboxEvent.Kind.join, other.id, [self.user2.id])
+        sqls = [query['sql'] for query in ctx.captured_queries]
+        lock = next(i for i, sql in enumerate(sqls) if 'FROM "chat_chatroom"' in sql)
+        insert = next(i for i, sql in enumerate(sqls) if 'INSERT INTO "chat_outboxevent"' in sql)
+        self.assertLess(lock, insert)
+
+        self.make_events()
+        ids = list(OutboxEvent.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(len(ids), 4)
+
+        # a failed publish deletes nothing and releases the shard
+        def fail(events, db):
+            raise ConnectionError('redis down')
+        with self.assertRaises(ConnectionError):
+            relay_outbox(publish=fail)
+        self.assertEqual(OutboxEvent.objects.count(), 4)
+
+        batches = []
+        def publish(events, db):
+            # published before being deleted
+            self.assertEqual(OutboxEvent.objects.filter(pk__in=[event.id for event in events]).count(), len(events))
+            batches.append([(event.id, event.kind, event.room_id) for event in events])
+        self.assertEqual(relay_outbox(publish=publish), 4)
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
+        self.assertEqual([event_id for batch in batches for event_id, _, _ in batch], ids)
+        self.assertEqual(
+            [(kind, room) for batch in batches for _, kind, room in batch],
+            [('join', other.id), ('join', self.room.id), ('message', self.room.id), ('leave', self.room.id)]
+        )
+        self.assertFalse(OutboxEvent.objects.exists())
+        self.assertEqual(relay_outbox(publish=publish), 0)
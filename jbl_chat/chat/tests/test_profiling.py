@@ -0,0 +1,78 @@
+from io import StringIO
+
+from celery.signals import after_task_publish, before_task_publish
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.profiling import profiling
+#
+
+
+@override_settings(TESTING=True, CHAT_PROFILING=True, CHAT_PROFILING_SAMPLE_RATE=1.0, CHAT_PROFILING_SLOW_MS=None)
+class RequestProfilingTestCase(TransactionTestCase):
+    """
+        * test_0001_server_timing   : chat__get_create_chat : GET : Test the Server-Timing breakdown of the request
+
+        * test_0002_sampling        : chat__get_create_chat : GET : Test the requests not sampled are only logged when slow
+
+        * test_0003_disabled        : chat__get_create_chat : GET : Test no Server-Timing header when profiling is disabled
+
+        * test_0004_broker_publish  : celery signals        :     : Test the tasks publish time is profiled
+
+    """
+
+    def setUp(self):
+        call_command('seed_chat', users=10, rooms=4, messages=20, distribution='small', stdout=StringIO())
+        self.user = User.objects.filter(membership__isnull=False).first()
+        self.url = '{}?user_id={}'.format(reverse('chat__get_create_chat'), self.user.id)
+        cache.clear()
+        super(RequestProfilingTestCase, self).setUp()
+
+    def server_timing(self, response) -> dict:
+        timings = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            timings[name] = dict(param.split('=', 1) for param in params)
+        return timings
+
+    def test_0001_server_timing(self):
+        with self.assertLogs('jbl_chat.middleware', 'INFO') as logs:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+
+        timings = self.server_timing(response)
+        self.assertGreater(int(timings['db']['desc'].strip('"').split()[0]), 0)
+        for part in ('db', 'serializer', 'render', 'total'):
+            self.assertGreaterEqual(float(timings[part]['dur']), 0)
+        self.assertLessEqual(float(timings['db']['dur']), float(timings['total']['dur']))
+        self.assertIn('url_name=chat__get_create_chat', logs.output[0])
+        self.assertEqual(logs.records[0].status, 200)
+
+        ###
+        # the users list reads the presence from redis
+        ###
+        response = self.client.get(reverse('authentication__list'))
+        self.assertIn('cache', self.server_timing(response))
+
+    @override_settings(CHAT_PROFILING_SAMPLE_RATE=0, CHAT_PROFILING_SLOW_MS=0)
+    def test_0002_sampling(self):
+        with self.assertLogs('jbl_chat.middleware', 'WARNING') as logs:
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+        self.assertIn('slow request', logs.output[0])
+        self.assertNotIn('db_ms', logs.output[0])
+
+    @override_settings(CHAT_PROFILING=False)
+    def test_0003_disabled(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Server-Timing', response)
+
+    def test_0004_broker_publish(self):
+        with profiling() as profile:
+            before_task_publish.send(sender='chat.tasks.send_group_message')
+            after_task_publish.send(sender='chat.tasks.send_group_message')
+        self.assertEqual(profile.counts['broker'], 1)
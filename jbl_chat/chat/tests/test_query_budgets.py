@@ -0,0 +1,108 @@
+import json
+from io import StringIO
+from unittest.mock import MagicMock, patch
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Count
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import count_queries
+from ..models import ChatRoom
+from ..tasks import send_direct_message, send_group_message, set_msg_as_seen
+#
+
+
+@override_settings(TESTING=True)
+class QueryBudgetsTestCase(TransactionTestCase):
+    """
+        * test_0001_query_budgets   : QUERY_BUDGETS : Test the endpoints queries are within budget and don't grow with the data set
+
+        * test_0002_budget_exceeded : QUERY_BUDGETS : Test the requests over budget are logged
+
+    """
+    # data set sizes, the same user gets more rooms and messages
+    SIZES = (1, 4)
+
+    def seed(self, size):
+        prefix = 'budget{}'.format(size)
+        call_command(
+            'seed_chat', users=20, rooms=6 * size, messages=60 * size,
+            distribution='small', direct_ratio=0.2, seen_ratio=0.3,
+            prefix=prefix, stdout=StringIO()
+        )
+        user = User.objects.filter(username__startswith=prefix + '_').annotate(
+            rooms=Count('membership')
+        ).order_by('-rooms', 'id').first()
+        room = ChatRoom.objects.filter(
+            is_direct=False,
+            membership__user=user
+        ).annotate(msgs=Count('message', distinct=True)).order_by('-msgs', 'id').first()
+        receiver = User.objects.filter(username__startswith=prefix + '_').exclude(pk=user.pk).first()
+        qs = '?user_id={}'.format(user.id)
+
+        # a user joining the room, then leaving it
+        joiner = User.objects.filter(username__startswith=prefix + '_').exclude(
+            membership__chatroom=room
+        ).first()
+        join_qs = '?user_id={}'.format(joiner.id)
+
+        return {
+            ('chat__get_create_chat', 'GET'): (reverse('chat__get_create_chat') + qs, None),
+            ('chat__join_leave_read_chat', 'GET'): (reverse('chat__join_leave_read_chat', args=(room.id,)) + qs, None),
+            ('chat__join_leave_read_chat', 'PUT'): (reverse('chat__join_leave_read_chat', args=(room.id,)) + join_qs, None),
+            ('chat__join_leave_read_chat', 'DELETE'): (reverse('chat__join_leave_read_chat', args=(room.id,)) + join_qs, None),
+            ('chat__get_room_messages', 'GET'): (reverse('chat__get_room_messages', args=(room.id,)) + qs, None),
+            ('chat__get_unseen_messages', 'GET'): (reverse('chat__get_unseen_messages') + qs, None),
+            ('chat__message_user_create', 'POST'): (reverse('chat__message_user_create', args=(receiver.id,)),
+                                                    {'from': user.id, 'text': 'hi'}),
+            ('chat__message_group_create', 'POST'): (reverse('chat__message_group_create', args=(room.id,)),
+                                                     {'from': user.id, 'text': 'hi'}),
+            ('chat__bulk_members', 'POST'): (reverse('chat__bulk_members', args=(room.id,)), json.dumps({
+                'usernames': list(User.objects.filter(username__startswith=prefix + '_').values_list('username', flat=True))
+            })),
+            ('chat__sync', 'GET'): (reverse('chat__sync') + qs + '&since=0', None),
+            ('authentication__list', 'GET'): (reverse('authentication__list'), None),
+            ('authentication__details', 'GET'): (reverse('authentication__details', args=(user.id,)), None),
+        }
+
+    def count_queries(self, method, url, data):
+        # cached pages would hide the queries
+        cache.clear()
+        # only the queries of the request, the tasks run in the workers
+        job = MagicMock(id='task-id')
+        with patch.object(set_msg_as_seen, 'apply', return_value=job), \
+                patch.object(send_direct_message, 'apply', return_value=job), \
+                patch.object(send_group_message, 'apply', return_value=job):
+            with count_queries() as counter:
+                if isinstance(data, str):
+                    response = getattr(self.client, method.lower())(url, data=data, content_type='application/json')
+                else:
+                    response = getattr(self.client, method.lower())(url, data=data)
+        self.assertIn(response.status_code, (200, 204), response.content)
+        return counter[0]
+
+    def test_0001_query_budgets(self):
+        counts = {}
+        for size in self.SIZES:
+            for (url_name, method), request in self.seed(size).items():
+                counts.setdefault((url_name, method), []).append(self.count_queries(method, *request))
+
+        self.assertEqual(set(counts), set(settings.QUERY_BUDGETS))
+        for (url_name, method), by_size in counts.items():
+            with self.subTest(url_name=url_name, method=method, queries=by_size):
+                self.assertLessEqual(max(by_size), settings.QUERY_BUDGETS[url_name, method])
+                # the count doesn't grow with the data
+                self.assertEqual(by_size[-1], by_size[0])
+
+    @override_settings(QUERY_BUDGETS={('chat__get_create_chat', 'GET'): 0}, CHAT_QUERY_BUDGET_LOG=True)
+    def test_0002_budget_exceeded(self):
+        with self.assertLogs('jbl_chat.middleware', 'WARNING') as logs:
+            self.client.get(reverse('chat__get_create_chat'))
+            # no budget for the method
+            self.client.post(reverse('chat__get_create_chat'))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('GET /chat/chatroom/ ran', logs.output[0])
+        self.assertIn('over the 0 budget of chat__get_create_chat', logs.output[0])
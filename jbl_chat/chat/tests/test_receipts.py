@@ -0,0 +1,72 @@
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from ..models import ChatRoom, Message, SeenMessage
+from ..receipts import COALESCED, ENQUEUED, enqueue_msg_as_seen, get_debounce_counters, release_msg_as_seen
+from ..tasks import set_msg_as_seen
+#
+
+
+@override_settings(TESTING=True)
+class ReceiptsDebounceTestCase(TransactionTestCase):
+    """
+        * test_0001_coalesced_jobs : chat__get_room_messages   : GET : Test the set_msg_as_seen jobs pending for the same room and reader are coalesced
+
+        * test_0002_released_jobs  : chat__get_unseen_messages : GET : Test a new job is enqueued once the pending one started
+
+        * test_0003_release        : set_msg_as_seen           :     : Test a job releases only its own pending key
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create(username='reader', password='test')
+        self.sender = User.objects.create(username='sender', password='test')
+        self.room = ChatRoom.objects.create(room_name='receipts', is_direct=False)
+        self.room.room_member.add(self.reader, self.sender)
+        Message.objects.create(room=self.room, msg_from=self.sender, text='first')
+        super(ReceiptsDebounceTestCase, self).setUp()
+
+    def test_0001_coalesced_jobs(self):
+        url = '{}?user_id={}'.format(reverse('chat__get_room_messages', args=(self.room.id,)), self.reader.id)
+
+        # the job stays pending
+        with patch.object(set_msg_as_seen, 'apply') as apply:
+            for _ in range(3):
+                self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(apply.call_count, 1)
+        self.assertEqual(get_debounce_counters(), {ENQUEUED: 1, COALESCED: 2})
+
+        # the pending job marks the messages sent after the coalesced requests too
+        Message.objects.create(room=self.room, msg_from=self.sender, text='second')
+        task_kwargs = apply.call_args.kwargs
+        set_msg_as_seen.apply(kwargs=task_kwargs['kwargs'], task_id=task_kwargs['task_id'])
+        self.assertEqual(SeenMessage.objects.filter(seen_by=self.reader).count(), 2)
+
+        response = self.client.get(reverse('chat__task_metrics'))
+        self.assertIn('chat_seen_jobs_total{result="coalesced"} 2', response.content.decode())
+
+    def test_0002_released_jobs(self):
+        url = '{}?user_id={}'.format(reverse('chat__get_unseen_messages'), self.reader.id)
+
+        # the eager jobs run and release the key
+        self.assertEqual(self.client.get(url).status_code, 200)
+        Message.objects.create(room=self.room, msg_from=self.sender, text='second')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.assertEqual(get_debounce_counters(), {ENQUEUED: 2, COALESCED: 0})
+        self.assertEqual(SeenMessage.objects.filter(seen_by=self.reader).count(), 2)
+
+    def test_0003_release(self):
+        with patch.object(set_msg_as_seen, 'apply') as apply:
+            task_id = enqueue_msg_as_seen(set_msg_as_seen.apply, self.room.id, self.reader.id)
+            # a stale job doesn't release the key of the pending one
+            release_msg_as_seen(self.room.id, self.reader.id, 'stale-task-id')
+            self.assertEqual(enqueue_msg_as_seen(set_msg_as_seen.apply, self.room.id, self.reader.id), task_id)
+
+            release_msg_as_seen(self.room.id, self.reader.id, task_id)
+            self.assertNotEqual(enqueue_msg_as_seen(set_msg_as_seen.apply, self.room.id, self.reader.id), task_id)
+        self.assertEqual(apply.call_count, 2)
@@ -0,0 +1,127 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django_redis import get_redis_connection
+from ..models import ChatRoom, Membership
+from ..recent import _recent_key, get_recent_cache_stats
+#
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_RECENT_MESSAGES=3)
+class RecentMessagesTestCase(TransactionTestCase):
+    """
+        * test_0001_cached_reads   : chat__get_room_messages    : GET  : Test the last messages are cached by the first read and served by the next ones
+
+        * test_0002_write_through  : chat__message_group_create : POST : Test the new messages are appended to the cached ones, the oldest dropped
+
+        * test_0003_repair         : chat__get_room_messages    : GET  : Test missing or stale cached messages are read from the db and cached again
+
+        * test_0004_live_senders   : chat__get_room_messages    : GET  : Test the cached messages are served with the current memberships of their senders
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='recent1', password='test')
+        self.user2 = User.objects.create(username='recent2', password='test')
+        self.room = ChatRoom.objects.create(room_name='recent', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=self.room)
+        Membership.objects.create(user=self.user2, chatroom=self.room)
+        self.key = _recent_key(self.room.id)
+        super(RecentMessagesTestCase, self).setUp()
+
+    def send(self, user, text):
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(self.room.id,)),
+            data={'from': user.id, 'text': text}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def read_last(self, last, query=''):
+        response = self.client.get('{}?user_id={}&last={}{}'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user2.id, last, query
+        ))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['data']['messages']
+
+    def test_0001_cached_reads(self):
+        for i in range(4):
+            self.send(self.user1, 'msg {}'.format(i))
+
+        messages = self.read_last(2)
+        self.assertEqual([msg['text'] for msg in messages], ['msg 2', 'msg 3'])
+        self.assertEqual(get_recent_cache_stats(), {self.room.id: {'hit': 0, 'miss': 1}})
+
+        # the same as the messages read from the db, with their read receipts
+        full = self.client.get('{}?user_id={}&seen_by=1'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user2.id
+        )).json()['data']['messages']
+        cached = self.read_last(10, '&seen_by=1')
+        self.assertEqual(cached, full[-3:])
+        self.assertEqual(cached[-1]['seen_by'], {'count': 1, 'readers': [{'id': self.user2.id, 'username': 'recent2'}]})
+        self.assertEqual(get_recent_cache_stats(), {self.room.id: {'hit': 1, 'miss': 1}})
+
+        response = self.client.get(reverse('chat__task_metrics'))
+        self.assertIn(
+            'chat_recent_cache_reads_total{{room="{}",result="hit"}} 1'.format(self.room.id),
+            response.content.decode()
+        )
+
+        response = self.client.get('{}?user_id={}&last=x'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user2.id
+        ))
+        self.assertEqual(response.status_code, 400)
+
+    def test_0002_write_through(self):
+        self.send(self.user1, 'first')
+        # not cached until read
+        self.assertEqual(get_redis_connection('default').llen(self.key), 0)
+
+        self.assertEqual([msg['seq'] for msg in self.read_last(3)], [1])
+        for i in range(3):
+            self.send(self.user2, 'msg {}'.format(i))
+        self.assertEqual(get_redis_connection('default').llen(self.key), 3)
+
+        messages = self.read_last(3)
+        self.assertEqual([msg['seq'] for msg in messages], [2, 3, 4])
+        self.assertEqual(messages[-1]['msg_from']['username'], 'recent2')
+        self.assertEqual(get_recent_cache_stats(), {self.room.id: {'hit': 1, 'miss': 1}})
+
+    def test_0003_repair(self):
+        for i in range(3):
+            self.send(self.user1, 'msg {}'.format(i))
+        self.read_last(3)
+
+        # a lost write-through
+        conn = get_redis_connection('default')
+        conn.rpop(self.key)
+        self.assertEqual([msg['text'] for msg in self.read_last(3)], ['msg 0', 'msg 1', 'msg 2'])
+        self.assertEqual(conn.llen(self.key), 3)
+
+        # a duplicate
+        conn.rpush(self.key, conn.lindex(self.key, -1))
+        self.assertEqual([msg['seq'] for msg in self.read_last(3)], [1, 2, 3])
+        self.assertEqual(get_recent_cache_stats(), {self.room.id: {'hit': 0, 'miss': 3}})
+        self.assertEqual([msg['seq'] for msg in self.read_last(2)], [2, 3])
+
+    def test_0004_live_senders(self):
+        self.send(self.user1, 'hello')
+        messages = self.read_last(1)
+        self.assertEqual(len(messages[0]['msg_from']['chat_room']), 1)
+        # only the sender id is cached
+        cached = json.loads(get_redis_connection('default').lindex(self.key, -1))
+        self.assertEqual(cached['msg_from'], self.user1.id)
+
+        # the sender joins another room between the two reads
+        other_room = ChatRoom.objects.create(room_name='recent_other', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=other_room)
+        messages = self.read_last(1)
+        self.assertEqual(
+            [membership['id'] for membership in messages[0]['msg_from']['chat_room']],
+            list(Membership.objects.filter(user=self.user1).order_by('id').values_list('id', flat=True))
+        )
+        self.assertEqual(messages[0]['msg_from']['username'], 'recent1')
+        self.assertEqual(get_recent_cache_stats(), {self.room.id: {'hit': 1, 'miss': 1}})
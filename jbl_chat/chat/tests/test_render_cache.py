@@ -0,0 +1,108 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django_redis import get_redis_connection
+from ..models import ChatRoom, Membership, Message
+from ..render_cache import _render_key, get_rendered_messages
+from ..serializers import BaseMessageSerializer, get_seen_by
+#
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True)
+class RenderCacheTestCase(TransactionTestCase):
+    """
+        * test_0001_cached_renders : chat__get_room_messages : GET : Test the messages JSON is cached and assembled with the read receipts, as BaseMessageSerializer
+
+        * test_0002_only_misses    : -                       :     : Test only the messages missing from the cache are loaded and rendered
+
+        * test_0003_live_senders   : chat__get_room_messages : GET : Test the cached messages are assembled with the current memberships of their senders
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='render1', password='test')
+        self.user2 = User.objects.create(username='render2', password='test')
+        self.room = ChatRoom.objects.create(room_name='render', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=self.room)
+        Membership.objects.create(user=self.user2, chatroom=self.room)
+        for i in range(4):
+            self.client.post(
+                reverse('chat__message_group_create', args=(self.room.id,)),
+                data={'from': self.user1.id, 'text': 'msg {}'.format(i)}
+            )
+        self.msgs = list(Message.objects.filter(room=self.room).order_by('id'))
+        super(RenderCacheTestCase, self).setUp()
+
+    def read(self, query=''):
+        response = self.client.get('{}?user_id={}{}'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user2.id, query
+        ))
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def test_0001_cached_renders(self):
+        conn = get_redis_connection('default')
+        self.assertIsNone(conn.get(_render_key(self.msgs[0].id, None)))
+
+        first = self.read('&seen_by=2').json()['data']['messages']
+        self.assertTrue(all(conn.get(_render_key(msg.id, None)) for msg in self.msgs))
+
+        # served from the cache, with the read receipts of now
+        cached = self.read('&seen_by=2').json()['data']['messages']
+        expected = json.loads(json.dumps(
+            BaseMessageSerializer(self.msgs, many=True).data,
+            default=str
+        ))
+        seen_by = get_seen_by(None, [msg.id for msg in self.msgs], 2)
+        for msg in expected:
+            msg['seen_by'] = seen_by[msg['id']]
+        self.assertEqual(cached, expected)
+        self.assertEqual([msg['seen_by']['count'] for msg in first], [0] * 4)
+        self.assertEqual([msg['seen_by']['count'] for msg in cached], [1] * 4)
+
+        # a seq range
+        messages = self.read('&seq_from=2&seq_to=3').json()['data']['messages']
+        self.assertEqual([msg['seq'] for msg in messages], [2, 3])
+
+    def test_0002_only_misses(self):
+        ids = [msg.id for msg in self.msgs]
+        rendered = get_rendered_messages(ids[:2])
+        self.assertEqual(list(rendered), ids[:2])
+
+        with CaptureQueriesContext(connection) as ctx:
+            rendered = get_rendered_messages(ids)
+        self.assertEqual(list(rendered), ids)
+        loads = [query['sql'] for query in ctx.captured_queries if 'FROM "chat_message"' in query['sql']]
+        self.assertEqual(len(loads), 1)
+        self.assertIn(str(ids[2]), loads[0])
+        self.assertNotIn('IN ({}'.format(ids[0]), loads[0])
+
+        # all cached, no query
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(get_rendered_messages(ids), rendered)
+        self.assertEqual(len(ctx.captured_queries), 0)
+
+    def test_0003_live_senders(self):
+        first = self.read().json()['data']['messages']
+        self.assertEqual(len(first[0]['msg_from']['chat_room']), 1)
+        # the sender isn't cached
+        self.assertNotIn('msg_from', json.loads(get_redis_connection('default').get(_render_key(self.msgs[0].id, None))))
+
+        # the sender joins another room between the two reads
+        other_room = ChatRoom.objects.create(room_name='render_other', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=other_room)
+        cached = self.read().json()['data']['messages']
+        membership_ids = list(Membership.objects.filter(user=self.user1).order_by('id').values_list('id', flat=True))
+        for msg in cached:
+            self.assertEqual([membership['id'] for membership in msg['msg_from']['chat_room']], membership_ids)
+            self.assertEqual(msg['msg_from']['username'], 'render1')
+
+        # a deleted sender
+        Message.objects.filter(room=self.room).update(msg_from=None)
+        self.assertEqual([msg['msg_from'] for msg in self.read().json()['data']['messages']], [None] * 4)
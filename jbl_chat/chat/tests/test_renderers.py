@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+from io import StringIO
+
+import msgpack
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.renderers import MSGPACK_MEDIA_TYPE
+from ..models import ChatRoom, Message
+#
+
+
+@override_settings(TESTING=True)
+class RenderersTestCase(TransactionTestCase):
+    """
+        * test_0001_msgpack_response : chat__get_create_chat      : GET  : Test the msgpack content negotiation returns the same data of json
+
+        * test_0002_msgpack_request  : chat__message_group_create : POST : Test a msgpack request body
+
+        * test_0003_cached_formats   : authentication__list       : GET  : Test the users list (not cached) by format
+
+        * test_0004_bench_renderers  : bench_renderers            :      : Test size and encode/decode time by payload and format
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='renderers_user', password='test')
+        self.room = ChatRoom.objects.create(room_name='renderers', is_direct=False)
+        self.room.room_member.add(self.user)
+        Message.objects.create(room=self.room, msg_from=self.user, text='hi \u2028 there')
+        super(RenderersTestCase, self).setUp()
+
+    def test_0001_msgpack_response(self):
+        url = '{}?user_id={}'.format(reverse('chat__get_create_chat'), self.user.id)
+        json_response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(json_response['Content-Type'], 'application/json')
+
+        msgpack_response = self.client.get(url, HTTP_ACCEPT=MSGPACK_MEDIA_TYPE)
+        self.assertEqual(msgpack_response.status_code, 200)
+        self.assertEqual(msgpack_response['Content-Type'], MSGPACK_MEDIA_TYPE)
+        self.assertEqual(msgpack.unpackb(msgpack_response.content, raw=False), json_response.json())
+        self.assertLess(len(msgpack_response.content), len(json_response.content))
+
+        # the json output escapes the line separators like the DRF encoder
+        url = '{}?user_id={}'.format(reverse('chat__get_room_messages', args=(self.room.id,)), self.user.id)
+        response = self.client.get(url)
+        self.assertIn(b'\\u2028', response.content)
+        self.assertEqual(response.json()['data']['messages'][0]['text'], 'hi \u2028 there')
+
+    def test_0002_msgpack_request(self):
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(self.room.id,)),
+            data=msgpack.packb({'from': self.user.id, 'text': 'packed'}),
+            content_type=MSGPACK_MEDIA_TYPE,
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Message.objects.filter(text='packed').exists())
+
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(self.room.id,)),
+            data=b'\xc1',
+            content_type=MSGPACK_MEDIA_TYPE,
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_0003_cached_formats(self):
+        url = reverse('authentication__list')
+        self.assertEqual(self.client.get(url)['Content-Type'], 'application/json')
+        response = self.client.get(url, HTTP_ACCEPT=MSGPACK_MEDIA_TYPE)
+        self.assertEqual(response['Content-Type'], MSGPACK_MEDIA_TYPE)
+        self.assertEqual(msgpack.unpackb(response.content, raw=False)['results'][0]['username'], 'renderers_user')
+
+    def test_0004_bench_renderers(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'renderers.json')
+            call_command(
+                'bench_renderers', users=20, rooms=6, messages=60, repeat=2,
+                output=output, stdout=StringIO()
+            )
+            with open(output) as f:
+                results = json.load(f)
+
+        self.assertEqual(set(results), {'message_list', 'chat_rooms', 'users'})
+        for formats in results.values():
+            self.assertEqual(set(formats), {'json', 'fast_json', 'msgpack'})
+            self.assertEqual(formats['json']['bytes'], formats['fast_json']['bytes'])
+            self.assertLess(formats['msgpack']['bytes'], formats['json']['bytes'])
+        # the seeded data is rolled back
+        self.assertFalse(User.objects.filter(username__startswith='bench_renderers').exists())
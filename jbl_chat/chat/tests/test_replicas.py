@@ -0,0 +1,60 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.test import SimpleTestCase, RequestFactory, override_settings
+
+from jbl_chat.middleware import ReadYourWritesMiddleware
+from jbl_chat.routers import (
+    PrimaryReplicaRouter,
+    pin_user_to_primary,
+    primary_db,
+    _pin_key,
+)
+#
+
+
+@override_settings(DATABASE_REPLICAS=['sqlite'])
+class ReplicaRoutingTestCase(SimpleTestCase):
+    """
+        * test_0001_route_reads_and_writes : Test reads go to the replica and writes to the primary
+
+        * test_0002_read_your_writes       : Test a user that wrote reads from the primary
+
+    """
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+        super(ReplicaRoutingTestCase, self).setUp()
+
+    def tearDown(self):
+        cache.delete(_pin_key(1))
+        super(ReplicaRoutingTestCase, self).tearDown()
+
+    def test_0001_route_reads_and_writes(self):
+        self.assertEqual(self.router.db_for_read(User), 'sqlite')
+        self.assertEqual(self.router.db_for_write(User), 'default')
+        self.assertFalse(self.router.allow_migrate('sqlite', 'chat'))
+
+        with primary_db():
+            self.assertEqual(self.router.db_for_read(User), 'default')
+
+        with override_settings(DATABASE_REPLICAS=[]):
+            self.assertEqual(self.router.db_for_read(User), 'default')
+
+    def test_0002_read_your_writes(self):
+        read_dbs = []
+
+        def view(request):
+            read_dbs.append(self.router.db_for_read(User))
+            return HttpResponse()
+
+        middleware = ReadYourWritesMiddleware(view)
+
+        middleware(self.factory.get('/chat/messages/unseen/?user_id=1'))
+        middleware(self.factory.post('/chat/group/1/'))
+        pin_user_to_primary(1)
+        middleware(self.factory.get('/chat/messages/unseen/?user_id=1'))
+        middleware(self.factory.get('/chat/messages/unseen/?user_id=2'))
+
+        self.assertEqual(read_dbs, ['sqlite', 'default', 'default', 'sqlite'])
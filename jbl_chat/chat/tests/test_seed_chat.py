@@ -0,0 +1,119 @@
+import hashlib
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db.models import Count
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from ..inbox import get_unseen_messages
+from ..models import ChatRoom, InboxEntry, Membership, Message, SeenMessage
+from ..sharding import get_user_chatrooms
+#
+
+
+@override_settings(TESTING=True, CHAT_INBOX_FANOUT_THRESHOLD=5)
+class SeedChatTestCase(TransactionTestCase):
+    """
+        * test_0001_seed_chat       : seed_chat : Test the generated users, rooms, messages and seen state
+
+        * test_0002_deterministic   : seed_chat : Test the same seed generates the same data set
+
+        * test_0003_read_cursors    : seed_chat : Test the unread counts of the seeded rooms match their seen messages
+
+    """
+
+    def seed(self, prefix, seed=1):
+        out = StringIO()
+        call_command(
+            'seed_chat', users=40, rooms=20, messages=500,
+            seed=seed, prefix=prefix, stdout=out
+        )
+        return out.getvalue().splitlines()[:-1]     # without the elapsed time
+
+    def digest(self, prefix) -> str:
+        """Digest of the rows seeded with the prefix (stripped from the names)"""
+        name = lambda value: (value or '').replace(prefix + '_', '')
+        users = User.objects.filter(username__startswith=prefix + '_')
+        rows = [
+            sorted(name(username) for username in users.values_list('username', flat=True)),
+            sorted(
+                (name(user), name(room), str(date_lefted))
+                for user, room, date_lefted in Membership.objects.filter(user__in=users).values_list(
+                    'user__username', 'chatroom__room_name', 'date_lefted'
+                )
+            ),
+            sorted(
+                (name(room), seq, name(sender), text, fanned_out)
+                for room, seq, sender, text, fanned_out in Message.objects.filter(msg_from__in=users).values_list(
+                    'room__room_name', 'seq', 'msg_from__username', 'text', 'fanned_out'
+                )
+            ),
+            sorted(
+                (name(room), seq, name(reader))
+                for room, seq, reader in SeenMessage.objects.filter(seen_by__in=users).values_list(
+                    'message__room__room_name', 'message__seq', 'seen_by__username'
+                )
+            ),
+        ]
+        return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+    def test_0001_seed_chat(self):
+        self.seed('seed')
+
+        self.assertEqual(User.objects.filter(username__startswith='seed_').count(), 40)
+        user = User.objects.get(username='seed_1')
+        self.assertTrue(user.check_password('Passw0rd!'))
+        self.assertIsNotNone(user.profile)
+        self.assertEqual(ChatRoom.objects.count(), 20)
+        self.assertEqual(Message.objects.count(), 500)
+
+        ###
+        # skewed activity: the most active room has more messages than the average
+        ###
+        busiest = Message.objects.values('room').annotate(msgs=Count('id')).order_by('-msgs').first()
+        self.assertGreater(busiest['msgs'], 500 / 20)
+
+        ###
+        # every message of the other members is either seen or unseen,
+        # unseen messages of the small rooms are in the inbox
+        ###
+        for user in User.objects.filter(username__startswith='seed_'):
+            rooms = get_user_chatrooms(user.id)
+            room_ids = [cr.id for cr in rooms]
+            from_others = Message.objects.filter(room_id__in=room_ids).exclude(msg_from=user).count()
+            seen = SeenMessage.objects.filter(seen_by=user).count()
+            unseen = sum(len(msgs) for msgs in get_unseen_messages(user, rooms).values())
+            self.assertEqual(seen + unseen, from_others)
+
+        self.assertFalse(InboxEntry.objects.filter(message__fanned_out=False).exists())
+        self.assertTrue(Membership.objects.filter(date_lefted__isnull=True).exists())
+
+    def test_0002_deterministic(self):
+        self.assertEqual(self.seed('first'), self.seed('second'))
+        self.assertEqual(self.digest('first'), self.digest('second'))
+        self.seed('third', seed=2)
+        self.assertNotEqual(self.digest('first'), self.digest('third'))
+
+    def test_0003_read_cursors(self):
+        self.seed('cursor')
+
+        checked = 0
+        for user in User.objects.filter(username__startswith='cursor_'):
+            response = self.client.get('{}?user_id={}'.format(reverse('chat__get_create_chat'), user.id))
+            self.assertEqual(response.status_code, 200)
+            for cr in response.json()['data']:
+                from_others = Message.objects.filter(room_id=cr['id']).exclude(msg_from=user).count()
+                seen = SeenMessage.objects.filter(message__room_id=cr['id'], seen_by=user).count()
+                self.assertEqual(cr['unread'], from_others - seen, (user.username, cr['room_name']))
+                checked += bool(cr['last_seq'])
+        self.assertTrue(checked)
+        # some rooms are read up to the end, some are not
+        self.assertTrue(any(
+            membership.read_seq < membership.chatroom.last_seq
+            for membership in Membership.objects.select_related('chatroom')
+        ))
+        self.assertTrue(any(
+            0 < membership.read_seq == membership.chatroom.last_seq
+            for membership in Membership.objects.select_related('chatroom')
+        ))
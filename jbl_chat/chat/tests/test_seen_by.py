@@ -0,0 +1,76 @@
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from jbl_chat.middleware import count_queries
+from ..models import ChatRoom, Message, SeenMessage
+from ..tasks import set_msg_as_seen
+#
+
+
+@override_settings(TESTING=True, CHAT_SEEN_BY_MAX_READERS=3)
+class SeenByTestCase(TransactionTestCase):
+    """
+        * test_0001_seen_by_count   : chat__get_room_messages : GET : Test the messages carry their readers count
+
+        * test_0002_seen_by_readers : chat__get_room_messages : GET : Test the first readers of the messages with ?seen_by=<n>
+
+        * test_0003_bulk_queries    : chat__get_room_messages : GET : Test the receipts of a page cost the same queries for any size
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(username='seen_sender', password='test')
+        self.readers = [User.objects.create(username='seen_reader{}'.format(i), password='test') for i in range(5)]
+        self.room = ChatRoom.objects.create(room_name='seen_by', is_direct=False)
+        self.room.room_member.add(self.sender, *self.readers)
+
+        # message i is seen by the first i readers
+        self.msgs = []
+        for i in range(5):
+            msg = Message.objects.create(room=self.room, msg_from=self.sender, text=str(i))
+            for reader in self.readers[:i]:
+                SeenMessage.objects.create(message=msg, seen_by=reader)
+            self.msgs.append(msg)
+        super(SeenByTestCase, self).setUp()
+
+    def get_messages(self, qs=''):
+        url = '{}?user_id={}{}'.format(reverse('chat__get_room_messages', args=(self.room.id,)), self.sender.id, qs)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return {msg['text']: msg['seen_by'] for msg in response.json()['data']['messages']}
+
+    def test_0001_seen_by_count(self):
+        seen_by = self.get_messages()
+        self.assertEqual(seen_by, {str(i): {'count': i} for i in range(5)})
+
+    def test_0002_seen_by_readers(self):
+        seen_by = self.get_messages('&seen_by=10')
+        self.assertEqual(seen_by['0'], {'count': 0, 'readers': []})
+        self.assertEqual(seen_by['2'], {'count': 2, 'readers': [
+            {'id': self.readers[0].id, 'username': 'seen_reader0'},
+            {'id': self.readers[1].id, 'username': 'seen_reader1'},
+        ]})
+        # at most CHAT_SEEN_BY_MAX_READERS readers, the count is complete
+        self.assertEqual(seen_by['4']['count'], 4)
+        self.assertEqual([r['username'] for r in seen_by['4']['readers']], ['seen_reader0', 'seen_reader1', 'seen_reader2'])
+
+    def test_0003_bulk_queries(self):
+        counts = []
+        for size in (5, 10):
+            for i in range(len(self.msgs), size):
+                msg = Message.objects.create(room=self.room, msg_from=self.sender, text=str(i))
+                for reader in self.readers[:3]:
+                    SeenMessage.objects.create(message=msg, seen_by=reader)
+                self.msgs.append(msg)
+            # cached messages would hide the queries, the task runs in the workers
+            cache.clear()
+            with patch.object(set_msg_as_seen, 'apply', return_value=MagicMock(id='task-id')):
+                with count_queries() as counter:
+                    seen_by = self.get_messages('&seen_by=2')
+            self.assertEqual(len(seen_by), size)
+            counts.append(counter[0])
+        self.assertEqual(counts[0], counts[1])
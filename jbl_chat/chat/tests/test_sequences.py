@@ -0,0 +1,103 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from ..models import ChatRoom, Membership, Message
+from ..sequences import next_seq
+#
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_SEQ_RANGE_MAX=3)
+class SequencesTestCase(TransactionTestCase):
+    """
+        * test_0001_gap_free_seq : chat__message_group_create : POST : Test the messages of a room get consecutive seqs, a rolled back send gives its seq back
+
+        * test_0002_range_read   : chat__get_room_messages    : GET  : Test the messages of a seq range are returned by seq, and the range limits
+
+        * test_0003_unread       : chat__get_create_chat      : GET  : Test the unread counts are the room last seq minus the read cursor
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='seq1', password='test')
+        self.user2 = User.objects.create(username='seq2', password='test')
+        self.room = ChatRoom.objects.create(room_name='seq', is_direct=False)
+        self.other_room = ChatRoom.objects.create(room_name='seq_other', is_direct=False)
+        for room in (self.room, self.other_room):
+            Membership.objects.create(user=self.user1, chatroom=room)
+            Membership.objects.create(user=self.user2, chatroom=room)
+        super(SequencesTestCase, self).setUp()
+
+    def send(self, user, room, text):
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(room.id,)),
+            data={'from': user.id, 'text': text}
+        )
+        self.assertEqual(response.status_code, 200)
+        return Message.objects.filter(room=room).latest('id')
+
+    def read(self, user, room, query=''):
+        return self.client.get('{}?user_id={}{}'.format(
+            reverse('chat__get_room_messages', args=(room.id,)), user.id, query
+        ))
+
+    def test_0001_gap_free_seq(self):
+        self.assertEqual(self.send(self.user1, self.room, 'one').seq, 1)
+        self.assertEqual(self.send(self.user2, self.other_room, 'other').seq, 1)
+        self.assertEqual(self.send(self.user2, self.room, 'two').seq, 2)
+
+        # a send failing after taking its seq rolls it back
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Message.objects.create(room=self.room, msg_from=self.user1, text='dup', seq=next_seq(self.room.id))
+                Message.objects.create(room=self.room, msg_from=self.user1, text='dup', seq=3)
+        self.assertEqual(self.send(self.user1, self.room, 'three').seq, 3)
+
+        self.assertEqual(
+            list(Message.objects.filter(room=self.room).order_by('id').values_list('seq', flat=True)),
+            [1, 2, 3]
+        )
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.last_seq, 3)
+
+        # (room, seq) is unique
+        with self.assertRaises(IntegrityError):
+            Message.objects.create(room=self.room, msg_from=self.user1, text='dup', seq=2)
+
+    def test_0002_range_read(self):
+        for i in range(5):
+            self.send(self.user1, self.room, 'msg {}'.format(i))
+
+        response = self.read(self.user2, self.room, '&seq_from=2&seq_to=4')
+        self.assertEqual(response.status_code, 200)
+        messages = response.json()['data']['messages']
+        self.assertEqual([msg['seq'] for msg in messages], [2, 3, 4])
+        self.assertEqual([msg['text'] for msg in messages], ['msg 1', 'msg 2', 'msg 3'])
+
+        # an open range is capped at CHAT_SEQ_RANGE_MAX messages
+        messages = self.read(self.user2, self.room, '&seq_from=4').json()['data']['messages']
+        self.assertEqual([msg['seq'] for msg in messages], [4, 5])
+
+        self.assertEqual(self.read(self.user2, self.room, '&seq_from=1&seq_to=4').status_code, 400)
+        self.assertEqual(self.read(self.user2, self.room, '&seq_from=4&seq_to=2').status_code, 400)
+        self.assertEqual(self.read(self.user2, self.room, '&seq_from=x').status_code, 400)
+
+    def test_0003_unread(self):
+        def unread(user):
+            response = self.client.get('{}?user_id={}'.format(reverse('chat__get_create_chat'), user.id))
+            self.assertEqual(response.status_code, 200)
+            return {cr['id']: (cr['last_seq'], cr['unread']) for cr in response.json()['data']}
+
+        for i in range(3):
+            self.send(self.user1, self.room, 'msg {}'.format(i))
+        self.send(self.user2, self.other_room, 'other')
+
+        # own messages are read
+        self.assertEqual(unread(self.user1), {self.room.id: (3, 0), self.other_room.id: (1, 1)})
+        self.assertEqual(unread(self.user2), {self.room.id: (3, 3), self.other_room.id: (1, 0)})
+
+        self.read(self.user2, self.room)
+        self.send(self.user1, self.room, 'new')
+        self.assertEqual(unread(self.user2), {self.room.id: (4, 1), self.other_room.id: (1, 0)})
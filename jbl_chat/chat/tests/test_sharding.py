@@ -0,0 +1,152 @@
+from io import StringIO
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import Count
+from django.test import TransactionTestCase, override_settings
+from django.test import Client
+from django.contrib.auth.models import User
+from django.urls import reverse
+from ..models import ChatRoom, Membership, Message, RoomShard
+from ..sharding import move_room, shard_for_room
+from celery import Celery
+celery_app = Celery('jbl_chat')
+#
+
+SHARDS = ['default', 'sqlite']
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_SHARDS=SHARDS)
+class ShardingTestCase(TransactionTestCase):
+    """
+        * test_0001_rooms_on_shards   : chat__get_create_chat     : POST-GET : Test rooms creation on the shards and scatter-gather listing
+
+        * test_0002_messages_on_shards: chat__message_group_create: POST-GET : Test messages stored on the room shard and unseen messages from all the shards
+
+        * test_0003_move_room         : chat__get_room_messages   : GET      : Test moving a room to another shard and rebalancing the shards
+
+    """
+    databases = set(SHARDS)
+
+    @classmethod
+    def setUpClass(cls):
+        celery_app.conf.task_always_eager = True
+
+        cls.client = Client()
+
+        cls.createAPI = 'chat__get_create_chat'
+        cls.sendAPI = 'chat__message_group_create'
+        cls.readAPI = 'chat__get_room_messages'
+        cls.unseenAPI = 'chat__get_unseen_messages'
+
+        super(ShardingTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        celery_app.conf.task_always_eager = False
+        super(ShardingTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        cache.delete_pattern('*room_shard*')
+
+        self.user1, _ = User.objects.get_or_create(**{'username': 'user1', 'password':'test'})
+        self.user2, _ = User.objects.get_or_create(**{'username': 'user2', 'password':'test'})
+
+        ###
+        # Create some groups with user1 and user2, they are spread on the shards
+        ###
+        self.room_ids = []
+        url = reverse(self.createAPI)
+        for i in range(6):
+            payload = {
+                "room_name": 'room_{}'.format(i),
+                "room_member": [{"username": "user1"}, {"username": "user2"}]
+            }
+            response = self.client.post(url, data=payload, content_type='application/json')
+            self.assertEqual(response.status_code, 200, response.content)
+            self.room_ids.append(response.json()['data']['id'])
+
+        super(ShardingTestCase, self).setUp()
+
+    def tearDown(self):
+        cache.delete_pattern('*room_shard*')
+        super(ShardingTestCase, self).tearDown()
+
+    def test_0001_rooms_on_shards(self):
+        shards = {room_id: shard_for_room(room_id) for room_id in self.room_ids}
+        self.assertEqual(set(shards.values()), set(SHARDS))
+        for room_id, shard in shards.items():
+            self.assertTrue(ChatRoom.objects.using(shard).filter(pk=room_id).exists())
+            self.assertEqual(Membership.objects.using(shard).filter(chatroom_id=room_id).count(), 2)
+        self.assertEqual(RoomShard.objects.count(), len(self.room_ids))
+
+        ###
+        # Rooms of user1 are gathered from both the shards
+        ###
+        url = reverse(self.createAPI)
+        response = self.client.get('{}{}{}'.format(url, '?user_id=', self.user1.id))
+        self.assertEqual(response.status_code, 200)
+        res = response.json()
+        self.assertEqual([room['id'] for room in res['data']], sorted(self.room_ids))
+        for room in res['data']:
+            self.assertEqual(
+                sorted(member['username'] for member in room['room_member']),
+                ['user1', 'user2']
+            )
+
+        response = self.client.get(url)
+        self.assertEqual(len(response.json()['data']), len(self.room_ids))
+
+    def test_0002_messages_on_shards(self):
+        for room_id in self.room_ids:
+            url = reverse(self.sendAPI, args=(room_id,))
+            response = self.client.post(url, data={"from": self.user1.id, "text": "hi {}".format(room_id)})
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                Message.objects.using(shard_for_room(room_id)).filter(room_id=room_id).exists()
+            )
+
+        ###
+        # user2 gets the unseen messages from all the shards
+        ###
+        url = reverse(self.unseenAPI)
+        response = self.client.get('{}{}{}'.format(url, '?user_id=', self.user2.id))
+        self.assertEqual(response.status_code, 200)
+        unseen = sorted(msg['text'] for room in response.json()['data'] for msg in room['messages'])
+        self.assertEqual(unseen, sorted("hi {}".format(room_id) for room_id in self.room_ids))
+
+    def test_0003_move_room(self):
+        room_id = self.room_ids[0]
+        source = shard_for_room(room_id)
+        target = [shard for shard in SHARDS if shard != source][0]
+
+        url = reverse(self.sendAPI, args=(room_id,))
+        self.client.post(url, data={"from": self.user1.id, "text": "before moving"})
+
+        move_room(room_id, target)
+
+        self.assertEqual(shard_for_room(room_id), target)
+        self.assertEqual(RoomShard.objects.get(pk=room_id).shard, target)
+        self.assertFalse(ChatRoom.objects.using(source).filter(pk=room_id).exists())
+        self.assertFalse(Message.objects.using(source).filter(room_id=room_id).exists())
+
+        ###
+        # the room is still readable after the move
+        ###
+        url = reverse(self.readAPI, args=(room_id,))
+        response = self.client.get('{}{}{}'.format(url, '?user_id=', self.user2.id))
+        self.assertEqual(response.status_code, 200)
+        res = response.json()
+        self.assertEqual([msg['text'] for msg in res['data']['messages']], ["before moving"])
+
+        ###
+        # rebalance the shards, they end up with the same number of rooms
+        ###
+        call_command('rebalance_shards', stdout=StringIO())
+        rooms_per_shard = RoomShard.objects.values('shard').annotate(rooms=Count('id'))
+        self.assertEqual(
+            {row['shard']: row['rooms'] for row in rooms_per_shard},
+            {shard: len(self.room_ids) // len(SHARDS) for shard in SHARDS}
+        )
+        for room_id in self.room_ids:
+            self.assertTrue(ChatRoom.objects.using(shard_for_room(room_id)).filter(pk=room_id).exists())
@@ -0,0 +1,132 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from ..memberships import bulk_join
+from ..models import ChangeLog, ChatRoom, Membership
+#
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, CHAT_SYNC_SETTLE_SECONDS=0)
+class SyncTestCase(TransactionTestCase):
+    """
+        * test_0001_delta_sync : chat__sync : GET : Test the changes after a seq: messages, joins, leaves and reads
+
+        * test_0002_pages      : chat__sync : GET : Test the changes are returned in bounded pages
+
+        * test_0003_settle     : chat__sync : GET : Test the changes commit with their transaction and are synced once settled
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user1 = User.objects.create(username='sync1', password='test')
+        self.user2 = User.objects.create(username='sync2', password='test')
+        self.user3 = User.objects.create(username='sync3', password='test')
+        self.room = ChatRoom.objects.create(room_name='sync', is_direct=False)
+        Membership.objects.create(user=self.user1, chatroom=self.room)
+        Membership.objects.create(user=self.user2, chatroom=self.room)
+        self.other_room = ChatRoom.objects.create(room_name='sync_other', is_direct=False)
+        Membership.objects.create(user=self.user3, chatroom=self.other_room)
+        super(SyncTestCase, self).setUp()
+
+    def sync(self, user, since=None, limit=None):
+        url = '{}?user_id={}'.format(reverse('chat__sync'), user.id)
+        if since is not None:
+            url += '&since={}'.format(since)
+        if limit is not None:
+            url += '&limit={}'.format(limit)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['data']
+
+    def send(self, user, room, text):
+        response = self.client.post(
+            reverse('chat__message_group_create', args=(room.id,)),
+            data={'from': user.id, 'text': text}
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_0001_delta_sync(self):
+        # the starting point
+        seq = self.sync(self.user1)['seq']
+
+        self.send(self.user2, self.room, 'hello')
+        self.send(self.user3, self.other_room, 'not for user 1')
+        # user 1 reads the room
+        self.client.get('{}?user_id={}'.format(
+            reverse('chat__get_room_messages', args=(self.room.id,)), self.user1.id
+        ))
+        # user 3 joins, user 2 leaves
+        url = reverse('chat__join_leave_read_chat', args=(self.room.id,))
+        self.client.put('{}?user_id={}'.format(url, self.user3.id))
+        self.client.delete('{}?user_id={}'.format(url, self.user2.id))
+
+        data = self.sync(self.user1, seq)
+        changes = [
+            {key: value for key, value in change.items() if key not in ('seq', 'message')}
+            for change in data['changes']
+        ]
+        self.assertEqual(changes, [
+            {'kind': 'message', 'room': self.room.id, 'user': self.user2.id},
+            {'kind': 'seen', 'room': self.room.id, 'user': self.user1.id},
+            {'kind': 'join', 'room': self.room.id, 'user': self.user3.id},
+            {'kind': 'leave', 'room': self.room.id, 'user': self.user2.id},
+        ])
+        self.assertEqual(data['changes'][0]['message']['text'], 'hello')
+        self.assertEqual(data['seq'], data['changes'][-1]['seq'])
+        self.assertFalse(data['has_more'])
+
+        # user 2 still gets its own leave, not what happens afterwards
+        self.send(self.user1, self.room, 'bye')
+        changes = self.sync(self.user2, seq)['changes']
+        self.assertEqual(changes[-1]['kind'], 'leave')
+        self.assertNotIn('bye', [c.get('message', {}).get('text') for c in changes if c['kind'] == 'message'])
+
+        # nothing new
+        data = self.sync(self.user1, self.sync(self.user1, seq)['seq'])
+        self.assertEqual(data['changes'], [])
+
+    @override_settings(CHAT_SYNC_PAGE_SIZE=4)
+    def test_0002_pages(self):
+        seq = self.sync(self.user1)['seq']
+        for i in range(10):
+            self.send(self.user2, self.room, str(i))
+
+        texts, pages = [], 0
+        while True:
+            data = self.sync(self.user1, seq, limit=100)
+            texts += [change['message']['text'] for change in data['changes']]
+            seq, pages = data['seq'], pages + 1
+            if not data['has_more']:
+                break
+        self.assertEqual(texts, [str(i) for i in range(10)])
+        self.assertEqual(pages, 3)
+
+        response = self.client.get('{}?user_id={}&since=x'.format(reverse('chat__sync'), self.user1.id))
+        self.assertEqual(response.status_code, 400)
+
+    def test_0003_settle(self):
+        seq = self.sync(self.user1)['seq']
+
+        # rolled back with the membership change
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                bulk_join(self.room, [self.user3])
+                raise RuntimeError('rolled back')
+        self.assertFalse(ChangeLog.objects.filter(id__gt=seq).exists())
+
+        self.send(self.user2, self.room, 'hello')
+        with override_settings(CHAT_SYNC_SETTLE_SECONDS=60):
+            # not settled yet, not even the starting point moves past it
+            self.assertEqual(self.sync(self.user1, seq)['changes'], [])
+            self.assertEqual(self.sync(self.user1)['seq'], seq)
+
+            ChangeLog.objects.filter(id__gt=seq).update(created_at=timezone.now() - timedelta(seconds=61))
+            data = self.sync(self.user1, seq)
+            self.assertEqual([change['kind'] for change in data['changes']], ['message'])
+            self.assertEqual(self.sync(self.user1)['seq'], data['seq'])
@@ -0,0 +1,78 @@
+from time import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+from ..models import ChatRoom, Membership
+from ..task_metrics import ENQUEUED_AT_HEADER, PROMETHEUS_CONTENT_TYPE
+from ..tasks import send_group_message
+#
+
+
+@override_settings(TESTING=True, CHAT_TASK_METRICS=True)
+class TaskMetricsTestCase(TransactionTestCase):
+    """
+        * test_0001_task_metrics : chat__task_metrics : GET : Test the run time, db time, result size and count of the tasks
+
+        * test_0002_queue_wait   : chat__task_metrics : GET : Test the queue wait from the publish timestamp header
+
+        * test_0003_disabled     : chat__task_metrics : GET : Test no metrics are recorded when disabled
+
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='metrics_user', password='Password!')
+        self.chat_room = ChatRoom.objects.create(room_name='metrics_room')
+        Membership.objects.create(user=self.user, chatroom=self.chat_room)
+        super(TaskMetricsTestCase, self).setUp()
+
+    def get_metrics(self) -> dict:
+        response = self.client.get(reverse('chat__task_metrics'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], PROMETHEUS_CONTENT_TYPE)
+        metrics = {}
+        for line in response.content.decode().splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                metrics[name] = float(value)
+        return metrics
+
+    def test_0001_task_metrics(self):
+        for _ in range(2):
+            response = self.client.post(
+                reverse('chat__message_group_create', args=(self.chat_room.id,)),
+                data={'from': self.user.id, 'text': 'hi'}
+            )
+            self.assertEqual(response.status_code, 200)
+
+        metrics = self.get_metrics()
+        labels = 'task="chat.tasks.send_group_message",queue="messages"'
+        self.assertEqual(metrics['chat_tasks_total{%s,state="SUCCESS"}' % labels], 2)
+        for metric in ('chat_task_run_seconds', 'chat_task_db_seconds', 'chat_task_result_bytes'):
+            self.assertEqual(metrics['%s_count{%s}' % (metric, labels)], 2)
+            self.assertEqual(metrics['%s_bucket{%s,le="+Inf"}' % (metric, labels)], 2)
+            self.assertGreater(metrics['%s_sum{%s}' % (metric, labels)], 0)
+        # eager tasks are not published
+        self.assertNotIn('chat_task_queue_wait_seconds_count{%s}' % labels, metrics)
+
+    def test_0002_queue_wait(self):
+        send_group_message.apply(
+            args=({'from': self.user.id, 'text': 'hi'}, self.chat_room.id),
+            headers={ENQUEUED_AT_HEADER: time() - 2}
+        )
+
+        metrics = self.get_metrics()
+        labels = 'task="chat.tasks.send_group_message",queue="messages"'
+        self.assertEqual(metrics['chat_task_queue_wait_seconds_count{%s}' % labels], 1)
+        self.assertEqual(metrics['chat_task_queue_wait_seconds_bucket{%s,le="1"}' % labels], 0)
+        self.assertEqual(metrics['chat_task_queue_wait_seconds_bucket{%s,le="2.5"}' % labels], 1)
+
+    @override_settings(CHAT_TASK_METRICS=False)
+    def test_0003_disabled(self):
+        self.client.post(
+            reverse('chat__message_group_create', args=(self.chat_room.id,)),
+            data={'from': self.user.id, 'text': 'hi'}
+        )
+        self.assertFalse([name for name in self.get_metrics() if name.startswith('chat_tasks_total')])
@@ -0,0 +1,56 @@
+from django.test import SimpleTestCase
+from jbl_chat.celery import (
+    CLEANUP_QUEUE,
+    DEFAULT_QUEUE,
+    MESSAGES_QUEUE,
+    RECEIPTS_QUEUE,
+    WORKER_PROFILES,
+    app,
+    apply_worker_profile,
+)
+from ..tasks import delete_chatroom_data, delete_user_data, send_direct_message, send_group_message, set_msg_as_seen
+#
+
+
+class TaskRoutingTestCase(SimpleTestCase):
+    """
+        * test_0001_task_routes    : celery : Test messages, read receipts and cleanup tasks go to their own queue
+
+        * test_0002_worker_profile : celery : Test the queues, concurrency and prefetch of the worker profiles
+
+    """
+
+    def route(self, task) -> str:
+        return task.app.amqp.router.route({}, task.name)['queue']
+
+    def test_0001_task_routes(self):
+        self.assertEqual(self.route(send_direct_message).name, MESSAGES_QUEUE)
+        self.assertEqual(self.route(send_group_message).name, MESSAGES_QUEUE)
+        self.assertEqual(self.route(set_msg_as_seen).name, RECEIPTS_QUEUE)
+        self.assertEqual(self.route(delete_chatroom_data).name, CLEANUP_QUEUE)
+        self.assertEqual(self.route(delete_user_data).name, CLEANUP_QUEUE)
+        self.assertEqual(app.amqp.router.route({}, 'chat.tasks.other').get('queue').name, DEFAULT_QUEUE)
+
+        # every queue has its own binding
+        queues = {q.name: q for q in app.conf.task_queues}
+        self.assertEqual(len({q.routing_key for q in queues.values()}), len(queues))
+        self.assertEqual(self.route(set_msg_as_seen).routing_key, RECEIPTS_QUEUE)
+
+    def test_0002_worker_profile(self):
+        conf = app.conf
+        saved = conf.task_queues, conf.worker_concurrency, conf.worker_prefetch_multiplier
+        try:
+            for name, profile in WORKER_PROFILES.items():
+                conf.task_queues, conf.worker_concurrency, conf.worker_prefetch_multiplier = saved
+                apply_worker_profile(name)
+                self.assertEqual([q.name for q in conf.task_queues], profile['queues'])
+                self.assertEqual(conf.worker_concurrency, profile['concurrency'])
+                self.assertEqual(conf.worker_prefetch_multiplier, profile['prefetch_multiplier'])
+        finally:
+            conf.task_queues, conf.worker_concurrency, conf.worker_prefetch_multiplier = saved
+
+        # the messages are never reserved behind other tasks
+        self.assertEqual(WORKER_PROFILES['messages']['prefetch_multiplier'], 1)
+        # nor the long deletions reserved behind each other, or by the receipts worker
+        self.assertEqual(WORKER_PROFILES['cleanup']['prefetch_multiplier'], 1)
+        self.assertTrue(all(CLEANUP_QUEUE not in profile['queues'] for name, profile in WORKER_PROFILES.items() if name != 'cleanup'))
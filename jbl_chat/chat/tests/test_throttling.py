@@ -0,0 +1,98 @@
+from django.conf import settings
+from django.test import TransactionTestCase, override_settings
+from django.test import Client
+from django.contrib.auth.models import User
+from django.urls import reverse
+from django_redis import get_redis_connection
+from ..models import ChatRoom
+from celery import Celery
+celery_app = Celery('jbl_chat')
+#
+
+REST_FRAMEWORK = dict(settings.REST_FRAMEWORK)
+REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] = {
+    'chat__get_unseen_messages': '2/min',
+    'chat__message_group_create': '100/min',
+    'chat__message_group_create__room': '1/min',
+}
+
+
+@override_settings(TESTING=True, CELERY_TASK_ALWAYS_EAGER=True, REST_FRAMEWORK=REST_FRAMEWORK)
+class ThrottlingTestCase(TransactionTestCase):
+    """
+        * test_0001_user_throttle : chat__get_unseen_messages  : GET  : Test per user token bucket and Retry-After header
+
+        * test_0002_room_throttle : chat__message_group_create : POST : Test per room token bucket shared by all the senders
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        celery_app.conf.task_always_eager = True
+
+        cls.client = Client()
+
+        cls.test1_API = 'chat__get_unseen_messages'
+        cls.test2_API = 'chat__message_group_create'
+
+        super(ThrottlingTestCase, cls).setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        User.objects.all().delete()
+        ChatRoom.objects.all().delete()
+        celery_app.conf.task_always_eager = False
+        super(ThrottlingTestCase, cls).tearDownClass()
+
+    def setUp(self):
+        self.user1, _ = User.objects.get_or_create(**{'username': 'user1', 'password':'test'})
+        self.user2, _ = User.objects.get_or_create(**{'username': 'user2', 'password':'test'})
+
+        self.roomFamily, _ = ChatRoom.objects.get_or_create(room_name='family', is_direct=False)
+        self.roomFamily.room_member.add(self.user1, self.user2)
+        self.clear_buckets()
+        super(ThrottlingTestCase, self).setUp()
+
+    def tearDown(self):
+        self.clear_buckets()
+        super(ThrottlingTestCase, self).tearDown()
+
+    def clear_buckets(self):
+        conn = get_redis_connection('default')
+        for key in conn.scan_iter('{}:throttle:*'.format(settings.CHAT_CACHE_KEY)):
+            conn.delete(key)
+
+    def test_0001_user_throttle(self):
+        url = reverse(self.test1_API)
+        user1_url = '{}{}{}'.format(url, '?user_id=', self.user1.id)
+        user2_url = '{}{}{}'.format(url, '?user_id=', self.user2.id)
+
+        ###
+        # user1 consumes its 2 tokens, the third poll is throttled
+        ###
+        for _ in range(2):
+            response = self.client.get(user1_url)
+            self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(user1_url)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) > 0)
+
+        ###
+        # user2 has its own bucket
+        ###
+        response = self.client.get(user2_url)
+        self.assertEqual(response.status_code, 200)
+
+    def test_0002_room_throttle(self):
+        url = reverse(self.test2_API, args=(self.roomFamily.id,))
+
+        response = self.client.post(url, data={"from": self.user1.id, "text": "hi"})
+        self.assertEqual(response.status_code, 200)
+
+        ###
+        # the room bucket is empty also for a different sender
+        ###
+        response = self.client.post(url, data={"from": self.user2.id, "text": "hi"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
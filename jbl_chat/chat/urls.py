@@ -1,12 +1,17 @@
+from django.conf import settings
 from django.urls import path
 
 from chat.views.chats import (
     ChatDestroyUpdateRetrieveAPIView, 
     ChatListCreateAPIView,
+    ChatMembersBulkAPIView,
     MessageRetrieveAPIView,
     MessageCreateAPIView,
-    MessageStatusAPIView
+    MessageStatusAPIView,
+    SyncAPIView,
 )
+from chat.views.async_views import async_read_view
+from chat.views.metrics import task_metrics
 
 message_create_direct = MessageCreateAPIView.as_view({
     'post':'message_user',
@@ -40,6 +45,25 @@ leave_join_read_chatroom = ChatDestroyUpdateRetrieveAPIView.as_view({
     'put':'add_user_to_chat'
 })
 
+bulk_members = ChatMembersBulkAPIView.as_view({
+    'get': 'list_members',
+    'post': 'bulk_join_chat',
+    'delete': 'bulk_leave_chat',
+})
+
+sync = SyncAPIView.as_view({
+    'get': 'sync',
+})
+
+# under asgi (see jbl_chat/asgi.py) the GET requests are served by async views
+if settings.CHAT_ASYNC_VIEWS:
+    message_read = async_read_view(message_read)
+    messages_unseen_read = async_read_view(messages_unseen_read, long_poll=True)
+    message_status = async_read_view(message_status)
+    sync = async_read_view(sync)
+    chatroom_list_create = async_read_view(chatroom_list_create)
+    leave_join_read_chatroom = async_read_view(leave_join_read_chatroom)
+
 urlpatterns = [
     ###
     # MESSAGES
@@ -62,5 +86,19 @@ urlpatterns = [
     path('chatroom/', chatroom_list_create, name='chat__get_create_chat'),
     # leave - join chatroom
     path('chatroom/<int:group_id>/', leave_join_read_chatroom, name='chat__join_leave_read_chat'),
+    # members presence - bulk join - leave chatroom
+    path('chatroom/<int:group_id>/members/', bulk_members, name='chat__bulk_members'),
+
+    ###
+    # DELTA SYNC
+    ###
+    # changes after ?since=<seq>
+    path('sync/', sync, name='chat__sync'),
+
+    ###
+    # METRICS
+    ###
+    # celery tasks metrics, prometheus format
+    path('metrics/', task_metrics, name='chat__task_metrics'),
 
 ]
\ No newline at end of file
@@ -0,0 +1,35 @@
+from contextlib import contextmanager
+
+from django.core.management.color import no_style
+from django.db import connections
+
+
+@contextmanager
+def keep_timestamps(*models):
+    """Disables 'auto_now_add' on the models fields, so that bulk copies
+       keep the original timestamps.
+       It changes the fields globally, use it only in commands
+    """
+    fields = [
+        field
+        for model in models
+        for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now_add', False)
+    ]
+    for field in fields:
+        field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field in fields:
+            field.auto_now_add = True
+
+
+def reset_sequences(db: str, *models):
+    """Moves the ids sequences of the models forward after inserting rows
+       with explicit ids (no-op on backends without sequences)
+    """
+    conn = connections[db]
+    with conn.cursor() as cursor:
+        for sql in conn.ops.sequence_reset_sql(no_style(), list(models)):
+            cursor.execute(sql)
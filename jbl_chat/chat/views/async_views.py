@@ -0,0 +1,107 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from functools import wraps
+from time import monotonic
+from typing import Callable
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+
+from chat.inbox import get_unseen_messages
+from chat.sharding import get_user_chatrooms
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'CHAT_ASYNC_VIEW_THREADS', 16),
+            thread_name_prefix='async_view'
+        )
+    return _executor
+
+
+def _run_closing_connections(func: Callable, args, kwargs):
+    # pool threads have their own connections, recycled like in a request
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_in_thread(func: Callable, *args, **kwargs):
+    """Runs the blocking 'func' (db and redis calls) in the async views
+       threads pool, with the current context (profiling, query counters)
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _get_executor(), copy_context().run, _run_closing_connections, func, args, kwargs
+    )
+
+
+def _render_view(view: Callable, request, args, kwargs):
+    response = view(request, *args, **kwargs)
+    # rendered in the pool thread, not in the event loop
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def has_unseen_messages(user_id: str) -> bool:
+    """Cheap check of the long poll, without serialization and jobs"""
+    reader = User.objects.get(pk=int(user_id))
+    return any(get_unseen_messages(reader, get_user_chatrooms(reader.pk)).values())
+
+
+def get_poll_wait(request) -> float:
+    """Seconds the unseen messages poll waits for new messages, ?wait=<s>"""
+    try:
+        wait = float(request.GET.get('wait', 0))
+    except ValueError:
+        return 0
+    return max(0, min(wait, getattr(settings, 'CHAT_POLL_MAX_WAIT', 30)))
+
+
+def async_read_view(view: Callable, long_poll: bool = False) -> Callable:
+    """Async version of the GET requests of a DRF view: the view runs in the
+       async views threads pool, so the event loop keeps serving the other
+       requests while it waits on the dbs and redis. The other methods are
+       served by the view as they are.
+
+       With 'long_poll' and ?wait=<seconds> the request waits (without
+       holding a thread) for unseen messages before answering
+    """
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        if request.method != 'GET':
+            return await sync_to_async(view)(request, *args, **kwargs)
+
+        wait = get_poll_wait(request) if long_poll and request.GET.get('user_id') else 0
+        if wait:
+            deadline = monotonic() + wait
+            interval = getattr(settings, 'CHAT_POLL_INTERVAL', 1)
+            try:
+                while not await run_in_thread(has_unseen_messages, request.GET['user_id']):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    await asyncio.sleep(min(interval, remaining))
+            except Exception as ex:
+                # the view answers with the right error
+                logger.debug('long poll interrupted: %s', ex)
+
+        return await run_in_thread(_render_view, view, request, args, kwargs)
+
+    # django 3.2 'csrf_exempt' would hide the coroutine function
+    async_view.csrf_exempt = True
+    return async_view
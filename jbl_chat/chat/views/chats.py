@@ -1,25 +1,47 @@
 from calendar import c
+from itertools import chain
 from django.core.exceptions import ValidationError
 from rest_framework import viewsets
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.authentication import BasicAuthentication
 from django.contrib.auth.models import User
+from django.db import transaction
 from django.db.models import Subquery, OuterRef
 from django.core.exceptions import ObjectDoesNotExist
 from rest_framework.response import Response
 from rest_framework import status
 from django.conf import settings
 
-from chat.models import ChatRoom, Membership, Message, SeenMessage
+from authentication.serializers import UserListSerializer
+from chat.models import ChangeLog, ChatRoom, Membership, Message, OutboxEvent, SeenMessage
 from chat.serializers import (
     BaseChatRoomSerializer,
     BaseMessageSerializer,
     ChatRoomSerializer,
     MessageSerializer,
     SeenMessageSerializer,
+    get_seen_by,
+    get_senders,
+    prefetch_messages_relations,
 )
 
+from jbl_chat.renderers import RawJSON
+from jbl_chat.routers import pin_user_to_primary
+from ..changes import current_seq, get_changes, get_sync_page_size, record_change, serialize_changes
+from ..inbox import backfill_inbox, get_unseen_messages
+from ..memberships import bulk_join, bulk_leave, get_outcomes, resolve_users
+from ..outbox import add_membership_events
+from ..receipts import enqueue_msg_as_seen
+from ..recent import get_recent_messages
+from ..render_cache import get_rendered_messages, with_field
+from ..sequences import get_seq_range
+from ..sharding import (
+    create_chatroom,
+    get_group_chatrooms,
+    get_user_chatrooms,
+    room_db,
+)
 from ..tasks import (
     set_msg_as_seen,
     send_direct_message,
@@ -106,9 +128,7 @@ class ChatListCreateAPIView(viewsets.ViewSet):
 
             # no user specified in the request query param
             if not user_id:
-                all_chat_rooms = ChatRoom.objects.filter(
-                    is_direct=False
-                )
+                all_chat_rooms = get_group_chatrooms()
                 ser = BaseChatRoomSerializer(all_chat_rooms, many = True)
 
             # user specified in the request query param
@@ -117,12 +137,7 @@ class ChatListCreateAPIView(viewsets.ViewSet):
                     raise ValidationError("user id most be a number")
                 user_id = int(user_id)
                 _: User = User.objects.get(pk=user_id)
-                user_chat_rooms = ChatRoom.objects.filter(
-                    id__in = Membership.objects.filter(
-                        user_id=user_id,
-                        date_lefted__isnull=True
-                    ).values('chatroom_id')
-                )
+                user_chat_rooms = get_user_chatrooms(user_id)
                 ser = ChatRoomSerializer(user_chat_rooms, many=True)
 
             ctx['status'] = status.HTTP_200_OK
@@ -171,7 +186,7 @@ class ChatListCreateAPIView(viewsets.ViewSet):
             if validation_err:
                 raise ValidationError('Attribute/s {} missing'.format(' - '.join(validation_err)))
 
-            cr:ChatRoom = ChatRoom.objects.create(
+            cr:ChatRoom = create_chatroom(
                 room_name=data['room_name'],
                 internal_identifier=ChatRoom().get_group_internal_id(data['room_name']),
                 is_direct=False
@@ -189,8 +204,7 @@ class ChatListCreateAPIView(viewsets.ViewSet):
                         username_list, data['room_name']
                     ))
 
-                cr.room_member.set(room_members)
-                cr.save()
+                bulk_join(cr, room_members)
 
             ser = ChatRoomSerializer(cr, many=False)
 
@@ -238,7 +252,7 @@ class ChatDestroyUpdateRetrieveAPIView(viewsets.ViewSet):
 
             # no user specified in the request query param
             if not user_id:
-                chat_room_no_details = ChatRoom.objects.get(
+                chat_room_no_details = ChatRoom.objects.using(room_db(group_id)).get(
                     pk=group_id,
                     is_direct=False
                 )
@@ -250,8 +264,9 @@ class ChatDestroyUpdateRetrieveAPIView(viewsets.ViewSet):
                     raise ValidationError("user id most be a number")
                 user_id = int(user_id)
                 _: User = User.objects.get(pk=user_id)
-                chat_room_details = ChatRoom.objects.get(
-                    id = Membership.objects.get(
+                db = room_db(group_id)
+                chat_room_details = ChatRoom.objects.using(db).get(
+                    id = Membership.objects.using(db).get(
                         user_id=user_id,
                         chatroom_id=group_id,
                         date_lefted__isnull=True
@@ -301,12 +316,20 @@ class ChatDestroyUpdateRetrieveAPIView(viewsets.ViewSet):
                 raise ValidationError("user id most be a number")
             user_id = int(user_id)
             leaver: User = User.objects.get(pk=user_id)
-            cr:ChatRoom = ChatRoom.objects.get(pk=group_id)
+            cr:ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
 
-            if not leaver in cr.room_member.all():
+            if not Membership.objects.using(room_db(cr)).filter(
+                user_id=leaver.id,
+                chatroom_id=cr.id
+            ).exists():
                 raise ValidationError("User %s is not part of this group" % leaver.username)
 
-            cr.room_member.remove(leaver)
+            with transaction.atomic(using=room_db(cr)):
+                cr.room_member.remove(leaver)
+                add_membership_events(OutboxEvent.Kind.leave, cr.id, [user_id], room_db(cr))
+                record_change(ChangeLog.Kind.leave, cr.id, user_id, db=room_db(cr))
+            # read-your-writes, next reads of the user go to the primary
+            pin_user_to_primary(user_id)
 
             ctx['status'] = status.HTTP_204_NO_CONTENT
             ctx['message']= 'HTTP_204_NO_CONTENT'
@@ -344,19 +367,155 @@ class ChatDestroyUpdateRetrieveAPIView(viewsets.ViewSet):
                 raise ValidationError("user id most be a number")
             user_id = int(user_id)
             new_member: User = User.objects.get(pk=user_id)
-            cr:ChatRoom = ChatRoom.objects.get(pk=group_id)
+            cr:ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
 
-            if new_member in cr.room_member.filter(membership__date_lefted__isnull=True):
+            if Membership.objects.using(room_db(cr)).filter(
+                user_id=new_member.id,
+                chatroom_id=cr.id,
+                date_lefted__isnull=True
+            ).exists():
                 raise ValidationError("User %s is already part of this group" % new_member.username)
 
             else:
                 if cr.is_direct:
                     raise ValidationError("Can't join a private chat")
 
-            Membership.objects.create(user=new_member, chatroom=cr)
+            with transaction.atomic(using=room_db(cr)):
+                Membership.objects.using(room_db(cr)).create(user=new_member, chatroom=cr)
+                backfill_inbox(cr.id, [user_id], room_db(cr))
+                add_membership_events(OutboxEvent.Kind.join, cr.id, [user_id], room_db(cr))
+                record_change(ChangeLog.Kind.join, cr.id, user_id, db=room_db(cr))
+            # read-your-writes, next reads of the user go to the primary
+            pin_user_to_primary(user_id)
+
+            ctx['status'] = status.HTTP_200_OK
+            ctx['message']= 'HTTP_200_OK'
+
+            return Response(ctx, status=status.HTTP_200_OK)
+
+        except ObjectDoesNotExist as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_404_NOT_FOUND)
+
+        except ValidationError as ex:
+            ctx['status'] = status.HTTP_400_BAD_REQUEST
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_400_BAD_REQUEST)
+
+        except Exception as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# bulk join - leave chatroom
+class ChatMembersBulkAPIView(viewsets.ViewSet):
+
+    def get_users(self, request):
+        data = request.data
+        # In case no data is sent or list is sent --> 400
+        if not data or isinstance(data, list):
+            raise ValidationError("Body is empty or wrong foramt")
+
+        user_ids = data.get('user_ids', [])
+        usernames = data.get('usernames', [])
+        if not isinstance(user_ids, list) or not isinstance(usernames, list) or not (user_ids or usernames):
+            raise ValidationError("Attribute/s user_ids - usernames missing or not lists")
+        return resolve_users(user_ids, usernames)
+
+    ###
+    # GET chat__bulk_members
+    ###
+    def list_members(self, request, group_id, *args, **kwargs):
+        """Current members of a chat room with their presence status,
+           looked up all at once
+        """
+        ctx = {}
+        try:
+            cr:ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
+            members = ChatRoomSerializer().get_room_members(cr, get_queryset=True).order_by('id')
+
+            ctx['status'] = status.HTTP_200_OK
+            ctx['message']= 'HTTP_200_OK'
+            ctx['data'] = UserListSerializer(members, many=True).data
+
+            return Response(ctx, status=status.HTTP_200_OK)
+
+        except ObjectDoesNotExist as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_404_NOT_FOUND)
+
+        except Exception as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    ###
+    # POST chat__bulk_members
+    ###
+    def bulk_join_chat(self, request, group_id, *args, **kwargs):
+        """Adds many users to a group chat 'is_direct=False', users are
+           validated in one query and their memberships inserted in bulk
+        {
+            "user_ids": list(int),
+            "usernames": list(str)
+        }
+           Returns the outcome of every user: joined, already_member, not_found
+        """
+        ctx = {}
+        try:
+            users, missing = self.get_users(request)
+            cr:ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
+            if cr.is_direct:
+                raise ValidationError("Can't join a private chat")
+
+            outcomes = bulk_join(cr, users)
+
+            ctx['status'] = status.HTTP_200_OK
+            ctx['message']= 'HTTP_200_OK'
+            ctx['data'] = get_outcomes(users, missing, outcomes)
+
+            return Response(ctx, status=status.HTTP_200_OK)
+
+        except ObjectDoesNotExist as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_404_NOT_FOUND)
+
+        except ValidationError as ex:
+            ctx['status'] = status.HTTP_400_BAD_REQUEST
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_400_BAD_REQUEST)
+
+        except Exception as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    ###
+    # DELETE chat__bulk_members
+    ###
+    def bulk_leave_chat(self, request, group_id, *args, **kwargs):
+        """Removes many users from a chat room with a single update,
+           the chat room is deleted when no member is left
+        {
+            "user_ids": list(int),
+            "usernames": list(str)
+        }
+           Returns the outcome of every user: left, not_member, not_found
+        """
+        ctx = {}
+        try:
+            users, missing = self.get_users(request)
+            cr:ChatRoom = ChatRoom.objects.using(room_db(group_id)).get(pk=group_id)
+
+            outcomes = bulk_leave(cr, users)
 
             ctx['status'] = status.HTTP_200_OK
             ctx['message']= 'HTTP_200_OK'
+            ctx['data'] = get_outcomes(users, missing, outcomes)
 
             return Response(ctx, status=status.HTTP_200_OK)
 
@@ -377,6 +536,72 @@ class ChatDestroyUpdateRetrieveAPIView(viewsets.ViewSet):
 
 
 
+###########################
+## DELTA SYNC
+###########################
+
+class SyncAPIView(viewsets.ViewSet):
+
+    ###
+    # GET chat__sync
+    ###
+    def sync(self, request, *args, **kwargs):
+        """ No auth, takes the request user from qs ?user_id=<user_id>
+
+            Changes (new messages, joins, leaves, reads) of the user chat
+            rooms after ?since=<seq>, in pages of at most CHAT_SYNC_PAGE_SIZE
+            (or ?limit=<n>): the next request starts from the returned 'seq'
+            while 'has_more'.
+
+            Without 'since' returns only the current 'seq', to start
+            syncing after a full read of the chat rooms
+        """
+        ctx = {}
+        try:
+            user_id: str = request.GET.get('user_id', '')
+            if not user_id.isdigit():
+                raise ValidationError("user id most be a number")
+            user_id = int(user_id)
+            _: User = User.objects.get(pk=user_id)
+
+            since: str = request.GET.get('since', '')
+            limit: str = request.GET.get('limit', '')
+            if (since and not since.isdigit()) or (limit and not limit.isdigit()):
+                raise ValidationError("since and limit must be numbers")
+
+            if not since:
+                data = {'changes': [], 'seq': current_seq(), 'has_more': False}
+            else:
+                limit = min(int(limit), get_sync_page_size()) if limit else get_sync_page_size()
+                changes, has_more = get_changes(user_id, int(since), limit)
+                data = {
+                    'changes': serialize_changes(changes),
+                    'seq': changes[-1].id if changes else int(since),
+                    'has_more': has_more,
+                }
+
+            ctx['status'] = status.HTTP_200_OK
+            ctx['message']= 'HTTP_200_OK'
+            ctx['data'] = data
+
+            return Response(ctx, status=status.HTTP_200_OK)
+
+        except ObjectDoesNotExist as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_404_NOT_FOUND)
+
+        except ValidationError as ex:
+            ctx['status'] = status.HTTP_400_BAD_REQUEST
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_400_BAD_REQUEST)
+
+        except Exception as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
 ###########################
 ## MESSAGES
 ###########################
@@ -401,33 +626,67 @@ class MessageRetrieveAPIView(viewsets.ViewSet):
             user_id = int(user_id)
             _: User = User.objects.get(pk=user_id)
 
+            # only the messages of the range, with ?seq_from=<n>&seq_to=<m>,
+            # or the last ones, with ?last=<n>
+            seq_range = get_seq_range(request.GET)
+            last: str = request.GET.get('last', '')
+            if last and not last.isdigit():
+                raise ValidationError("last must be a number")
+
             # get the chatroom
-            user_chat_room = ChatRoom.objects.prefetch_related('message_set').get(
-                id = Membership.objects.get(
+            db = room_db(group_id)
+            user_chat_room = ChatRoom.objects.using(db).get(
+                id = Membership.objects.using(db).get(
                     user_id=user_id,
                     chatroom_id=group_id,
                     date_lefted__isnull=True
                 ).chatroom_id
             )
 
-            user_chat_room.messages = BaseMessageSerializer(
-                user_chat_room.message_set.all(),
-                many=True
-            ).data
+            # with their read receipts: count and, with ?seen_by=<n>, first readers
+            seen_by_readers = request.GET.get('seen_by', '')
+            seen_by_readers = int(seen_by_readers) if seen_by_readers.isdigit() else 0
+            rendered = None
+            if last and seq_range is None:
+                # the last messages of the room are cached (see chat.recent)
+                user_chat_room.messages = get_recent_messages(user_chat_room, int(last))
+                seen_by = get_seen_by(db, [msg['id'] for msg in user_chat_room.messages], seen_by_readers)
+                for msg in user_chat_room.messages:
+                    msg['seen_by'] = seen_by[msg['id']]
+            else:
+                messages = Message.objects.using(db).filter(room_id=user_chat_room.id)
+                messages = messages.order_by('id') if seq_range is None else messages.filter(
+                    seq__range=seq_range
+                ).order_by('seq')
+                sender_ids = dict(messages.values_list('id', 'msg_from_id'))
+                message_ids = list(sender_ids)
+
+                # the JSON of every message is cached (see chat.render_cache)
+                # and assembled with its current sender and read receipts
+                # without decoding it
+                seen_by = get_seen_by(db, message_ids, seen_by_readers)
+                senders = get_senders(sender_ids.values())
+                by_id = get_rendered_messages(message_ids, db)
+                rendered = RawJSON(b'[%s]' % b','.join(
+                    with_field(
+                        with_field(by_id[message_id], 'msg_from', senders.get(sender_ids[message_id])),
+                        'seen_by', seen_by[message_id]
+                    )
+                    for message_id in message_ids if message_id in by_id
+                ))
+                user_chat_room.messages = []
 
-            # set asynchronously the messages as 'seen'
-            set_msg_as_seen_apply_task(
-                kwargs={
-                    'chat_room_id':user_chat_room.pk,
-                    'reader_id':user_id
-                }
-            )
+            # set asynchronously the messages as 'seen' (unless already pending)
+            enqueue_msg_as_seen(set_msg_as_seen_apply_task, user_chat_room.pk, user_id)
 
             ser = ChatRoomSerializer(user_chat_room)
+            data = ser.data
+            if rendered is not None:
+                data['messages'] = rendered
 
             ctx['status'] = status.HTTP_200_OK
             ctx['message']= 'HTTP_200_OK'
-            ctx['data'] = ser.data
+            ctx['data'] = data
 
             return Response(ctx, status=status.HTTP_200_OK)
 
@@ -463,43 +722,26 @@ class MessageRetrieveAPIView(viewsets.ViewSet):
             user_id = int(user_id)
             reader: User = User.objects.get(pk=user_id)
             # get all mine chatroom
-            user_chat_rooms = ChatRoom.objects.prefetch_related('message_set').filter(
-                id__in = Membership.objects.filter(
-                    user_id=user_id,
-                    date_lefted__isnull=True
-                ).values('chatroom_id')
-            )
-            
+            user_chat_rooms = get_user_chatrooms(user_id)
+
+            # merge inbox (small rooms) and not fanned out (big rooms) messages
+            unseen_by_room = get_unseen_messages(reader, user_chat_rooms)
+            # senders of all the rooms at once, not room by room
+            prefetch_messages_relations(list(chain(*unseen_by_room.values())))
+
             chat_rooms = []
             # for all chatroom set all unseen msgs for user
             for cr in user_chat_rooms:
-                cr_msgs = cr.message_set.prefetch_related(
-                    'seenmessage_set'
-                )
-                unseen_msgs = cr_msgs.exclude(
-                    msg_from=reader            # exclude msgs sent by me
-                ).annotate(
-                    already_seen=Subquery(
-                        SeenMessage.objects.filter(
-                            seen_by_id=reader.id,        # annotate the already senn msgs
-                            message_id=OuterRef('id'),
-                        ).values('message_id')
-                    )
-                ).filter(
-                    already_seen__isnull=True
-                )                                # filter where annotation is None
-
+                unseen_msgs = unseen_by_room.get(cr.id, [])
 
                 cr.messages = BaseMessageSerializer(unseen_msgs, many=True).data
                 chat_rooms.append(cr)
 
-                # set asynchronously the messages as 'seen'
-                set_msg_as_seen_apply_task(
-                    kwargs={
-                        'chat_room_id':cr.pk,
-                        'reader_id':user_id
-                    }
-                )
+                if not unseen_msgs:
+                    continue
+
+                # set asynchronously the messages as 'seen' (unless already pending)
+                enqueue_msg_as_seen(set_msg_as_seen_apply_task, cr.pk, user_id)
 
 
             ser = ChatRoomSerializer(chat_rooms, many=True)
@@ -601,6 +843,8 @@ class MessageCreateAPIView(viewsets.ModelViewSet):
                     'user_id':user_id
                 }
             )
+            # read-your-writes, next reads of the sender go to the primary
+            pin_user_to_primary(data['from'])
 
             ctx['status'] = status.HTTP_200_OK
             ctx['message']= 'HTTP_200_OK'
@@ -651,6 +895,8 @@ class MessageCreateAPIView(viewsets.ModelViewSet):
                     'group_id': group_id
                 }
             )
+            # read-your-writes, next reads of the sender go to the primary
+            pin_user_to_primary(data['from'])
 
             ctx['status'] = status.HTTP_200_OK
             ctx['message']= 'HTTP_200_OK'
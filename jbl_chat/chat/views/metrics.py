@@ -0,0 +1,23 @@
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+
+from chat.receipts import render_debounce_metrics
+from chat.recent import render_recent_cache_metrics
+from chat.task_metrics import PROMETHEUS_CONTENT_TYPE, render_metrics
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+@require_GET
+def task_metrics(request):
+    """Celery tasks (and chat caches) metrics of all the workers, to be scraped by prometheus"""
+    try:
+        return HttpResponse(
+            render_metrics() + render_debounce_metrics() + render_recent_cache_metrics(),
+            content_type=PROMETHEUS_CONTENT_TYPE
+        )
+    except Exception as ex:
+        logger.exception(ex)
+        return HttpResponse(str(ex), status=503, content_type='text/plain')
@@ -12,5 +12,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'jbl_chat.settings')
+# async views for the GET requests (chat/views/async_views.py)
+os.environ.setdefault('CHAT_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
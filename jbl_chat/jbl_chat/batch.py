@@ -0,0 +1,210 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from io import BytesIO
+from typing import Callable, List
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+from django.http import Http404, HttpRequest, QueryDict
+from django.urls import resolve
+from rest_framework import status, viewsets
+from rest_framework.response import Response
+
+from jbl_chat.middleware import SAFE_METHODS, needs_primary
+from jbl_chat.routers import get_replicas, primary_db
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+BATCH_URL_NAME = 'batch'
+BATCH_PATH = '/batch/'
+
+_executor = None
+
+
+def get_batch_max_requests() -> int:
+    """Max sub-requests of a batch request"""
+    return getattr(settings, 'CHAT_BATCH_MAX_REQUESTS', 20)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    # not the shards pool, the sub-requests scatter their own queries there
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'CHAT_BATCH_WORKERS', 4),
+            thread_name_prefix='batch'
+        )
+    return _executor
+
+
+def _run_closing_connections(func: Callable, *args):
+    # worker threads have their own connections, recycled like in a request
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def parse_batch(data) -> List[dict]:
+    """Validates the sub-requests of a batch:
+       [{"method": "GET", "url": "/chat/chatroom/?user_id=1", "body": {...}}, ...]
+    """
+    if not isinstance(data, list) or not data:
+        raise ValidationError("requests must be a non empty list")
+    if len(data) > get_batch_max_requests():
+        raise ValidationError("At most {} requests per batch".format(get_batch_max_requests()))
+
+    sub_requests = []
+    for item in data:
+        if not isinstance(item, dict) or not isinstance(item.get('url'), str) or not item['url'].startswith('/'):
+            raise ValidationError("every request needs an absolute 'url'")
+        method = str(item.get('method', 'GET')).upper()
+        if method not in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+            raise ValidationError("method {} not allowed".format(method))
+        sub_requests.append({'method': method, 'url': item['url'], 'body': item.get('body')})
+    return sub_requests
+
+
+def build_sub_request(request, method: str, url: str, body=None) -> HttpRequest:
+    """A request to the 'url' view with the headers, cookies, session and
+       (already authenticated) user of the batch request
+    """
+    parts = urlsplit(url)
+    content = json.dumps(body).encode() if body is not None else b''
+
+    sub = HttpRequest()
+    sub.method = method
+    sub.path = sub.path_info = parts.path
+    sub.META = dict(
+        request.META,
+        REQUEST_METHOD=method,
+        PATH_INFO=parts.path,
+        QUERY_STRING=parts.query,
+        CONTENT_TYPE='application/json',
+        CONTENT_LENGTH=str(len(content)),
+    )
+    sub.GET = QueryDict(parts.query)
+    sub.COOKIES = request.COOKIES
+    sub._stream = BytesIO(content)
+    sub._read_started = False
+
+    # one authentication for all the sub-requests (DRF forced auth)
+    sub.user = request.user
+    sub._force_auth_user = request.user
+    sub._force_auth_token = request.auth
+    if hasattr(request, 'session'):
+        sub.session = request.session
+    return sub
+
+
+def _get_body(response):
+    if hasattr(response, 'data'):
+        return response.data
+    if response.get('Content-Type', '').startswith('application/json'):
+        return json.loads(response.content)
+    return response.content.decode()
+
+
+def run_sub_request(request, sub_request: dict, primary: bool = False) -> dict:
+    """Runs a sub-request in process, through the urlconf but without the
+       middlewares (already run by the batch request). Its reads go to the
+       primary db with 'primary', or when ReadYourWritesMiddleware would
+       send them there
+    """
+    try:
+        match = resolve(urlsplit(sub_request['url']).path)
+    except Http404:
+        return {'status': status.HTTP_404_NOT_FOUND, 'body': {'msg': 'Not found'}}
+    if match.url_name == BATCH_URL_NAME:
+        return {'status': status.HTTP_400_BAD_REQUEST, 'body': {'msg': 'Nested batch requests are not allowed'}}
+
+    sub = build_sub_request(request, **sub_request)
+    sub.resolver_match = match
+    view = match.func
+    # the async views (CHAT_ASYNC_VIEWS) wrap the sync one
+    if asyncio.iscoroutinefunction(view):
+        view = view.__wrapped__
+
+    try:
+        if get_replicas() and (primary or needs_primary(sub)):
+            with primary_db():
+                response = view(sub, *match.args, **match.kwargs)
+        else:
+            response = view(sub, *match.args, **match.kwargs)
+    except Exception as ex:
+        logger.exception(ex)
+        return {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'body': {'msg': str(ex)}}
+    return {'status': response.status_code, 'body': _get_body(response)}
+
+
+def run_batch(request, sub_requests: List[dict], parallel: bool = False) -> List[dict]:
+    """Runs the sub-requests in order. With 'parallel' the consecutive
+       read (GET) sub-requests run concurrently, each write waits for the
+       previous sub-requests and is waited by the next ones, whose reads
+       go to the primary db
+    """
+    responses = []
+    executor = _get_executor()
+    futures = []
+    wrote = False
+
+    def flush():
+        responses.extend(future.result() for future in futures)
+        futures.clear()
+
+    for sub_request in sub_requests:
+        if parallel and sub_request['method'] in SAFE_METHODS:
+            futures.append(executor.submit(
+                copy_context().run, _run_closing_connections, run_sub_request, request, sub_request, wrote
+            ))
+            continue
+        flush()
+        responses.append(run_sub_request(request, sub_request, wrote))
+        wrote = wrote or sub_request['method'] not in SAFE_METHODS
+    flush()
+    return responses
+
+
+class BatchAPIView(viewsets.ViewSet):
+
+    ###
+    # POST batch
+    ###
+    def batch(self, request, *args, **kwargs):
+        """ Runs several API requests in one round trip, with the
+            authentication of the batch request:
+
+            {"requests": [{"method": "GET", "url": "/chat/chatroom/?user_id=1"}, ...], "parallel": true}
+
+            Returns the responses ({"status": ..., "body": ...}) in the
+            requests order
+        """
+        ctx = {}
+        try:
+            # the list of the requests or an object with the options
+            data = request.data if isinstance(request.data, dict) else {'requests': request.data}
+            sub_requests = parse_batch(data.get('requests'))
+            parallel = data.get('parallel', False) in (True, 'true', '1')
+
+            ctx['status'] = status.HTTP_200_OK
+            ctx['message']= 'HTTP_200_OK'
+            ctx['data'] = run_batch(request, sub_requests, parallel)
+
+            return Response(ctx, status=status.HTTP_200_OK)
+
+        except ValidationError as ex:
+            ctx['status'] = status.HTTP_400_BAD_REQUEST
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_400_BAD_REQUEST)
+
+        except Exception as ex:
+            ctx['status'] = status.HTTP_404_NOT_FOUND
+            ctx['msg'] = str(ex)
+            return Response(ctx, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
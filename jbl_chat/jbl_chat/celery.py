@@ -2,9 +2,90 @@ from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
 from celery import shared_task
+from kombu import Queue
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'jbl_chat.settings')
 
 app = Celery('jbl_chat')
 app.config_from_object('django.conf:settings', namespace='CELERY')
-app.autodiscover_tasks()
\ No newline at end of file
+app.autodiscover_tasks()
+
+###
+# QUEUES
+###
+# messages delivery never waits behind the read receipts bookkeeping
+# of the polling clients
+MESSAGES_QUEUE = 'messages'
+RECEIPTS_QUEUE = 'receipts'
+# long running deletions of rooms and users, never in front of the receipts
+CLEANUP_QUEUE = 'cleanup'
+DEFAULT_QUEUE = 'celery'
+
+# a routing key per queue, the default one would bind all of them to 'celery'
+app.conf.task_queues = (
+    Queue(MESSAGES_QUEUE, routing_key=MESSAGES_QUEUE),
+    Queue(RECEIPTS_QUEUE, routing_key=RECEIPTS_QUEUE),
+    Queue(CLEANUP_QUEUE, routing_key=CLEANUP_QUEUE),
+    Queue(DEFAULT_QUEUE, routing_key=DEFAULT_QUEUE),
+)
+app.conf.task_default_queue = DEFAULT_QUEUE
+app.conf.task_routes = {
+    'chat.tasks.send_direct_message': {'queue': MESSAGES_QUEUE},
+    'chat.tasks.send_group_message': {'queue': MESSAGES_QUEUE},
+    'chat.tasks.set_msg_as_seen': {'queue': RECEIPTS_QUEUE},
+    'chat.tasks.delete_chatroom_data': {'queue': CLEANUP_QUEUE},
+    'chat.tasks.delete_user_data': {'queue': CLEANUP_QUEUE},
+}
+
+###
+# PERIODIC TASKS (celery beat)
+###
+app.conf.beat_schedule = {
+    # expired presences are written back as offline
+    'sweep-expired-presence': {
+        'task': 'authentication.tasks.sweep_expired_presence',
+        'schedule': 30.0,
+    },
+}
+
+###
+# WORKER PROFILES
+###
+# picked by the CELERY_WORKER_PROFILE env variable of the worker, the
+# worker consumes only the queues of its profile.
+# - messages : short tasks, one reserved task per process so a message is
+#              never stuck behind another in a busy process
+# - receipts : bulk work, fewer processes, many reserved tasks per process
+#              to save the broker round trips
+# - cleanup  : long jobs, a single process reserving one job at a time
+WORKER_PROFILES = {
+    'messages': {
+        'queues': [MESSAGES_QUEUE],
+        'concurrency': 8,
+        'prefetch_multiplier': 1,
+    },
+    'receipts': {
+        'queues': [RECEIPTS_QUEUE, DEFAULT_QUEUE],
+        'concurrency': 2,
+        'prefetch_multiplier': 16,
+    },
+    'cleanup': {
+        'queues': [CLEANUP_QUEUE],
+        'concurrency': 1,
+        'prefetch_multiplier': 1,
+    },
+}
+
+
+def apply_worker_profile(name: str):
+    """Sets the queues, concurrency and prefetch of a worker profile, the
+       worker command line options still win
+    """
+    profile = WORKER_PROFILES[name]
+    app.conf.task_queues = [q for q in app.conf.task_queues if q.name in profile['queues']]
+    app.conf.worker_concurrency = profile['concurrency']
+    app.conf.worker_prefetch_multiplier = profile['prefetch_multiplier']
+
+
+if os.environ.get('CELERY_WORKER_PROFILE'):
+    apply_worker_profile(os.environ['CELERY_WORKER_PROFILE'])
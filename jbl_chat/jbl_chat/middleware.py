@@ -0,0 +1,285 @@
+import asyncio
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from jbl_chat.profiling import Profile, profiling
+from jbl_chat.routers import get_replicas, is_user_pinned, primary_db
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+QUERY_COUNT_HEADER = 'X-DB-Queries'
+
+# counters of the queries run by the current request, lists to be shared
+# with the threads that copy the request context (chat.sharding.scatter).
+# Nested 'count_queries' blocks are all counted
+_query_counters: ContextVar = ContextVar('query_counters', default=())
+
+
+def get_request_user_id(request):
+    """No auth is requested, the request user is the authenticated one
+       or the one provided by the query string param ?user_id=<user_id>
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return user.pk
+    return request.GET.get('user_id') or None
+
+
+class SyncAndAsyncMiddleware:
+    """Base of the middlewares running in both the sync (wsgi) and the
+       async (asgi) handlers, so that the async views aren't moved to a
+       thread: subclasses implement 'call' and its async version 'acall'
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # django checks if the middleware itself is a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.acall(request)
+        return self.call(request)
+
+    def call(self, request):
+        raise NotImplementedError('.call() must be overridden')
+
+    async def acall(self, request):
+        raise NotImplementedError('.acall() must be overridden')
+
+
+def needs_primary(request) -> bool:
+    """Whether the reads of the request go to the primary db: it's a write
+       or its user wrote in the last DATABASE_REPLICA_PIN_SECONDS
+    """
+    return request.method not in SAFE_METHODS or is_user_pinned(get_request_user_id(request))
+
+
+class ReadYourWritesMiddleware(SyncAndAsyncMiddleware):
+    """Pins to the primary db the reads of:
+       - write requests (the view reads what it's going to write)
+       - users that wrote in the last DATABASE_REPLICA_PIN_SECONDS
+       The batch requests pick the db of each sub-request (see jbl_chat.batch).
+       Does nothing if no replica is configured
+    """
+
+    def use_primary(self, request) -> bool:
+        from jbl_chat.batch import BATCH_PATH
+
+        if request.path_info == BATCH_PATH:
+            return False
+        return needs_primary(request)
+
+    def call(self, request):
+        if not get_replicas():
+            return self.get_response(request)
+
+        if self.use_primary(request):
+            with primary_db():
+                return self.get_response(request)
+
+        return self.get_response(request)
+
+    async def acall(self, request):
+        if not get_replicas():
+            return await self.get_response(request)
+
+        # the pin lookup is a blocking redis call
+        if await sync_to_async(self.use_primary, thread_sensitive=False)(request):
+            with primary_db():
+                return await self.get_response(request)
+
+        return await self.get_response(request)
+
+
+def count_query(execute, sql, params, many, context):
+    for counter in _query_counters.get():
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    # every thread has its own connections, the wrapper is added to each one
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+@contextmanager
+def count_queries():
+    """Counts the db queries (all the dbs) run in the block, including the
+       ones of the threads that copy the current context.
+       Yields a list holding the count
+    """
+    # connections opened before this module was imported
+    for conn in connections.all():
+        install_query_counter(None, conn)
+    counter = [0]
+    token = _query_counters.set(_query_counters.get() + (counter,))
+    try:
+        yield counter
+    finally:
+        _query_counters.reset(token)
+
+
+class QueryCountMiddleware(SyncAndAsyncMiddleware):
+    """Adds to the response the number of db queries (all the dbs) run by
+       the request, used by the 'loadtest' command.
+       Enabled by CHAT_QUERY_COUNT_HEADER
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CHAT_QUERY_COUNT_HEADER', False):
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def call(self, request):
+        with count_queries() as counter:
+            response = self.get_response(request)
+        response[QUERY_COUNT_HEADER] = str(counter[0])
+        return response
+
+    async def acall(self, request):
+        with count_queries() as counter:
+            response = await self.get_response(request)
+        response[QUERY_COUNT_HEADER] = str(counter[0])
+        return response
+
+
+class QueryBudgetMiddleware(SyncAndAsyncMiddleware):
+    """Logs the requests running more db queries than the QUERY_BUDGETS
+       of their url name and method. Enabled by CHAT_QUERY_BUDGET_LOG
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CHAT_QUERY_BUDGET_LOG', False) or not getattr(settings, 'QUERY_BUDGETS', None):
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+
+    def call(self, request):
+        with count_queries() as counter:
+            response = self.get_response(request)
+        self.check_budget(request, counter[0])
+        return response
+
+    async def acall(self, request):
+        with count_queries() as counter:
+            response = await self.get_response(request)
+        self.check_budget(request, counter[0])
+        return response
+
+    def check_budget(self, request, queries: int):
+        url_name = getattr(request.resolver_match, 'url_name', None)
+        budget = settings.QUERY_BUDGETS.get((url_name, request.method))
+        if budget is not None and queries > budget:
+            logger.warning(
+                '%s %s ran %s db queries, over the %s budget of %s',
+                request.method, request.get_full_path(), queries, budget, url_name
+            )
+
+
+class RequestProfilingMiddleware(SyncAndAsyncMiddleware):
+    """Breaks down the time of the requests in db (time and queries), cache
+       calls, celery broker publish, serialization and rendering.
+       The breakdown is added to the response as a Server-Timing header and
+       logged as 'key=value' fields (also passed as log record attributes).
+
+       Enabled by CHAT_PROFILING, CHAT_PROFILING_SAMPLE_RATE (0..1) requests
+       are profiled, the others are only timed. Requests slower than
+       CHAT_PROFILING_SLOW_MS are logged as warnings
+    """
+    PARTS = ('db', 'cache', 'broker', 'serializer', 'render')
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'CHAT_PROFILING', False):
+            raise MiddlewareNotUsed()
+        super().__init__(get_response)
+        self.sample_rate = getattr(settings, 'CHAT_PROFILING_SAMPLE_RATE', 1.0)
+        self.slow_ms = getattr(settings, 'CHAT_PROFILING_SLOW_MS', None)
+
+    def call(self, request):
+        start = perf_counter()
+        if random.random() >= self.sample_rate:
+            response = self.get_response(request)
+            return self.finish(request, response, start)
+
+        with profiling() as profile:
+            request._profile = profile
+            response = self.get_response(request)
+        return self.finish(request, response, start, profile)
+
+    async def acall(self, request):
+        start = perf_counter()
+        if random.random() >= self.sample_rate:
+            response = await self.get_response(request)
+            return self.finish(request, response, start)
+
+        with profiling() as profile:
+            request._profile = profile
+            response = await self.get_response(request)
+        return self.finish(request, response, start, profile)
+
+    def finish(self, request, response, start: float, profile: Optional[Profile] = None):
+        duration_ms = (perf_counter() - start) * 1000
+        slow = self.slow_ms is not None and duration_ms > self.slow_ms
+        fields = {'duration_ms': round(duration_ms, 2)}
+
+        # not sampled, only the slow requests are logged
+        if profile is None:
+            if slow:
+                self.log(request, response, fields, slow=True)
+            return response
+
+        timings = []
+        for part in self.PARTS:
+            if part not in profile.counts:
+                continue
+            part_ms = profile.durations[part] * 1000
+            fields['{}_ms'.format(part)] = round(part_ms, 2)
+            fields['{}_calls'.format(part)] = profile.counts[part]
+            timings.append('{};dur={:.2f};desc="{} calls"'.format(part, part_ms, profile.counts[part]))
+        timings.append('total;dur={:.2f}'.format(duration_ms))
+        response['Server-Timing'] = ', '.join(timings)
+
+        self.log(request, response, fields, slow=slow)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after the view (and this hook)
+        profile = getattr(request, '_profile', None)
+        if profile is not None:
+            profile.start('render')
+            response.add_post_render_callback(lambda r: profile.stop('render'))
+        return response
+
+    def log(self, request, response, fields: dict, slow: bool):
+        fields = dict(
+            method=request.method,
+            path=request.path,
+            url_name=getattr(request.resolver_match, 'url_name', None),
+            status=response.status_code,
+            **fields
+        )
+        message = ' '.join('{}={}'.format(key, value) for key, value in fields.items())
+        if slow:
+            logger.warning('slow request %s', message, extra=fields)
+        else:
+            logger.info('request profile %s', message, extra=fields)
@@ -0,0 +1,175 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+from time import perf_counter
+from typing import Optional, Tuple
+
+from celery.signals import after_task_publish, before_task_publish
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django_redis.cache import RedisCache
+from rest_framework import serializers
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+
+# profile of the current request, None when the request isn't profiled
+# (the threads copying the request context add to the same profile)
+_profile: ContextVar = ContextVar('request_profile', default=None)
+
+
+class Profile:
+    """Time (seconds) and number of calls spent by a request in each part
+       (db, cache, broker, serializer, render).
+       Nested calls of the same part are counted once, by the outer one
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._depth = defaultdict(int)
+        self._started = {}
+
+    def add(self, name: str, duration: float):
+        self.durations[name] += duration
+        self.counts[name] += 1
+
+    def start(self, name: str):
+        if not self._depth[name]:
+            self._started[name] = perf_counter()
+        self._depth[name] += 1
+
+    def stop(self, name: str):
+        self._depth[name] -= 1
+        if not self._depth[name] and name in self._started:
+            self.add(name, perf_counter() - self._started.pop(name))
+
+
+def current_profile() -> Optional[Profile]:
+    return _profile.get()
+
+
+def start_profiling() -> Tuple[Profile, Token]:
+    """Profiles the current context until 'stop_profiling(token)'"""
+    profile = Profile()
+    return profile, _profile.set(profile)
+
+
+def stop_profiling(token: Token):
+    _profile.reset(token)
+
+
+@contextmanager
+def profiling():
+    """Profiles the block, yields the Profile"""
+    profile, token = start_profiling()
+    try:
+        yield profile
+    finally:
+        stop_profiling(token)
+
+
+@contextmanager
+def timed(name: str):
+    """Adds the time of the block to the 'name' part of the current profile"""
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    profile.start(name)
+    try:
+        yield
+    finally:
+        profile.stop(name)
+
+
+###
+# db
+###
+
+def profile_query(execute, sql, params, many, context):
+    profile = _profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add('db', perf_counter() - start)
+
+
+@receiver(connection_created)
+def install_query_profiler(sender, connection, **kwargs):
+    if profile_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(profile_query)
+
+
+###
+# celery broker
+###
+
+@before_task_publish.connect
+def task_publish_started(**kwargs):
+    profile = _profile.get()
+    if profile is not None:
+        profile.start('broker')
+
+
+@after_task_publish.connect
+def task_publish_finished(**kwargs):
+    profile = _profile.get()
+    if profile is not None:
+        profile.stop('broker')
+
+
+###
+# cache
+###
+
+def _timed_cache_method(name):
+    def method(self, *args, **kwargs):
+        profile = _profile.get()
+        if profile is None:
+            return getattr(super(ProfiledRedisCache, self), name)(*args, **kwargs)
+        profile.start('cache')
+        try:
+            return getattr(super(ProfiledRedisCache, self), name)(*args, **kwargs)
+        finally:
+            profile.stop('cache')
+    method.__name__ = name
+    return method
+
+
+class ProfiledRedisCache(RedisCache):
+    """django-redis cache adding its calls to the request profile"""
+
+
+for _name in (
+    'add', 'get', 'set', 'touch', 'delete', 'delete_many', 'delete_pattern', 'clear',
+    'get_many', 'set_many', 'has_key', 'incr', 'decr', 'keys', 'ttl', 'expire',
+):
+    setattr(ProfiledRedisCache, _name, _timed_cache_method(_name))
+
+
+###
+# serializers
+###
+
+class ProfiledSerializerMixin:
+    """Adds the serialization time to the request profile"""
+
+    def to_representation(self, instance):
+        profile = _profile.get()
+        if profile is None:
+            return super().to_representation(instance)
+        profile.start('serializer')
+        try:
+            return super().to_representation(instance)
+        finally:
+            profile.stop('serializer')
+
+
+class ProfiledModelSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
+    pass
@@ -0,0 +1,120 @@
+import json
+import re
+from uuid import uuid4
+
+import msgpack
+from rest_framework import renderers
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # optional, the stdlib json is used instead
+    orjson = None
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+
+
+
+class RawJSON:
+    """Already encoded JSON, embedded as it is in the JSON responses (by
+       the other renderers it's decoded first)
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = data
+
+
+class RawJSONEncoder(JSONEncoder):
+
+    def default(self, obj):
+        if isinstance(obj, RawJSON):
+            return json.loads(obj.data)
+        return super().default(obj)
+
+
+# types the fast encoders don't know (Decimal, lazy strings, querysets...)
+_default = RawJSONEncoder().default
+
+
+def dumps(data) -> bytes:
+    """JSON encoding of 'data', with orjson if installed"""
+    if orjson is None:
+        return json.dumps(data, cls=RawJSONEncoder, separators=(',', ':')).encode()
+    return orjson.dumps(data, default=_default)
+
+
+class FastJSONRenderer(renderers.JSONRenderer):
+    """JSON renderer encoding with orjson, if installed.
+       The browsable API and the indented responses use the DRF encoder.
+       RawJSON values are spliced in the encoded response, not re-encoded
+    """
+    encoder_class = RawJSONEncoder
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type or '', renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # the raw values are encoded as placeholder strings, then replaced
+        fragments = []
+        nonce = uuid4().hex
+
+        def default(obj):
+            if isinstance(obj, RawJSON):
+                fragments.append(obj.data)
+                return '\x00{}:{}'.format(nonce, len(fragments) - 1)
+            return _default(obj)
+
+        ret = orjson.dumps(data, default=default)
+        if fragments:
+            ret = re.sub(
+                r'"\\u0000{}:(\d+)"'.format(nonce).encode(),
+                lambda match: fragments[int(match.group(1))],
+                ret
+            )
+        # same escaping of the DRF renderer, the two chars are invalid in javascript
+        return ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    """JSON parser decoding with orjson, if installed"""
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if orjson is None:
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackRenderer(renderers.BaseRenderer):
+    media_type = MSGPACK_MEDIA_TYPE
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = MSGPACK_MEDIA_TYPE
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
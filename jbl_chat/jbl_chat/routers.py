@@ -0,0 +1,169 @@
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import monotonic
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+# when True, reads of the current request/task go to the primary
+_use_primary: ContextVar = ContextVar('use_primary', default=False)
+
+# replica alias -> (checked at, lag in seconds or None if unreachable)
+_replica_lag = {}
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def get_replicas() -> List[str]:
+    return list(getattr(settings, 'DATABASE_REPLICAS', []))
+
+
+def replica_lag(alias: str) -> Optional[float]:
+    """Replication lag of a replica in seconds, None if it can't be reached.
+       The value is cached for DATABASE_REPLICA_LAG_CHECK_INTERVAL seconds
+    """
+    interval = getattr(settings, 'DATABASE_REPLICA_LAG_CHECK_INTERVAL', 5)
+    checked_at, lag = _replica_lag.get(alias, (None, None))
+    if checked_at is not None and monotonic() - checked_at < interval:
+        return lag
+
+    try:
+        conn = connections[alias]
+        if conn.vendor != 'postgresql':
+            lag = 0.0
+        else:
+            with conn.cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = float(cursor.fetchone()[0])
+    except Exception as ex:
+        logger.warning('replica %s lag check failed: %s', alias, ex)
+        lag = None
+
+    _replica_lag[alias] = (monotonic(), lag)
+    return lag
+
+
+def get_healthy_replicas() -> List[str]:
+    """Replicas reachable and behind the primary less than DATABASE_REPLICA_MAX_LAG seconds"""
+    max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5)
+    healthy = []
+    for alias in get_replicas():
+        lag = replica_lag(alias)
+        if lag is not None and lag <= max_lag:
+            healthy.append(alias)
+    return healthy
+
+
+@contextmanager
+def primary_db():
+    """Forces the reads in the block to the primary"""
+    token = _use_primary.set(True)
+    try:
+        yield
+    finally:
+        _use_primary.reset(token)
+
+
+def reads_from_primary(func):
+    """Decorator version of 'primary_db', used by the celery tasks that
+       have to read what the api just wrote
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with primary_db():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _pin_key(user_id) -> str:
+    return '{}:db_pin:{}'.format(CHAT_CACHE_KEY, user_id)
+
+
+def pin_user_to_primary(user_id):
+    """After a write, the user reads from the primary for
+       DATABASE_REPLICA_PIN_SECONDS to see its own writes (read-your-writes)
+    """
+    if not get_replicas() or user_id in (None, ''):
+        return
+    cache.set(
+        _pin_key(user_id), 1,
+        timeout=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+    )
+
+
+def pin_users_to_primary(user_ids):
+    """pin_user_to_primary of many users, with a single cache call"""
+    user_ids = [user_id for user_id in user_ids if user_id not in (None, '')]
+    if not get_replicas() or not user_ids:
+        return
+    cache.set_many(
+        {_pin_key(user_id): 1 for user_id in user_ids},
+        timeout=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10)
+    )
+
+
+def is_user_pinned(user_id) -> bool:
+    if not get_replicas() or user_id in (None, ''):
+        return False
+    return bool(cache.get(_pin_key(user_id)))
+
+
+class PrimaryReplicaRouter:
+    """Sends writes to the primary ('default') and reads to a random
+       healthy replica, unless the reads are pinned to the primary
+    """
+
+    def _pool(self):
+        return [DEFAULT_DB_ALIAS] + get_replicas()
+
+    def _outside_pool_db(self, instance, model=None):
+        # object explicitly loaded from a db outside the primary/replica
+        # pool (e.g. a chat shard), for reads it has to be of the same model
+        if instance is None or not instance._state.db or instance._state.db in self._pool():
+            return None
+        if model is not None and not isinstance(instance, model):
+            return None
+        return instance._state.db
+
+    def db_for_read(self, model, **hints):
+        outside_pool_db = self._outside_pool_db(hints.get('instance'), model)
+        if outside_pool_db:
+            return outside_pool_db
+
+        if _use_primary.get():
+            return DEFAULT_DB_ALIAS
+
+        replicas = get_healthy_replicas()
+        if not replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        # writes of related objects follow the instance db, like Django does
+        return self._outside_pool_db(hints.get('instance')) or DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = self._pool()
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in get_replicas():
+            return False
+        return None
@@ -56,15 +56,48 @@ INSTALLED_APPS += [
 ]
 
 MIDDLEWARE = [
+    'jbl_chat.middleware.RequestProfilingMiddleware',
+    'jbl_chat.middleware.QueryCountMiddleware',
+    'jbl_chat.middleware.QueryBudgetMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'jbl_chat.middleware.ReadYourWritesMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# adds the X-DB-Queries header to the responses (see the loadtest command)
+CHAT_QUERY_COUNT_HEADER = DEBUG
+
+# Server-Timing header and logs with the time of the requests by part
+# (db, cache, broker, serializer, render), see RequestProfilingMiddleware
+CHAT_PROFILING = DEBUG
+CHAT_PROFILING_SAMPLE_RATE = 1.0 # share of the profiled requests
+CHAT_PROFILING_SLOW_MS = 500 # slower requests are logged as warnings
+
+# max db queries of a request by url name and method (with a single db, the
+# shards add a query per shard), enforced by chat/tests/test_query_budgets.py
+# and logged at runtime by QueryBudgetMiddleware, methods without a budget
+# are not checked
+QUERY_BUDGETS = {
+    ('chat__get_create_chat', 'GET'): 4,
+    ('chat__join_leave_read_chat', 'GET'): 4,
+    ('chat__join_leave_read_chat', 'PUT'): 10,
+    ('chat__join_leave_read_chat', 'DELETE'): 13,
+    ('chat__bulk_members', 'POST'): 9,
+    ('chat__sync', 'GET'): 4,
+    ('chat__get_room_messages', 'GET'): 9,
+    ('chat__get_unseen_messages', 'GET'): 8,
+    ('chat__message_user_create', 'POST'): 0,
+    ('chat__message_group_create', 'POST'): 0,
+    ('authentication__list', 'GET'): 1,
+    ('authentication__details', 'GET'): 1,
+}
+CHAT_QUERY_BUDGET_LOG = True
+
 ROOT_URLCONF = 'jbl_chat.urls'
 
 TEMPLATES = [
@@ -92,7 +125,32 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_FILTER_BACKENDS': (
         'django_filters.rest_framework.DjangoFilterBackend',
-    )
+    ),
+    # orjson encoding/decoding (if installed) and application/msgpack
+    # content negotiation (Accept / Content-Type headers or ?format=msgpack)
+    'DEFAULT_RENDERER_CLASSES': (
+        'jbl_chat.renderers.FastJSONRenderer',
+        'jbl_chat.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'jbl_chat.renderers.FastJSONParser',
+        'jbl_chat.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ),
+    # redis token buckets, rates are set by url name (per user)
+    # and by '<url name>__room' (per chat room)
+    'DEFAULT_THROTTLE_CLASSES': (
+        'jbl_chat.throttling.UserTokenBucketThrottle',
+        'jbl_chat.throttling.RoomTokenBucketThrottle',
+    ),
+    'DEFAULT_THROTTLE_RATES': {
+        'chat__message_user_create': '60/min',
+        'chat__message_group_create': '60/min',
+        'chat__message_group_create__room': '600/min',
+        'chat__get_unseen_messages': '60/min',
+    }
 }
 
 # Database
@@ -118,9 +176,51 @@ DATABASES = {
     }
 }
 
+# Read replicas (comma separated hosts), reads are routed to a replica
+# unless the user wrote in the last DATABASE_REPLICA_PIN_SECONDS
+# or the replica is behind the primary more than DATABASE_REPLICA_MAX_LAG
+DATABASE_REPLICAS = []
+for i, replica_host in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(','))):
+    replica_alias = 'replica_{}'.format(i + 1)
+    DATABASES[replica_alias] = dict(
+        DATABASES['default'],
+        HOST=replica_host.strip(),
+        TEST={'MIRROR': 'default'}
+    )
+    DATABASE_REPLICAS.append(replica_alias)
+
+# Chat rooms sharding (comma separated hosts), rooms data (memberships,
+# messages, seen messages) is spread by room id across CHAT_SHARDS
+# ('default' first), users and the room -> shard map stay on 'default'
+CHAT_SHARDS = []
+for i, shard_host in enumerate(filter(None, os.environ.get('DB_SHARD_HOSTS', '').split(','))):
+    shard_alias = 'shard_{}'.format(i + 1)
+    DATABASES[shard_alias] = dict(DATABASES['default'], HOST=shard_host.strip())
+    CHAT_SHARDS.append(shard_alias)
+if CHAT_SHARDS:
+    CHAT_SHARDS.insert(0, 'default')
+CHAT_SHARD_WORKERS = 8 # threads for the scatter-gather queries
+
+# async views for the chat GET requests, enabled by jbl_chat/asgi.py: the
+# dbs and redis calls run in a pool of CHAT_ASYNC_VIEW_THREADS threads and
+# the unseen messages poll can wait ?wait=<s> (max CHAT_POLL_MAX_WAIT) for
+# new messages, checking every CHAT_POLL_INTERVAL seconds
+CHAT_ASYNC_VIEWS = os.environ.get('CHAT_ASYNC_VIEWS') == '1'
+CHAT_ASYNC_VIEW_THREADS = 16
+CHAT_POLL_MAX_WAIT = 30
+CHAT_POLL_INTERVAL = 1
+
+DATABASE_ROUTERS = [
+    'chat.sharding.RoomShardRouter',
+    'jbl_chat.routers.PrimaryReplicaRouter',
+]
+DATABASE_REPLICA_PIN_SECONDS = 10
+DATABASE_REPLICA_MAX_LAG = 5 # seconds
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = 5 # seconds
+
 CACHES = {
     "default": {
-        "BACKEND": "django_redis.cache.RedisCache",
+        "BACKEND": "jbl_chat.profiling.ProfiledRedisCache",
         "LOCATION": "redis://jbl_cache:6379/1",
         "OPTIONS": {
             "CLIENT_CLASS": "django_redis.client.DefaultClient"
@@ -134,6 +234,61 @@ CHAT_CACHE_KEY = 'chat'
 
 CACHE_TTL = 60*15 # 15 minutes cache
 
+# rooms with less members get messages copied in each member inbox at send
+# time (fan-out-on-write), bigger rooms are filtered at read time
+CHAT_INBOX_FANOUT_THRESHOLD = 50
+
+# a set_msg_as_seen job pending for a (room, reader) absorbs the following
+# requests until it starts, or for this many seconds if it gets lost
+CHAT_SEEN_DEBOUNCE_TTL = 10
+
+# max readers listed in the read receipts of each message (?seen_by=<n>)
+CHAT_SEEN_BY_MAX_READERS = 10
+
+# max changes returned by a delta sync request (chat/sync/?since=<seq>)
+CHAT_SYNC_PAGE_SIZE = 500
+# seconds a change waits before being synced (by the db clock): a running
+# transaction holding a lower seq must commit within it to be never skipped
+CHAT_SYNC_SETTLE_SECONDS = 5
+
+# max messages of a seq range read (chat/messages/<id>/?seq_from=<n>&seq_to=<m>)
+CHAT_SEQ_RANGE_MAX = 1000
+
+# max sub-requests of a batch request (batch/) and threads running the
+# read ones concurrently ("parallel": true)
+CHAT_BATCH_MAX_REQUESTS = 20
+CHAT_BATCH_WORKERS = 4
+
+# outbox relay (see chat.outbox and the relay_outbox command): events
+# published per batch, seconds a relay holds a shard, approximate length
+# of the events redis stream
+CHAT_OUTBOX_BATCH_SIZE = 500
+CHAT_OUTBOX_RELAY_LOCK_TTL = 60
+CHAT_EVENTS_STREAM_MAXLEN = 100000
+
+# last messages of the rooms cached in redis (chat/messages/<id>/?last=<n>),
+# and seconds they are kept without reads
+CHAT_RECENT_MESSAGES = 50
+CHAT_RECENT_MESSAGES_TTL = 24 * 60 * 60
+
+# seconds the rendered JSON of a message is cached (chat/messages/<id>/)
+CHAT_MESSAGE_RENDER_TTL = 24 * 60 * 60
+
+# max users (ids + usernames) of a bulk join / leave request
+CHAT_BULK_MEMBERS_MAX = 5000
+
+# rows deleted by each statement of the rooms / users deletion jobs
+CHAT_DELETE_CHUNK_SIZE = 1000
+
+# users directory cursor pages (?page_size= up to the max)
+USERS_PAGE_SIZE = 100
+USERS_MAX_PAGE_SIZE = 1000
+
+# presence heartbeats keep the user status in redis for this many seconds,
+# Profile.status is written only on the transitions
+PRESENCE_CACHE_KEY = 'presence'
+PRESENCE_TTL = 60
+
 
 LOGGING = {
     'version': 1,
@@ -241,4 +396,8 @@ CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND')
 
 CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_RESULT_SERIALIZER = 'json'
-CELERY_TASK_SERIALIZER = 'json'
\ No newline at end of file
+CELERY_TASK_SERIALIZER = 'json'
+
+# queue wait, run time, db time and result size of the celery tasks, kept
+# in redis by the workers and exported at /chat/metrics/ (prometheus format)
+CHAT_TASK_METRICS = True
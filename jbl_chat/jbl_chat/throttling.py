@@ -0,0 +1,164 @@
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django_redis import get_redis_connection
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+from jbl_chat.profiling import timed
+
+## LOGGING
+import logging
+logger = logging.getLogger(__name__)
+
+CHAT_CACHE_KEY = getattr(settings, 'CHAT_CACHE_KEY', '')
+
+# Atomic token bucket, one EVALSHA per check.
+# KEYS[1] bucket key
+# ARGV[1] capacity, ARGV[2] refill rate (tokens/s)
+# returns {allowed (0|1), seconds to wait for the next token}
+# The clock is the redis server one, the web nodes clocks may drift apart
+TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local refill_rate = tonumber(ARGV[2])
+
+-- TIME is not deterministic, writes after it need the effects replication
+-- (the default from redis 5)
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * refill_rate)
+
+local allowed = 0
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 - tokens) / refill_rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_rate) + 1)
+return {allowed, tostring(wait)}
+"""
+
+_token_bucket_script = None
+
+
+def get_token_bucket_script():
+    global _token_bucket_script
+    if _token_bucket_script is None:
+        _token_bucket_script = get_redis_connection('default').register_script(TOKEN_BUCKET_LUA)
+    return _token_bucket_script
+
+
+def parse_rate(rate: str) -> Tuple[int, float]:
+    """Parses a DRF like rate '<n>/<s|m|h|d>'
+
+    Returns:
+        Tuple[int, float]: bucket capacity and refill rate in tokens per second
+    """
+    num, period = rate.split('/')
+    num_requests = int(num)
+    duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+    return num_requests, num_requests / duration
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Redis token bucket throttle.
+
+       The rate is read from REST_FRAMEWORK['DEFAULT_THROTTLE_RATES']
+       by the url name of the endpoint (plus the 'scope_suffix'),
+       endpoints without a rate are not throttled.
+       Throttled requests are rejected before reaching the view, so
+       they never enqueue a celery task.
+    """
+    scope_suffix = ''
+
+    def __init__(self):
+        self.wait_time = None
+
+    def get_scope(self, request) -> Optional[str]:
+        resolver_match = getattr(request, 'resolver_match', None)
+        if resolver_match is None or not resolver_match.url_name:
+            return None
+        return resolver_match.url_name + self.scope_suffix
+
+    def get_bucket_id(self, request, view) -> Optional[str]:
+        raise NotImplementedError('.get_bucket_id() must be overridden')
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request)
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+
+        bucket_id = self.get_bucket_id(request, view)
+        if bucket_id is None:
+            return True
+
+        capacity, refill_rate = parse_rate(rate)
+        key = '{}:throttle:{}:{}'.format(CHAT_CACHE_KEY, scope, bucket_id)
+        try:
+            with timed('cache'):
+                allowed, wait = get_token_bucket_script()(
+                    keys=[key],
+                    args=[capacity, refill_rate]
+                )
+        except Exception as ex:
+            # never block the traffic because of the throttle storage
+            logger.warning('throttle check failed for %s: %s', key, ex)
+            return True
+
+        if int(allowed):
+            return True
+
+        self.wait_time = float(wait)
+        logger.info('request throttled on %s, retry in %.2fs', key, self.wait_time)
+        return False
+
+    def wait(self):
+        return self.wait_time
+
+
+class UserTokenBucketThrottle(TokenBucketThrottle):
+    """Per user bucket.
+
+       No auth is requested, so the user is taken from the authenticated user,
+       from the 'from' attribute of the body or from the ?user_id=<user_id> qs,
+       falling back to the client ip
+    """
+
+    def get_bucket_id(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return 'user:{}'.format(request.user.pk)
+
+        user_id = request.query_params.get('user_id')
+        if not user_id and request.method == 'POST':
+            try:
+                user_id = request.data.get('from')
+            except Exception:
+                user_id = None
+        if user_id:
+            return 'user:{}'.format(user_id)
+
+        return 'ip:{}'.format(self.get_ident(request))
+
+
+class RoomTokenBucketThrottle(TokenBucketThrottle):
+    """Per chat room bucket, rates are configured as '<url_name>__room'"""
+    scope_suffix = '__room'
+
+    def get_bucket_id(self, request, view):
+        group_id = view.kwargs.get('group_id')
+        if group_id is None:
+            return None
+        return 'room:{}'.format(group_id)
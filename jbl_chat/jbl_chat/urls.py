@@ -16,8 +16,15 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 
+from jbl_chat.batch import BATCH_PATH, BATCH_URL_NAME, BatchAPIView
+
+batch = BatchAPIView.as_view({
+    'post': 'batch',
+})
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('users/', include('authentication.urls')),
     path('chat/', include('chat.urls')),
+    path(BATCH_PATH.lstrip('/'), batch, name=BATCH_URL_NAME),
 ]